@@ -0,0 +1,164 @@
+import logging
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import contains_eager
+
+from app import app, db
+from models import Certificate, CertificateAlert, Company, User
+
+logger = logging.getLogger(__name__)
+
+# Days before expiry at which alerts are sent
+ALERT_THRESHOLDS = (30, 15, 5)
+
+
+def _threshold_for(days_left):
+    """Return the smallest alert threshold a certificate has reached"""
+    reached = [days for days in ALERT_THRESHOLDS if days_left <= days]
+    return min(reached) if reached else None
+
+
+def find_due_alerts(today=None):
+    """Return (certificate, threshold, days_left) tuples not alerted yet
+
+    A single range scan covers every alert window, so a run that was skipped
+    (or a certificate uploaded inside a window) still gets its alert on the
+    next run instead of waiting for an exact day match.
+    """
+    today = today or datetime.now().date()
+
+    certificates = (
+        Certificate.query
+        .join(Company)
+        .options(contains_eager(Certificate.company))
+        .filter(
+            Certificate.expiry_date > today,
+            Certificate.expiry_date <= today + timedelta(days=max(ALERT_THRESHOLDS))
+        )
+        .order_by(Certificate.expiry_date)
+        .all()
+    )
+    if not certificates:
+        return []
+
+    sent = set(
+        db.session.query(
+            CertificateAlert.certificate_id,
+            CertificateAlert.threshold_days,
+            CertificateAlert.expiry_date
+        )
+        .filter(CertificateAlert.certificate_id.in_([c.id for c in certificates]))
+        .all()
+    )
+
+    due = []
+    for certificate in certificates:
+        days_left = (certificate.expiry_date - today).days
+        threshold = _threshold_for(days_left)
+        if (certificate.id, threshold, certificate.expiry_date) not in sent:
+            due.append((certificate, threshold, days_left))
+    return due
+
+
+def _claim(certificate, threshold):
+    """Record an alert in the ledger; False if another run already did"""
+    try:
+        with db.session.begin_nested():
+            db.session.add(CertificateAlert(
+                certificate_id=certificate.id,
+                organization_id=certificate.organization_id,
+                threshold_days=threshold,
+                expiry_date=certificate.expiry_date
+            ))
+        return True
+    except IntegrityError:
+        return False
+
+
+def run_expiration_alerts(today=None):
+    """Queue every due expiration alert once
+
+    Alerts are claimed in the ledger and queued in the mail outbox in the
+    same transaction, so concurrent runs (several workers or hosts) never
+    send the same alert twice; an alert that fails to queue is not claimed.
+    Returns the number of alerts queued.
+    """
+    from utils import send_expiration_alert
+
+    due = find_due_alerts(today)
+    if not due:
+        return 0
+
+    # Group hits by organization and resolve all admins in one query
+    by_organization = {}
+    for certificate, threshold, days_left in due:
+        by_organization.setdefault(certificate.organization_id, []).append(
+            (certificate, threshold, days_left)
+        )
+
+    admins = {}
+    for admin in User.query.filter(
+        User.organization_id.in_(list(by_organization)),
+        User.role.in_(['admin', 'master_admin'])
+    ):
+        admins.setdefault(admin.organization_id, []).append(admin.email)
+
+    queued = 0
+    with app.test_request_context('/', base_url=app.config["APP_BASE_URL"]):
+        for organization_id, alerts in by_organization.items():
+            if not admins.get(organization_id):
+                logger.warning(f"No admins found for organization {organization_id} alerts")
+                continue
+            for certificate, threshold, days_left in alerts:
+                savepoint = db.session.begin_nested()
+                if not _claim(certificate, threshold):
+                    savepoint.rollback()
+                    continue
+                if not send_expiration_alert(
+                    certificate,
+                    days_left,
+                    admins[organization_id],
+                    dedup_key=f"alert:{certificate.id}:{threshold}:{certificate.expiry_date.isoformat()}"
+                ):
+                    # Release the claim so the next run retries the alert
+                    savepoint.rollback()
+                    continue
+                savepoint.commit()
+                queued += 1
+        db.session.commit()
+    return queued
+
+
+# CLI commands
+alerts_cli = AppGroup('alerts', help='Alertas de expiração de certificados.')
+
+
+@alerts_cli.command('run')
+def run_command():
+    """Queue due expiration alerts once."""
+    queued = run_expiration_alerts()
+    click.echo(f'{queued} alerta(s) enfileirado(s).')
+
+
+@alerts_cli.command('schedule')
+@click.option('--interval', type=int, default=3600, show_default=True,
+              help='Intervalo entre verificações, em segundos.')
+def schedule_command(interval):
+    """Run the expiration alerts in a loop."""
+    while True:
+        try:
+            queued = run_expiration_alerts()
+            logger.info(f"Expiration alerts: {queued} queued")
+        except Exception:
+            db.session.rollback()
+            logger.exception("Expiration alerts run failed")
+        finally:
+            db.session.remove()
+        time.sleep(interval)
+
+
+app.cli.add_command(alerts_cli)
@@ -10,6 +10,7 @@ from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_login import LoginManager, current_user
 from flask_wtf.csrf import CSRFProtect
 from flask_mail import Mail
+from flask_migrate import Migrate
 from datetime import datetime
 
 # Configure logging
@@ -25,13 +26,27 @@ db = SQLAlchemy(model_class=Base)
 csrf = CSRFProtect()
 login_manager = LoginManager()
 mail = Mail()
+migrate = Migrate()
 
 # Create the app
 app = Flask(__name__)
 
 # Configure app
 app.secret_key = os.environ.get("SESSION_SECRET", "oguardiao-dev-key")
-app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
+
+# Reverse proxies in front of the application whose X-Forwarded-* headers
+# are trusted (0 ignores the header). Proto and host are trusted from one
+# proxy, for HTTPS links and secure cookies; client IPs feed the rate
+# limits, so X-Forwarded-For is opt-in, only behind a proxy that sets it
+app.config["PROXY_FIX_X_FOR"] = int(os.environ.get("PROXY_FIX_X_FOR", 0))
+app.config["PROXY_FIX_X_PROTO"] = int(os.environ.get("PROXY_FIX_X_PROTO", 1))
+app.config["PROXY_FIX_X_HOST"] = int(os.environ.get("PROXY_FIX_X_HOST", 1))
+app.wsgi_app = ProxyFix(
+    app.wsgi_app,
+    x_for=app.config["PROXY_FIX_X_FOR"],
+    x_proto=app.config["PROXY_FIX_X_PROTO"],
+    x_host=app.config["PROXY_FIX_X_HOST"]
+)
 
 # Database configuration
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///oguardiao.db")
@@ -41,12 +56,98 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
 }
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# Create missing tables at startup; disable when the schema is managed with
+# migrations (flask db upgrade)
+app.config["AUTO_CREATE_SCHEMA"] = os.environ.get("AUTO_CREATE_SCHEMA", "True") == "True"
+
+# Public URL used in links of emails sent outside a request (e.g. alerts)
+app.config["APP_BASE_URL"] = os.environ.get("APP_BASE_URL", "http://localhost:5000")
+
+# Certificate statistics caches (seconds, 0 disables caching)
+app.config["DASHBOARD_STATS_CACHE_TTL"] = int(os.environ.get("DASHBOARD_STATS_CACHE_TTL", 300))
+app.config["EXPIRING_BADGE_CACHE_TTL"] = int(os.environ.get("EXPIRING_BADGE_CACHE_TTL", 60))
+
+# Users loaded by Flask-Login are cached per worker process (seconds, 0
+# disables caching); commits that change a user are logged in a SQLite file
+# the workers of the host poll (see identity.py)
+app.config["IDENTITY_CACHE_TTL"] = int(os.environ.get("IDENTITY_CACHE_TTL", 60))
+app.config["IDENTITY_CACHE_SIZE"] = int(os.environ.get("IDENTITY_CACHE_SIZE", 10000))
+app.config["IDENTITY_CACHE_SQLITE_PATH"] = os.environ.get("IDENTITY_CACHE_SQLITE_PATH")
+
 # Security configurations
 app.config["PERMANENT_SESSION_LIFETIME"] = timedelta(hours=12)
 app.config["SESSION_COOKIE_SECURE"] = True
 app.config["SESSION_COOKIE_HTTPONLY"] = True
 app.config["SESSION_COOKIE_SAMESITE"] = "Lax"
 
+# Last activity tracking (seconds)
+app.config["LAST_ACTIVITY_WRITE_INTERVAL"] = int(os.environ.get("LAST_ACTIVITY_WRITE_INTERVAL", 60))
+app.config["LAST_ACTIVITY_FLUSH_INTERVAL"] = int(os.environ.get("LAST_ACTIVITY_FLUSH_INTERVAL", 15))
+app.config["LAST_ACTIVITY_BATCH_SIZE"] = int(os.environ.get("LAST_ACTIVITY_BATCH_SIZE", 500))
+
+# Audit log buffering
+app.config["AUDIT_LOG_SYNC"] = os.environ.get("AUDIT_LOG_SYNC", "False") == "True"
+app.config["AUDIT_LOG_BATCH_SIZE"] = int(os.environ.get("AUDIT_LOG_BATCH_SIZE", 100))
+app.config["AUDIT_LOG_FLUSH_INTERVAL"] = int(os.environ.get("AUDIT_LOG_FLUSH_INTERVAL", 5))
+app.config["AUDIT_LOG_SPOOL_DIR"] = os.environ.get("AUDIT_LOG_SPOOL_DIR")
+app.config["AUDIT_LOG_SPOOL_FSYNC"] = os.environ.get("AUDIT_LOG_SPOOL_FSYNC", "False") == "True"
+app.config["AUDIT_ACTION_CATALOG_CACHE_TTL"] = int(os.environ.get("AUDIT_ACTION_CATALOG_CACHE_TTL", 300))
+
+# Audit log partitions kept in the database (months) and cold archive location
+app.config["AUDIT_HOT_RETENTION_MONTHS"] = int(os.environ.get("AUDIT_HOT_RETENTION_MONTHS", 6))
+app.config["AUDIT_ARCHIVE_DIR"] = os.environ.get("AUDIT_ARCHIVE_DIR")
+
+# Certificate password encryption keys: the single key is version 1; during a
+# rotation list every key as "version:key,..." (the highest version, or
+# CERTIFICATE_ENCRYPTION_KEY_VERSION, encrypts new passwords)
+app.config["CERTIFICATE_ENCRYPTION_KEY"] = os.environ.get("CERTIFICATE_ENCRYPTION_KEY")
+app.config["CERTIFICATE_ENCRYPTION_KEYS"] = os.environ.get("CERTIFICATE_ENCRYPTION_KEYS")
+app.config["CERTIFICATE_ENCRYPTION_KEY_VERSION"] = int(os.environ.get("CERTIFICATE_ENCRYPTION_KEY_VERSION", 0))
+
+# Processes parsing certificate files in bulk imports (0 = one per CPU)
+app.config["CERTIFICATE_IMPORT_WORKERS"] = int(os.environ.get("CERTIFICATE_IMPORT_WORKERS", 0))
+
+# Certificate file storage: "local" (STORAGE_LOCAL_DIR) or "s3" (AWS S3 or any
+# S3-compatible service such as MinIO; credentials from the AWS_* variables or
+# the instance role)
+app.config["STORAGE_BACKEND"] = os.environ.get("STORAGE_BACKEND", "local")
+app.config["STORAGE_LOCAL_DIR"] = os.environ.get("STORAGE_LOCAL_DIR", "certificates")
+app.config["AWS_S3_BUCKET_NAME"] = os.environ.get("AWS_S3_BUCKET_NAME", "oguardiao-certificates")
+app.config["AWS_S3_REGION"] = os.environ.get("AWS_S3_REGION", "us-east-1")
+app.config["AWS_S3_ENDPOINT_URL"] = os.environ.get("AWS_S3_ENDPOINT_URL")
+app.config["AWS_S3_PREFIX"] = os.environ.get("AWS_S3_PREFIX", "certificates/")
+app.config["STORAGE_MULTIPART_CHUNK_SIZE"] = int(os.environ.get("STORAGE_MULTIPART_CHUNK_SIZE", 8 * 1024 * 1024))
+app.config["STORAGE_MAX_CONCURRENCY"] = int(os.environ.get("STORAGE_MAX_CONCURRENCY", 8))
+app.config["STORAGE_PRESIGNED_URL_TTL"] = int(os.environ.get("STORAGE_PRESIGNED_URL_TTL", 300))
+
+# Certificate downloads from local storage: served by the application ("") or
+# handed to the front proxy ("x-accel-redirect" for nginx, "x-sendfile" for
+# Apache/lighttpd); the nginx internal location maps the prefix to
+# STORAGE_LOCAL_DIR
+app.config["CERTIFICATE_DOWNLOAD_OFFLOAD"] = os.environ.get("CERTIFICATE_DOWNLOAD_OFFLOAD", "")
+app.config["CERTIFICATE_DOWNLOAD_ACCEL_PREFIX"] = os.environ.get("CERTIFICATE_DOWNLOAD_ACCEL_PREFIX", "/protected/certificates/")
+
+# Request limits (token buckets): per IP, per login form POST and, by plan,
+# per user and organization; "sqlite" shares the buckets between workers,
+# with "memory" each worker process has its own buckets, so the effective
+# limits are multiplied by the number of workers
+app.config["RATE_LIMIT_ENABLED"] = os.environ.get("RATE_LIMIT_ENABLED", "True") == "True"
+app.config["RATE_LIMIT_STORAGE"] = os.environ.get("RATE_LIMIT_STORAGE", "memory")
+app.config["RATE_LIMIT_SQLITE_PATH"] = os.environ.get("RATE_LIMIT_SQLITE_PATH")
+app.config["RATE_LIMIT_IP_PER_MINUTE"] = int(os.environ.get("RATE_LIMIT_IP_PER_MINUTE", 300))
+app.config["RATE_LIMIT_LOGIN_PER_MINUTE"] = int(os.environ.get("RATE_LIMIT_LOGIN_PER_MINUTE", 10))
+
+# Request instrumentation: Server-Timing headers and Prometheus metrics at
+# /metrics, merged from one file per worker process in METRICS_DIR
+app.config["SERVER_TIMING_ENABLED"] = os.environ.get("SERVER_TIMING_ENABLED", "True") == "True"
+app.config["METRICS_DIR"] = os.environ.get("METRICS_DIR")
+app.config["METRICS_FLUSH_INTERVAL"] = int(os.environ.get("METRICS_FLUSH_INTERVAL", 5))
+app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")
+
+# Relationship lazy loads during template rendering (N+1 queries): "off",
+# "warn" (logged per request) or "raise" (development and tests)
+app.config["LAZY_LOAD_DETECTION"] = os.environ.get("LAZY_LOAD_DETECTION", "off")
+
 # Mail configuration
 app.config["MAIL_SERVER"] = os.environ.get("MAIL_SERVER", "smtp.gmail.com")
 app.config["MAIL_PORT"] = int(os.environ.get("MAIL_PORT", 587))
@@ -55,11 +156,44 @@ app.config["MAIL_USERNAME"] = os.environ.get("MAIL_USERNAME")
 app.config["MAIL_PASSWORD"] = os.environ.get("MAIL_PASSWORD")
 app.config["MAIL_DEFAULT_SENDER"] = os.environ.get("MAIL_DEFAULT_SENDER", "noreply@oguardiao.com")
 
+# Mail outbox delivery
+app.config["MAIL_OUTBOX_BACKGROUND"] = os.environ.get("MAIL_OUTBOX_BACKGROUND", "True") == "True"
+app.config["MAIL_OUTBOX_POLL_INTERVAL"] = int(os.environ.get("MAIL_OUTBOX_POLL_INTERVAL", 10))
+app.config["MAIL_OUTBOX_BATCH_SIZE"] = int(os.environ.get("MAIL_OUTBOX_BATCH_SIZE", 100))
+app.config["MAIL_OUTBOX_MAX_ATTEMPTS"] = int(os.environ.get("MAIL_OUTBOX_MAX_ATTEMPTS", 5))
+app.config["MAIL_OUTBOX_RETRY_BACKOFF"] = int(os.environ.get("MAIL_OUTBOX_RETRY_BACKOFF", 60))
+app.config["MAIL_OUTBOX_LEASE"] = int(os.environ.get("MAIL_OUTBOX_LEASE", 600))
+
 # Initialize extensions with app
 db.init_app(app)
 csrf.init_app(app)
 login_manager.init_app(app)
 mail.init_app(app)
+migrate.init_app(app, db)
+
+# Write-behind tracker for users' last activity
+from presence import activity_tracker
+activity_tracker.init_app(app)
+
+# Buffered audit log writer
+from audit import audit_sink
+audit_sink.init_app(app)
+
+# SQL, template and request timing of every view
+from metrics import request_metrics
+request_metrics.init_app(app)
+
+# N+1 detection for templates (development and tests)
+from lazy_loads import lazy_load_detector
+lazy_load_detector.init_app(app)
+
+# Identity cache for Flask-Login's user loader
+from identity import identity_cache
+identity_cache.init_app(app)
+
+# Request rate limiting
+from rate_limit import rate_limiter
+rate_limiter.init_app(app)
 
 # Login manager configuration
 login_manager.login_view = "login"
@@ -69,14 +203,29 @@ login_manager.login_message_category = "info"
 # Import models and routes after initializing app to avoid circular imports
 with app.app_context():
     # Import all models so they are registered with SQLAlchemy
-    from models import User, Organization, Company, Certificate, AuditLog, UserInvite, Group
+    from models import (
+        User, Organization, Company, Certificate, AuditLog, UserInvite, Group,
+        OrganizationCertificateStats, CertificateAlert, MailOutbox, AuditActionCatalog,
+        AuditArchiveSegment, CertificateBlob
+    )
 
     # Create all tables
-    db.create_all()
+    if app.config["AUTO_CREATE_SCHEMA"]:
+        db.create_all()
+
+        # Text search tables, triggers and indexes are not part of the models
+        from search import ensure_search_index
+        ensure_search_index()
 
 # Import route modules
 from auth import *
 
+# Register the expiration alerts, mail outbox and key rotation CLIs
+import alerts  # noqa: F401
+import outbox  # noqa: F401
+import query_plans  # noqa: F401
+import key_rotation  # noqa: F401
+
 # Register error handlers
 @app.errorhandler(404)
 def not_found_error(error):
@@ -90,31 +239,33 @@ def internal_error(error):
 # Context processor for global template variables
 @app.context_processor
 def utility_processor():
+    from stats import certificate_status
+
     def check_expiring_certificates():
-        if current_user.is_authenticated:
-            from models import Certificate
-            from datetime import datetime, timedelta
-            
-            today = datetime.now().date()
-            expiring_soon = Certificate.query.filter(
-                Certificate.expiry_date <= today + timedelta(days=30),
-                Certificate.expiry_date > today
-            ).count()
+        if current_user.is_authenticated and current_user.organization_id:
+            from stats import get_expiring_badge_count
             
-            return expiring_soon
+            # Scoped to the user's organization, memoized per request and
+            # cached across requests
+            return get_expiring_badge_count(current_user.organization_id)
         return 0
     
     return {
         'check_expiring_certificates': check_expiring_certificates,
+        'certificate_status': certificate_status,
+        # Templates check for optional endpoints in current_app.view_functions
+        'current_app': app,
         'now': datetime.now()
     }
 
 # Middleware to track last activity
 @app.before_request
 def update_last_activity():
+    if request.endpoint == 'static':
+        return
     if current_user.is_authenticated:
-        current_user.last_active = datetime.utcnow()
-        db.session.commit()
+        # Recorded in memory and flushed in batches by the tracker
+        activity_tracker.touch(current_user.id)
 
 # Note: Role decorator functions are defined in auth.py
 
@@ -0,0 +1,362 @@
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import select
+from sqlalchemy.exc import DataError, IntegrityError
+
+from app import db
+from background import PeriodicFlusher, pid_alive
+
+logger = logging.getLogger(__name__)
+
+
+def _set_organizations(connection, events):
+    """Fill in each event's organization with one lookup per batch"""
+    from models import User
+
+    user_ids = {event["user_id"] for event in events if event.get("organization_id") is None}
+    if user_ids:
+        organizations = dict(connection.execute(
+            select(User.id, User.organization_id).where(User.id.in_(user_ids))
+        ).all())
+    for event in events:
+        if event.get("organization_id") is None:
+            event["organization_id"] = organizations.get(event["user_id"])
+
+
+def _insert_ignoring_duplicates(connection, table, rows):
+    """Insert rows, skipping those that violate a unique constraint"""
+    dialect = connection.dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        for row in rows:
+            try:
+                with connection.begin_nested():
+                    connection.execute(table.insert(), row)
+            except IntegrityError:
+                pass
+        return
+    connection.execute(insert(table).on_conflict_do_nothing(), rows)
+
+
+class ActionCatalog:
+    """Distinct audit actions per organization
+
+    The catalog table is maintained as events are written, so the audit log
+    filters never scan `audit_logs`. Lookups are cached per process for
+    AUDIT_ACTION_CATALOG_CACHE_TTL seconds and dropped when this process
+    records a new action for the organization.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._known = set()
+        self._lock = threading.Lock()
+
+    def get(self, organization_id):
+        from models import AuditActionCatalog
+
+        ttl = current_app.config.get("AUDIT_ACTION_CATALOG_CACHE_TTL", 300)
+        with self._lock:
+            entry = self._entries.get(organization_id)
+        if entry is not None and time.monotonic() - entry[0] < ttl:
+            return entry[1]
+
+        actions = db.session.execute(
+            select(AuditActionCatalog.action)
+            .where(AuditActionCatalog.organization_id == organization_id)
+            .order_by(AuditActionCatalog.action)
+        ).scalars().all()
+        if ttl > 0:
+            with self._lock:
+                self._entries[organization_id] = (time.monotonic(), actions)
+        return actions
+
+    def record(self, connection, events):
+        """Add the actions of a batch of events to the catalog
+
+        Runs on the connection that inserts the events; returns the new
+        (organization_id, action) pairs, to be passed to `remember()` once
+        the transaction is committed.
+        """
+        from models import AuditActionCatalog
+
+        with self._lock:
+            pairs = {
+                (event["organization_id"], event["action"])
+                for event in events
+                if event["organization_id"] is not None
+            } - self._known
+        if pairs:
+            now = datetime.utcnow()
+            _insert_ignoring_duplicates(connection, AuditActionCatalog.__table__, [
+                {"organization_id": organization_id, "action": action, "first_seen_at": now}
+                for organization_id, action in sorted(pairs)
+            ])
+        return pairs
+
+    def remember(self, pairs):
+        with self._lock:
+            self._known.update(pairs)
+            for organization_id, _ in pairs:
+                self._entries.pop(organization_id, None)
+
+    def rebuild(self):
+        """Fill the catalog from the existing audit logs"""
+        from models import AuditActionCatalog, AuditLog
+
+        with db.engine.begin() as connection:
+            rows = connection.execute(
+                select(AuditLog.organization_id, AuditLog.action)
+                .where(AuditLog.organization_id.isnot(None))
+                .distinct()
+            ).all()
+            if rows:
+                now = datetime.utcnow()
+                _insert_ignoring_duplicates(connection, AuditActionCatalog.__table__, [
+                    {"organization_id": organization_id, "action": action, "first_seen_at": now}
+                    for organization_id, action in rows
+                ])
+        with self._lock:
+            self._entries.clear()
+        return len(rows)
+
+
+action_catalog = ActionCatalog()
+
+
+class AuditSink:
+    """Buffered writer for `AuditLog` rows
+
+    Events are appended to a per-process spool file and queued in memory; a
+    background thread bulk-inserts them once AUDIT_LOG_BATCH_SIZE events are
+    queued or every AUDIT_LOG_FLUSH_INTERVAL seconds. Spool files left behind
+    by a worker that died are replayed by the next process that starts.
+    Events the database rejects (constraint or data errors) are set aside in
+    a `rejected-<pid>.jsonl` file of the spool directory; any other error
+    requeues the batch for the next flush.
+    With AUDIT_LOG_SYNC enabled events are written and committed immediately.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.sync = True
+        self.batch_size = 100
+        self.spool_dir = None
+        self.fsync = False
+        self._queue = []
+        self._batch_files = []
+        self._spool = None
+        self._spool_pid = None
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.sync = app.config.get("AUDIT_LOG_SYNC", False)
+        self.batch_size = app.config.get("AUDIT_LOG_BATCH_SIZE", 100)
+        self.spool_dir = app.config.get("AUDIT_LOG_SPOOL_DIR") or os.path.join(
+            app.instance_path, "audit_spool"
+        )
+        self.fsync = app.config.get("AUDIT_LOG_SPOOL_FSYNC", False)
+        self._flusher = PeriodicFlusher(
+            "audit-log-flusher",
+            self.flush,
+            app.config.get("AUDIT_LOG_FLUSH_INTERVAL", 5),
+        )
+        app.cli.add_command(audit_cli)
+
+    def log(self, user_id, action, details=None, ip_address=None):
+        """Record an audit event"""
+        event = {
+            "user_id": user_id,
+            "action": action,
+            "details": details,
+            "ip_address": ip_address,
+            "created_at": datetime.utcnow(),
+        }
+
+        if self.sync:
+            self._write_sync(event)
+            return
+
+        with self._lock:
+            self._append_to_spool(event)
+            self._queue.append(event)
+            queued = len(self._queue)
+
+        self._flusher.ensure_started()
+        if queued >= self.batch_size:
+            self._flusher.wake()
+
+    def _write_sync(self, event):
+        from models import AuditLog
+
+        try:
+            connection = db.session.connection()
+            _set_organizations(connection, [event])
+            db.session.add(AuditLog(**event))
+            pairs = action_catalog.record(connection, [event])
+            db.session.commit()
+        except Exception as e:
+            logger.error(f"Failed to save audit log: {str(e)}")
+            db.session.rollback()
+        else:
+            action_catalog.remember(pairs)
+
+    def _spool_path(self, suffix):
+        return os.path.join(self.spool_dir, f"audit-{os.getpid()}{suffix}")
+
+    def _append_to_spool(self, event):
+        if self._spool is None or self._spool_pid != os.getpid():
+            if self._spool_pid != os.getpid():
+                # First event in this process: replay what dead workers left
+                self._spool_pid = os.getpid()
+                self._queue, self._batch_files = [], []
+                self._recover_orphans()
+            os.makedirs(self.spool_dir, exist_ok=True)
+            self._spool = open(self._spool_path(".jsonl"), "a", encoding="utf-8")
+
+        record = dict(event, created_at=event["created_at"].isoformat())
+        self._spool.write(json.dumps(record) + "\n")
+        self._spool.flush()
+        if self.fsync:
+            os.fsync(self._spool.fileno())
+
+    def _recover_orphans(self):
+        if not os.path.isdir(self.spool_dir):
+            return
+        for path in glob.glob(os.path.join(self.spool_dir, "audit-*")):
+            name = os.path.basename(path)
+            try:
+                pid = int(name.split("-")[1].split(".")[0])
+            except (IndexError, ValueError):
+                continue
+            if pid != os.getpid() and pid_alive(pid):
+                continue
+
+            # Claim the file atomically so only one process replays it
+            self._sequence += 1
+            claimed = self._spool_path(f"-{self._sequence}.batch")
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue
+            self._queue.extend(self._read_spool(claimed))
+            self._batch_files.append(claimed)
+
+        if self._queue:
+            logger.info(f"Recovered {len(self._queue)} spooled audit events")
+
+    @staticmethod
+    def _read_spool(path):
+        events = []
+        with open(path, encoding="utf-8") as spool:
+            for line in spool:
+                try:
+                    record = json.loads(line)
+                    record["created_at"] = datetime.fromisoformat(record["created_at"])
+                except (ValueError, KeyError, TypeError):
+                    # Partially written line from a worker that died mid-write
+                    continue
+                events.append(record)
+        return events
+
+    def flush(self):
+        """Bulk insert all queued events; returns the number inserted"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._queue:
+                    return 0
+                events, self._queue = self._queue, []
+                if self._spool is not None:
+                    # Rotate the spool so it holds exactly the events in flight
+                    self._spool.close()
+                    self._spool = None
+                    self._sequence += 1
+                    batch_file = self._spool_path(f"-{self._sequence}.batch")
+                    os.rename(self._spool_path(".jsonl"), batch_file)
+                    self._batch_files.append(batch_file)
+                batch_files = list(self._batch_files)
+
+            # A batch the database rejects is halved until the offending
+            # events are isolated; the rest of it is still inserted
+            chunks, rejected = [events], []
+            try:
+                while chunks:
+                    chunk = chunks.pop()
+                    try:
+                        self._insert(chunk)
+                    except (IntegrityError, DataError) as e:
+                        if len(chunk) == 1:
+                            rejected.append((chunk[0], e))
+                        else:
+                            middle = len(chunk) // 2
+                            chunks += [chunk[middle:], chunk[:middle]]
+            except Exception:
+                # Transient (connection lost, lock timeout): retry what is left
+                pending = [chunk] + chunks[::-1]
+                with self._lock:
+                    self._queue[:0] = [event for part in pending for event in part]
+                raise
+            finally:
+                if rejected:
+                    self._reject(rejected)
+
+            with self._lock:
+                for path in batch_files:
+                    self._batch_files.remove(path)
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+            return len(events) - len(rejected)
+
+    def _reject(self, rejected):
+        """Set events the database refused aside, with the reason"""
+        os.makedirs(self.spool_dir, exist_ok=True)
+        path = os.path.join(self.spool_dir, f"rejected-{os.getpid()}.jsonl")
+        with open(path, "a", encoding="utf-8") as spool:
+            for event, error in rejected:
+                record = dict(event, created_at=event["created_at"].isoformat(), error=str(error.orig))
+                spool.write(json.dumps(record, default=str) + "\n")
+        logger.error(f"{len(rejected)} audit event(s) rejected by the database, kept in {path}")
+
+    def _insert(self, events):
+        from models import AuditLog
+
+        with self.app.app_context():
+            with db.engine.begin() as connection:
+                _set_organizations(connection, events)
+                connection.execute(AuditLog.__table__.insert(), events)
+                pairs = action_catalog.record(connection, events)
+        action_catalog.remember(pairs)
+
+
+audit_sink = AuditSink()
+
+
+# CLI commands
+audit_cli = AppGroup("audit", help="Logs de auditoria.")
+
+
+@audit_cli.command("rebuild-catalog")
+def rebuild_catalog_command():
+    """Rebuild the per-organization action catalog from the audit logs."""
+    pairs = action_catalog.rebuild()
+    click.echo(f"{pairs} ação(ões) por organização registrada(s).")
@@ -0,0 +1,437 @@
+import gzip
+import json
+import logging
+import os
+from datetime import date, datetime, time
+from collections import deque
+from heapq import merge
+from itertools import groupby
+
+import click
+from sqlalchemy import func, select, text
+from sqlalchemy.exc import SQLAlchemyError
+
+from app import app, db
+from audit import audit_cli
+from models import AuditArchiveSegment, AuditLog, User
+
+logger = logging.getLogger(__name__)
+
+# Rows fetched per round-trip while writing segments
+FETCH_SIZE = 5000
+
+# Rows deleted per statement when trimming an archived month
+DELETE_BATCH = 10000
+
+# Monthly partitions kept ready ahead of the current month on PostgreSQL
+PARTITIONS_AHEAD = 3
+
+
+def _month_start(value):
+    return date(value.year, value.month, 1)
+
+
+def _add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def _as_datetime(month):
+    return datetime.combine(month, time())
+
+
+def archive_dir():
+    return app.config.get("AUDIT_ARCHIVE_DIR") or os.path.join(app.instance_path, "audit_archive")
+
+
+def segment_path(organization_id, month):
+    """Path of a segment, relative to the archive directory"""
+    owner = f"org-{organization_id}" if organization_id is not None else "org-none"
+    return os.path.join(f"{month:%Y}", f"{month:%m}", f"{owner}.jsonl.gz")
+
+
+def partition_name(month):
+    return f"audit_logs_p{month:%Y%m}"
+
+
+# Partitions (PostgreSQL)
+
+def is_partitioned():
+    """Whether audit_logs is a natively partitioned table"""
+    if db.engine.dialect.name != "postgresql":
+        return False
+    return db.session.execute(text(
+        "SELECT 1 FROM pg_partitioned_table p "
+        "JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = 'audit_logs'"
+    )).first() is not None
+
+
+def _default_partition_rows(start, end):
+    """Whether the default partition holds rows of a range"""
+    if not db.session.execute(text("SELECT to_regclass('audit_logs_default')")).scalar():
+        return False
+    return db.session.execute(text(
+        "SELECT 1 FROM audit_logs_default WHERE created_at >= :start AND created_at < :end LIMIT 1"
+    ), {"start": start, "end": end}).first() is not None
+
+
+def _create_partition(month):
+    """Create a month's partition, moving its rows out of the default one
+
+    PostgreSQL refuses a new partition while the default partition holds
+    rows of its range, so the default partition is detached, emptied of
+    them through the new partition and attached again.
+    """
+    name = partition_name(month)
+    start, end = _as_datetime(month), _as_datetime(_add_months(month, 1))
+    create = text(
+        f"CREATE TABLE {name} PARTITION OF audit_logs "
+        f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    )
+    if not _default_partition_rows(start, end):
+        db.session.execute(create)
+        return
+
+    bounds = {"start": start, "end": end}
+    db.session.execute(text("LOCK TABLE audit_logs IN ACCESS EXCLUSIVE MODE"))
+    db.session.execute(text("ALTER TABLE audit_logs DETACH PARTITION audit_logs_default"))
+    db.session.execute(create)
+    db.session.execute(text(
+        "INSERT INTO audit_logs SELECT * FROM audit_logs_default WHERE created_at >= :start AND created_at < :end"
+    ), bounds)
+    db.session.execute(text(
+        "DELETE FROM audit_logs_default WHERE created_at >= :start AND created_at < :end"
+    ), bounds)
+    db.session.execute(text("ALTER TABLE audit_logs ATTACH PARTITION audit_logs_default DEFAULT"))
+
+
+def ensure_partitions(today=None, ahead=PARTITIONS_AHEAD):
+    """Create the monthly partitions of the current and next months
+
+    Returns the number of partitions created. Does nothing on databases
+    without native partitioning.
+    """
+    if not is_partitioned():
+        return 0
+
+    current = _month_start(today or datetime.utcnow().date())
+    created = 0
+    for offset in range(ahead + 1):
+        month = _add_months(current, offset)
+        name = partition_name(month)
+        if db.session.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar():
+            continue
+        try:
+            with db.session.begin_nested():
+                _create_partition(month)
+            created += 1
+        except SQLAlchemyError as e:
+            # Part of the range is still covered by the legacy partition
+            logger.warning(f"Could not create audit partition {name}: {str(e)}")
+    db.session.commit()
+    return created
+
+
+# Archiving
+
+def _read_segment_file(path):
+    with gzip.open(path, "rt", encoding="utf-8") as segment:
+        for line in segment:
+            yield json.loads(line)
+
+
+def _position(record):
+    return datetime.fromisoformat(record["created_at"]), record["id"]
+
+
+def _write_segment(organization_id, month, rows, archived_ids):
+    """Write (or extend) the segment of an organization's month
+
+    Records are stored newest first, the order the audit listing reads
+    them in, so a page is read from the start of the file without loading
+    the rest. `rows` must come newest first too; records already in an
+    existing segment are merged in, so a month can be archived again when
+    late events reach the hot table. The ids of `rows` are appended to
+    `archived_ids`. Returns the number of rows added.
+    """
+    relative = segment_path(organization_id, month)
+    path = os.path.join(archive_dir(), relative)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    manifest = AuditArchiveSegment.query.filter_by(organization_id=organization_id, month=month).first()
+
+    count = added = 0
+    first = last = None
+    seen = set()
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb") as segment:
+            def write(record):
+                nonlocal count, first, last
+                segment.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+                seen.add((record["created_at"], record["id"]))
+                count += 1
+                first = record["created_at"] if first is None else min(first, record["created_at"])
+                last = record["created_at"] if last is None else max(last, record["created_at"])
+
+            # Only merge with a segment the manifest knows about; anything
+            # else at this path is a leftover from an interrupted run
+            existing = []
+            if manifest is not None and os.path.exists(path):
+                existing = ({**record, "archived": True} for record in _read_segment_file(path))
+            def new():
+                for row in rows:
+                    archived_ids.append(row.id)
+                    yield {
+                        "id": row.id,
+                        "user_id": row.user_id,
+                        "user_name": row.user_name,
+                        "action": row.action,
+                        "details": row.details,
+                        "ip_address": row.ip_address,
+                        "created_at": row.created_at.isoformat(),
+                    }
+
+            for record in merge(existing, new(), key=_position, reverse=True):
+                # A row archived by an interrupted run is already there
+                if (record["created_at"], record["id"]) in seen:
+                    continue
+                added += not record.pop("archived", False)
+                write(record)
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(temporary, path)
+
+    if manifest is None:
+        manifest = AuditArchiveSegment(organization_id=organization_id, month=month)
+        db.session.add(manifest)
+    manifest.path = relative
+    manifest.row_count = count
+    manifest.first_created_at = datetime.fromisoformat(first) if first else None
+    manifest.last_created_at = datetime.fromisoformat(last) if last else None
+    manifest.archived_at = datetime.utcnow()
+    return added
+
+
+def _drop_partition(month, archived_ids):
+    """Drop a month's partition if it holds archived rows only
+
+    Audit writes are locked out while the partition is checked against the
+    archived ids, so no event can land in it between the check and the
+    drop. Returns whether it was dropped.
+    """
+    name = partition_name(month)
+    db.session.execute(text("LOCK TABLE audit_logs IN ACCESS EXCLUSIVE MODE"))
+    db.session.execute(text(
+        "CREATE TEMPORARY TABLE archived_audit_log_ids (id integer PRIMARY KEY) ON COMMIT DROP"
+    ))
+    for batch in range(0, len(archived_ids), DELETE_BATCH):
+        db.session.execute(
+            text("INSERT INTO archived_audit_log_ids (id) VALUES (:id)"),
+            [{"id": log_id} for log_id in archived_ids[batch:batch + DELETE_BATCH]]
+        )
+    unarchived = db.session.execute(text(
+        f"SELECT count(*) FROM {name} p "
+        f"WHERE NOT EXISTS (SELECT 1 FROM archived_audit_log_ids a WHERE a.id = p.id)"
+    )).scalar()
+    if unarchived:
+        db.session.rollback()
+        logger.warning(f"{unarchived} audit logs reached {name} while it was archived; keeping it")
+        return False
+    db.session.execute(text(f"ALTER TABLE audit_logs DETACH PARTITION {name}"))
+    db.session.execute(text(f"DROP TABLE {name}"))
+    db.session.commit()
+    return True
+
+
+def _drop_month(month, archived_ids):
+    """Remove the archived rows of a month from the hot table
+
+    Only rows written to a segment are removed: events of the month that
+    arrived after they were read (spool or orphan replays carry their
+    original created_at) stay for the next run.
+    """
+    if not archived_ids:
+        return
+    name = partition_name(month)
+    if is_partitioned() and db.session.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar():
+        _drop_partition(month, archived_ids)
+
+    # Plain table, rows of the month left in the legacy partition, or a
+    # partition that received new events: delete by id in small batches
+    start, end = _as_datetime(month), _as_datetime(_add_months(month, 1))
+    table = AuditLog.__table__
+    for batch in range(0, len(archived_ids), DELETE_BATCH):
+        db.session.execute(table.delete().where(
+            table.c.id.in_(archived_ids[batch:batch + DELETE_BATCH]),
+            table.c.created_at >= start,
+            table.c.created_at < end
+        ))
+        db.session.commit()
+
+
+def archive_month(month):
+    """Move one month of audit logs to per-organization segments
+
+    Segments are written and synced to disk before the rows leave the hot
+    table; returns the number of rows archived.
+    """
+    start, end = _as_datetime(month), _as_datetime(_add_months(month, 1))
+    rows = db.session.execute(
+        select(
+            AuditLog.id,
+            AuditLog.organization_id,
+            AuditLog.user_id,
+            User.name.label("user_name"),
+            AuditLog.action,
+            AuditLog.details,
+            AuditLog.ip_address,
+            AuditLog.created_at,
+        )
+        .outerjoin(User, AuditLog.user_id == User.id)
+        .where(AuditLog.created_at >= start, AuditLog.created_at < end)
+        .order_by(AuditLog.organization_id, AuditLog.created_at.desc(), AuditLog.id.desc())
+        .execution_options(yield_per=FETCH_SIZE)
+    )
+
+    archived = 0
+    archived_ids = []
+    for organization_id, group in groupby(rows, key=lambda row: row.organization_id):
+        archived += _write_segment(organization_id, month, group, archived_ids)
+    db.session.commit()
+
+    _drop_month(month, archived_ids)
+    return archived
+
+
+def archive_audit_logs(retention_months=None, today=None):
+    """Archive every month older than the retention window
+
+    Returns a dict with the months and rows archived.
+    """
+    if retention_months is None:
+        retention_months = app.config.get("AUDIT_HOT_RETENTION_MONTHS", 6)
+    today = today or datetime.utcnow().date()
+    cutoff = _add_months(_month_start(today), -retention_months)
+
+    ensure_partitions(today)
+
+    oldest = db.session.execute(
+        select(func.min(AuditLog.created_at)).where(AuditLog.created_at < _as_datetime(cutoff))
+    ).scalar()
+    result = {"months": 0, "rows": 0}
+    if oldest is None:
+        return result
+
+    month = _month_start(oldest)
+    while month < cutoff:
+        rows = archive_month(month)
+        if rows:
+            logger.info(f"Archived {rows} audit logs of {month:%Y-%m}")
+            result["months"] += 1
+            result["rows"] += rows
+        month = _add_months(month, 1)
+    return result
+
+
+# Reading
+
+class ArchivedAuditLog:
+    """Read-only audit log row loaded from an archive segment"""
+
+    __slots__ = ("id", "organization_id", "user_id", "user_name", "action", "details",
+                 "ip_address", "created_at")
+
+    def __init__(self, organization_id, record):
+        self.id = record["id"]
+        self.organization_id = organization_id
+        self.user_id = record["user_id"]
+        self.user_name = record.get("user_name") or "-"
+        self.action = record["action"]
+        self.details = record["details"]
+        self.ip_address = record["ip_address"]
+        self.created_at = datetime.fromisoformat(record["created_at"])
+
+
+def archived_audit_logs(organization_id, user_id=None, action=None, start=None, end=None):
+    """Return a `keyset_paginate` tail over an organization's archived logs
+
+    Archived months are always older than the hot table, so the listing
+    (newest first) continues into the archive once the table runs out.
+    """
+    def tail(values, backwards, limit):
+        key = tuple(values) if values is not None else None
+
+        segments = AuditArchiveSegment.query.filter(AuditArchiveSegment.organization_id == organization_id)
+        if start is not None:
+            segments = segments.filter(AuditArchiveSegment.last_created_at >= start)
+        if end is not None:
+            segments = segments.filter(AuditArchiveSegment.first_created_at < end)
+        if key is not None:
+            if backwards:
+                segments = segments.filter(AuditArchiveSegment.last_created_at >= key[0])
+            else:
+                segments = segments.filter(AuditArchiveSegment.first_created_at <= key[0])
+        segments = segments.order_by(
+            AuditArchiveSegment.month.asc() if backwards else AuditArchiveSegment.month.desc()
+        )
+
+        items = []
+        for segment in segments:
+            path = os.path.join(archive_dir(), segment.path)
+            try:
+                items.extend(_read_page(path, key, backwards, limit - len(items)))
+            except OSError as e:
+                logger.error(f"Audit archive segment unavailable: {str(e)}")
+                continue
+            if len(items) == limit:
+                break
+        return items
+
+    def _read_page(path, key, backwards, limit):
+        """Up to `limit` matching logs of a segment next to the key
+
+        Segments are stored newest first: reading older logs stops once the
+        page is full, reading newer ones stops at the key and keeps only
+        the `limit` logs closest to it.
+        """
+        page = deque(maxlen=limit) if backwards else []
+        for record in _read_segment_file(path):
+            log = ArchivedAuditLog(organization_id, record)
+            if key is not None:
+                position = (log.created_at, log.id)
+                if backwards and position <= key:
+                    break
+                if not backwards and position >= key:
+                    continue
+            if user_id and log.user_id != user_id:
+                continue
+            if action and log.action != action:
+                continue
+            if start is not None and log.created_at < start:
+                continue
+            if end is not None and log.created_at >= end:
+                continue
+            page.append(log)
+            if not backwards and len(page) == limit:
+                break
+        return list(reversed(page)) if backwards else page
+
+    return tail
+
+
+# CLI commands
+
+@audit_cli.command("archive")
+@click.option("--retention-months", type=int, default=None,
+              help="Meses mantidos no banco (padrão: AUDIT_HOT_RETENTION_MONTHS).")
+def archive_command(retention_months):
+    """Move audit logs older than the retention window to the archive."""
+    result = archive_audit_logs(retention_months)
+    click.echo(f"{result['rows']} log(s) de {result['months']} mês(es) arquivado(s).")
+
+
+@audit_cli.command("partitions")
+def partitions_command():
+    """Create the upcoming monthly partitions (PostgreSQL)."""
+    created = ensure_partitions()
+    click.echo(f"{created} partição(ões) criada(s).")
@@ -1,12 +1,24 @@
-from flask import render_template, redirect, url_for, flash, request, jsonify, g
+from flask import render_template, redirect, url_for, flash, request, jsonify, g, Response, stream_with_context
 from flask_login import login_user, logout_user, current_user, login_required
+from sqlalchemy.orm import selectinload
 from urllib.parse import urlparse
 from datetime import datetime, timedelta
 from functools import wraps
 from app import app, db, login_manager
+from presence import activity_tracker
+from audit import action_catalog
+from audit_archive import archived_audit_logs
+from pagination import keyset_paginate, ranked_paginate
+from projections import audit_log_rows, certificate_rows, choices, company_rows, user_rows
+from search import SEARCH_RESULT_LIMIT, ranked_ids, search_certificates, search_companies
+from ingestion import CertificateImportError, import_certificates, summarize
 from models import User, Organization, UserInvite, AuditLog
 from forms import LoginForm, RegistrationForm, AcceptInviteForm, MFASetupForm, ProfileForm
 from utils import generate_mfa_secret, generate_mfa_qr_code, verify_mfa_code, log_audit_event
+from stats import (
+    certificate_status_condition, get_dashboard_stats, invalidate_dashboard_stats,
+    invalidate_certificate_caches, record_certificate_added, record_certificate_removed
+)
 
 # Role decorator functions
 def master_admin_required(f):
@@ -221,16 +233,18 @@ def accept_invite(token):
 @login_required
 def profile():
     form = ProfileForm()
+    # current_user may be a cached snapshot; changes go to the row
+    user = current_user.db_user
     
     if form.validate_on_submit():
         if form.current_password.data:
             # Check current password before allowing changes
-            if not current_user.check_password(form.current_password.data):
+            if not user.check_password(form.current_password.data):
                 flash('Senha atual incorreta', 'error')
                 return render_template('profile.html', form=form)
             
             if form.new_password.data:
-                current_user.set_password(form.new_password.data)
+                user.set_password(form.new_password.data)
                 flash('Senha atualizada com sucesso', 'success')
                 
                 log_audit_event(
@@ -241,8 +255,8 @@ def profile():
                 )
         
         # Update name
-        if current_user.name != form.name.data:
-            current_user.name = form.name.data
+        if user.name != form.name.data:
+            user.name = form.name.data
             flash('Perfil atualizado com sucesso', 'success')
         
         db.session.commit()
@@ -251,7 +265,7 @@ def profile():
         form.name.data = current_user.name
     
     # Get MFA status for display
-    mfa_enabled = current_user.mfa_enabled
+    mfa_enabled = user.mfa_enabled
     
     return render_template('profile.html', form=form, mfa_enabled=mfa_enabled)
 
@@ -259,19 +273,20 @@ def profile():
 @login_required
 def mfa_setup():
     form = MFASetupForm()
+    user = current_user.db_user
     
     # Generate secret if not already set up
-    if not current_user.mfa_secret:
-        current_user.mfa_secret = generate_mfa_secret()
+    if not user.mfa_secret:
+        user.mfa_secret = generate_mfa_secret()
         db.session.commit()
     
     # Generate QR code
-    qr_code = generate_mfa_qr_code(current_user.email, current_user.mfa_secret)
+    qr_code = generate_mfa_qr_code(user.email, user.mfa_secret)
     
     if form.validate_on_submit():
         # Verify submitted code
-        if verify_mfa_code(current_user.mfa_secret, form.code.data):
-            current_user.mfa_enabled = True
+        if verify_mfa_code(user.mfa_secret, form.code.data):
+            user.mfa_enabled = True
             db.session.commit()
             
             log_audit_event(
@@ -286,19 +301,20 @@ def mfa_setup():
         else:
             flash('Código inválido, tente novamente', 'error')
     
-    return render_template('mfa_setup.html', form=form, qr_code=qr_code, secret=current_user.mfa_secret)
+    return render_template('mfa_setup.html', form=form, qr_code=qr_code, secret=user.mfa_secret)
 
 @app.route('/mfa-disable', methods=['POST'])
 @login_required
 def mfa_disable():
     password = request.form.get('password')
+    user = current_user.db_user
     
-    if not password or not current_user.check_password(password):
+    if not password or not user.check_password(password):
         flash('Senha incorreta', 'error')
         return redirect(url_for('profile'))
     
-    current_user.mfa_enabled = False
-    current_user.mfa_secret = None
+    user.mfa_enabled = False
+    user.mfa_secret = None
     db.session.commit()
     
     log_audit_event(
@@ -319,189 +335,53 @@ def dashboard():
     
     # Get certificates expiring in the next 30 days
     today = datetime.now().date()
-    expiry_date_limit = today + timedelta(days=30)
     
     # Get organization ID (all users belong to an organization)
     org_id = current_user.organization_id
     
-    # Query certificates based on user role
-    if current_user.role in ['master_admin', 'admin']:
-        # Admins can see all certificates in their organization
-        expiring_certificates = (
-            Certificate.query
-            .join(Company)
-            .filter(
-                Company.organization_id == org_id,
-                Certificate.expiry_date <= expiry_date_limit,
-                Certificate.expiry_date >= today
-            )
-            .order_by(Certificate.expiry_date)
-            .limit(10)
-            .all()
-        )
-        
-        # Get some statistics
-        total_companies = Company.query.filter_by(organization_id=org_id).count()
-        total_certificates = (
-            Certificate.query
-            .join(Company)
-            .filter(Company.organization_id == org_id)
-            .count()
-        )
-        
-        # Get certificates by type for chart
-        ecnpj_count = (
-            Certificate.query
-            .join(Company)
-            .filter(
-                Company.organization_id == org_id,
-                Certificate.type == 'e-cnpj'
-            )
-            .count()
-        )
-        
-        ecpf_count = (
-            Certificate.query
-            .join(Company)
-            .filter(
-                Company.organization_id == org_id,
-                Certificate.type == 'e-cpf'
-            )
-            .count()
-        )
-        
-        # Get expiring certificates count for different periods
-        expiring_30d = (
-            Certificate.query
-            .join(Company)
-            .filter(
-                Company.organization_id == org_id,
-                Certificate.expiry_date <= today + timedelta(days=30),
-                Certificate.expiry_date > today
-            )
-            .count()
-        )
-        
-        expiring_60d = (
-            Certificate.query
-            .join(Company)
-            .filter(
-                Company.organization_id == org_id,
-                Certificate.expiry_date <= today + timedelta(days=60),
-                Certificate.expiry_date > today + timedelta(days=30)
-            )
-            .count()
-        )
-        
-        expiring_90d = (
-            Certificate.query
-            .join(Company)
-            .filter(
-                Company.organization_id == org_id,
-                Certificate.expiry_date <= today + timedelta(days=90),
-                Certificate.expiry_date > today + timedelta(days=60)
-            )
-            .count()
+    # Counters for cards and charts, computed in a single query and cached
+    # per organization. Read first: rebuilding the stats row commits, which
+    # would expire the certificates below and reload them one by one while
+    # the template renders
+    stats = get_dashboard_stats(org_id)
+    
+    expiring_certificates = (
+        Certificate.query
+        .options(selectinload(Certificate.company))
+        .filter(
+            Certificate.organization_id == org_id,
+            certificate_status_condition('expiring-soon', today)
         )
-        
+        .order_by(Certificate.expiry_date, Certificate.id)
+        .limit(10)
+        .all()
+    )
+    
+    # Query recent activity based on user role
+    if current_user.role in ['master_admin', 'admin']:
         # Get recent activity from audit log
         from models import AuditLog
         recent_activity = (
             AuditLog.query
-            .join(User)
-            .filter(User.organization_id == org_id)
-            .order_by(AuditLog.created_at.desc())
+            .options(selectinload(AuditLog.user))
+            .filter(AuditLog.organization_id == org_id)
+            .order_by(AuditLog.created_at.desc(), AuditLog.id.desc())
             .limit(10)
             .all()
         )
     else:
-        # Operators see a limited dashboard
-        expiring_certificates = (
-            Certificate.query
-            .join(Company)
-            .filter(
-                Company.organization_id == org_id,
-                Certificate.expiry_date <= expiry_date_limit,
-                Certificate.expiry_date >= today
-            )
-            .order_by(Certificate.expiry_date)
-            .limit(10)
-            .all()
-        )
-        
-        total_companies = Company.query.filter_by(organization_id=org_id).count()
-        total_certificates = (
-            Certificate.query
-            .join(Company)
-            .filter(Company.organization_id == org_id)
-            .count()
-        )
-        
-        ecnpj_count = (
-            Certificate.query
-            .join(Company)
-            .filter(
-                Company.organization_id == org_id,
-                Certificate.type == 'e-cnpj'
-            )
-            .count()
-        )
-        
-        ecpf_count = (
-            Certificate.query
-            .join(Company)
-            .filter(
-                Company.organization_id == org_id,
-                Certificate.type == 'e-cpf'
-            )
-            .count()
-        )
-        
-        expiring_30d = (
-            Certificate.query
-            .join(Company)
-            .filter(
-                Company.organization_id == org_id,
-                Certificate.expiry_date <= today + timedelta(days=30),
-                Certificate.expiry_date > today
-            )
-            .count()
-        )
-        
-        expiring_60d = (
-            Certificate.query
-            .join(Company)
-            .filter(
-                Company.organization_id == org_id,
-                Certificate.expiry_date <= today + timedelta(days=60),
-                Certificate.expiry_date > today + timedelta(days=30)
-            )
-            .count()
-        )
-        
-        expiring_90d = (
-            Certificate.query
-            .join(Company)
-            .filter(
-                Company.organization_id == org_id,
-                Certificate.expiry_date <= today + timedelta(days=90),
-                Certificate.expiry_date > today + timedelta(days=60)
-            )
-            .count()
-        )
-        
         recent_activity = []  # Operators don't see audit logs
     
     return render_template(
         'dashboard.html',
         expiring_certificates=expiring_certificates,
-        total_companies=total_companies,
-        total_certificates=total_certificates,
-        ecnpj_count=ecnpj_count,
-        ecpf_count=ecpf_count,
-        expiring_30d=expiring_30d,
-        expiring_60d=expiring_60d,
-        expiring_90d=expiring_90d,
+        total_companies=stats['total_companies'],
+        total_certificates=stats['total_certificates'],
+        ecnpj_count=stats['ecnpj_count'],
+        ecpf_count=stats['ecpf_count'],
+        expiring_30d=stats['expiring_30d'],
+        expiring_60d=stats['expiring_60d'],
+        expiring_90d=stats['expiring_90d'],
         recent_activity=recent_activity
     )
 
@@ -515,7 +395,7 @@ def companies():
     org_id = current_user.organization_id
     
     # Get groups for filtering
-    groups = Group.query.filter_by(organization_id=org_id).all()
+    groups = choices(Group.query.filter_by(organization_id=org_id), Group).all()
     selected_group_id = request.args.get('group_id', type=int)
     
     # Base query
@@ -525,13 +405,15 @@ def companies():
     if selected_group_id:
         query = query.filter_by(group_id=selected_group_id)
     
-    # Search filter
+    # Search filter (name, trade name or CNPJ prefix), best matches first
     search = request.args.get('search', '')
     if search:
-        query = query.filter(Company.name.ilike(f'%{search}%') | Company.cnpj.ilike(f'%{search}%'))
+        query = search_companies(query, search)
+    else:
+        query = query.order_by(Company.name)
     
-    # Get companies
-    companies = query.order_by(Company.name).all()
+    # Get companies, only the columns the cards show
+    companies = company_rows(query).all()
     
     return render_template(
         'companies/index.html',
@@ -563,6 +445,7 @@ def create_company():
         
         try:
             db.session.commit()
+            invalidate_dashboard_stats(company.organization_id)
             
             log_audit_event(
                 current_user.id,
@@ -639,6 +522,7 @@ def delete_company(company_id):
         company_name = company.name
         db.session.delete(company)
         db.session.commit()
+        invalidate_dashboard_stats(current_user.organization_id)
         
         log_audit_event(
             current_user.id,
@@ -781,11 +665,7 @@ def certificates():
     from models import Certificate, Company
     
     # Base query
-    query = (
-        Certificate.query
-        .join(Company)
-        .filter(Company.organization_id == current_user.organization_id)
-    )
+    query = Certificate.query.filter(Certificate.organization_id == current_user.organization_id)
     
     # Apply filters
     company_id = request.args.get('company_id', type=int)
@@ -798,30 +678,53 @@ def certificates():
     
     status = request.args.get('status')
     today = datetime.now().date()
-    if status == 'valid':
-        query = query.filter(Certificate.expiry_date > today)
-    elif status == 'expired':
-        query = query.filter(Certificate.expiry_date <= today)
-    elif status == 'expiring-soon':
-        query = query.filter(
-            Certificate.expiry_date <= today + timedelta(days=30),
-            Certificate.expiry_date > today
-        )
+    status_condition = certificate_status_condition(status, today)
+    if status_condition is not None:
+        query = query.filter(status_condition)
     
-    # Search filter
     search = request.args.get('search', '')
-    if search:
-        query = query.filter(Certificate.name.ilike(f'%{search}%'))
     
-    # Get certificates
-    certificates = query.order_by(Certificate.expiry_date).all()
+    # Get one page of certificates, keyed on (expiry_date, id)
+    per_page = min(max(request.args.get('per_page', 48, type=int), 1), 200)
+    filters = {
+        'company_id': company_id,
+        'type': type_filter,
+        'status': status,
+        'search': search,
+        'per_page': per_page,
+    }
+    if search:
+        # Search results are ordered by relevance instead
+        ids = ranked_ids(search_certificates(query, search), Certificate.id)
+        page = ranked_paginate(
+            certificate_rows(query),
+            Certificate.id,
+            ids,
+            cursor=request.args.get('cursor'),
+            per_page=per_page,
+            filters=filters,
+            truncated=len(ids) >= SEARCH_RESULT_LIMIT
+        )
+    else:
+        page = keyset_paginate(
+            certificate_rows(query),
+            [Certificate.expiry_date, Certificate.id],
+            cursor=request.args.get('cursor'),
+            per_page=per_page,
+            filters=filters,
+            with_total=request.args.get('count', '1') != '0'
+        )
     
     # Get companies for filter dropdown
-    companies = Company.query.filter_by(organization_id=current_user.organization_id).order_by(Company.name).all()
+    companies = choices(
+        Company.query.filter_by(organization_id=current_user.organization_id).order_by(Company.name), Company
+    ).all()
     
     return render_template(
         'certificates/index.html',
-        certificates=certificates,
+        certificates=page.items,
+        page=page,
+        page_args={k: v for k, v in filters.items() if v},
         companies=companies,
         company_id=company_id,
         type_filter=type_filter,
@@ -838,47 +741,88 @@ def upload_certificate():
     form = CertificateUploadForm(organization_id=current_user.organization_id)
     
     if form.validate_on_submit():
-        from models import Certificate
+        from models import Certificate, CertificateBlob
         from utils import encrypt_certificate_password
+        from certificate_files import parse_certificate_file
+        from blobs import (
+            cached_metadata, discard_new_blobs, find_duplicate, remember_metadata, spool_upload, store_upload
+        )
+        from storage import StorageError
+        from key_ring import KeyRingError
         import os
         
         # Get the certificate file
         cert_file = form.certificate_file.data
+        extension = os.path.splitext(cert_file.filename)[1].lower()
         
-        # Generate a secure filename
-        import uuid
-        filename = f"{uuid.uuid4()}.{cert_file.filename.split('.')[-1]}"
-        
-        # Create certificates directory if it doesn't exist
-        os.makedirs('certificates', exist_ok=True)
-        
-        # Save the file temporarily
-        file_path = os.path.join('certificates', filename)
-        cert_file.save(file_path)
+        # Hash the file while spooling it to disk; duplicates and invalid
+        # files are turned down before anything reaches the storage backend
+        with spool_upload(cert_file.stream) as upload:
+            duplicate = find_duplicate(current_user.organization_id, upload.fingerprint)
+            if duplicate is not None:
+                flash(f'Este arquivo já está cadastrado como "{duplicate.name}".', 'warning')
+                return redirect(url_for('view_certificate', certificate_id=duplicate.id))
+            
+            # Validity comes from the certificate itself; contents already
+            # opened with this password reuse the cached metadata
+            blob = db.session.get(CertificateBlob, upload.fingerprint)
+            metadata = cached_metadata(blob, form.password.data)
+            if metadata is None:
+                metadata = parse_certificate_file(cert_file.filename, upload.read(), form.password.data)
+            if not metadata['ok']:
+                form.certificate_file.errors.append(metadata['error'])
+                return render_template('certificates/upload.html', form=form)
+            
+            if metadata['not_after'] < datetime.now().date():
+                form.certificate_file.errors.append('O certificado está vencido.')
+                return render_template('certificates/upload.html', form=form)
+            
+            # Store the file by content (SHA-256) in the configured backend;
+            # identical files share one blob
+            try:
+                blob, created = store_upload(upload, extension)
+            except StorageError as e:
+                db.session.rollback()
+                app.logger.error(f"Certificate storage error: {str(e)}")
+                flash('Não foi possível armazenar o arquivo do certificado. Por favor, tente novamente.', 'error')
+                return render_template('certificates/upload.html', form=form)
+        new_blobs = [(blob.fingerprint, blob.file_name, blob.s3_key)] if created else []
+        remember_metadata(blob, metadata, form.password.data)
         
-        # Encrypt the certificate password
-        encrypted_password, iv = encrypt_certificate_password(form.password.data)
+        # Encrypt the certificate password with the active key
+        try:
+            encrypted_password, iv, key_version = encrypt_certificate_password(form.password.data)
+        except KeyRingError as e:
+            db.session.rollback()
+            discard_new_blobs(new_blobs)
+            app.logger.error(f"Certificate password encryption error: {str(e)}")
+            flash('Ocorreu um erro ao enviar o certificado. Por favor, tente novamente.', 'error')
+            return render_template('certificates/upload.html', form=form)
         
         # Create certificate record
         certificate = Certificate(
             name=form.name.data,
             type=form.type.data,
-            file_name=filename,
+            file_name=blob.file_name,
+            fingerprint=blob.fingerprint,
+            s3_key=blob.s3_key,
             encrypted_password=encrypted_password,
             iv=iv,
+            key_version=key_version,
             company_id=form.company_id.data,
-            issue_date=form.issue_date.data,
-            expiry_date=form.expiry_date.data,
+            issue_date=metadata['not_before'],
+            expiry_date=metadata['not_after'],
             created_by=current_user.id
         )
         
         db.session.add(certificate)
         
         try:
+            # Keep the organization stats read model in the same transaction
+            db.session.flush()
+            record_certificate_added(certificate, current_user.organization_id)
             db.session.commit()
-            
-            # In production, this would upload to AWS S3 and delete the local file
-            # certificate.s3_key = 'path/to/s3/file'
+            invalidate_certificate_caches(current_user.organization_id)
             
             log_audit_event(
                 current_user.id,
@@ -894,12 +838,52 @@ def upload_certificate():
             app.logger.error(f"Certificate upload error: {str(e)}")
             flash('Ocorreu um erro ao enviar o certificado. Por favor, tente novamente.', 'error')
             
-            # Remove the file if there was an error
-            if os.path.exists(file_path):
-                os.remove(file_path)
+            # Remove the file if nothing else uses it
+            discard_new_blobs(new_blobs)
     
     return render_template('certificates/upload.html', form=form)
 
+@app.route('/certificates/import', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def import_certificates_view():
+    from forms import CertificateImportForm
+    
+    form = CertificateImportForm()
+    report = None
+    
+    if form.validate_on_submit():
+        manifest = form.manifest.data.read() if form.manifest.data else None
+        try:
+            # The upload is spooled to disk by Werkzeug past a few hundred
+            # KB; the archive is read from there, member by member
+            report = import_certificates(
+                form.archive.data.stream,
+                current_user.organization_id,
+                current_user.id,
+                manifest=manifest,
+                default_password=form.password.data or None
+            )
+        except CertificateImportError as e:
+            flash(str(e), 'error')
+        else:
+            imported = summarize(report).get('imported', 0)
+            if imported:
+                log_audit_event(
+                    current_user.id,
+                    'certificates_imported',
+                    f"Importação em lote: {imported} de {len(report)} certificado(s)",
+                    request.remote_addr
+                )
+            flash(f'{imported} de {len(report)} certificado(s) importado(s).', 'success' if imported else 'warning')
+    
+    return render_template(
+        'certificates/import.html',
+        form=form,
+        report=report,
+        counts=summarize(report) if report else {}
+    )
+
 @app.route('/certificates/<int:certificate_id>/view')
 @login_required
 def view_certificate(certificate_id):
@@ -908,10 +892,9 @@ def view_certificate(certificate_id):
     # Get the certificate, ensuring it belongs to the user's organization
     certificate = (
         Certificate.query
-        .join(Company)
         .filter(
             Certificate.id == certificate_id,
-            Company.organization_id == current_user.organization_id
+            Certificate.organization_id == current_user.organization_id
         )
         .first_or_404()
     )
@@ -926,6 +909,41 @@ def view_certificate(certificate_id):
     
     return render_template('certificates/view.html', certificate=certificate)
 
+@app.route('/api/certificates/<int:certificate_id>/download')
+@login_required
+def download_certificate(certificate_id):
+    from models import Certificate
+    from blobs import send_certificate_file
+    from storage import StorageError
+
+    # Get the certificate, ensuring it belongs to the user's organization
+    certificate = (
+        Certificate.query
+        .filter(
+            Certificate.id == certificate_id,
+            Certificate.organization_id == current_user.organization_id
+        )
+        .first_or_404()
+    )
+
+    try:
+        response = send_certificate_file(certificate)
+    except StorageError as e:
+        app.logger.error(f"Certificate download error: {str(e)}")
+        return jsonify({'error': 'Arquivo do certificado indisponível.'}), 503
+
+    # Revalidations and later parts of a ranged download are not new downloads
+    first_part = request.range is None or request.range.ranges[0][0] == 0
+    if response.status_code != 304 and first_part:
+        log_audit_event(
+            current_user.id,
+            'certificate_downloaded',
+            f"Certificado baixado: {certificate.name}",
+            request.remote_addr
+        )
+
+    return response
+
 @app.route('/certificates/<int:certificate_id>/delete', methods=['POST'])
 @login_required
 def delete_certificate(certificate_id):
@@ -934,26 +952,27 @@ def delete_certificate(certificate_id):
     # Get the certificate, ensuring it belongs to the user's organization
     certificate = (
         Certificate.query
-        .join(Company)
         .filter(
             Certificate.id == certificate_id,
-            Company.organization_id == current_user.organization_id
+            Certificate.organization_id == current_user.organization_id
         )
         .first_or_404()
     )
     
     try:
-        cert_name = certificate.name
+        from blobs import release_blob, remove_file
         
-        # Delete the certificate file
-        # In production, this would delete from S3
-        import os
-        file_path = os.path.join('certificates', certificate.file_name)
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        cert_name = certificate.name
         
         db.session.delete(certificate)
+        db.session.flush()
+        record_certificate_removed(certificate, current_user.organization_id)
+        
+        # The file may be shared with other certificates of the same content
+        unused_file, unused_s3_key = release_blob(certificate)
         db.session.commit()
+        remove_file(unused_file, unused_s3_key)
+        invalidate_certificate_caches(current_user.organization_id)
         
         log_audit_event(
             current_user.id,
@@ -978,7 +997,9 @@ def users():
     from models import User
     
     # Get users for this organization
-    users = User.query.filter_by(organization_id=current_user.organization_id).order_by(User.name).all()
+    users = user_rows(
+        User.query.filter_by(organization_id=current_user.organization_id).order_by(User.name)
+    ).all()
     
     return render_template('users/index.html', users=users)
 
@@ -1019,10 +1040,12 @@ def invite_user():
             existing_invite.token = UserInvite.generate_token()
             
             try:
+                # Queue the invitation email in the same transaction; it is
+                # delivered by the mail outbox worker
+                queued = send_invitation_email(existing_invite)
                 db.session.commit()
                 
-                # Send the invitation email
-                if send_invitation_email(existing_invite):
+                if queued:
                     flash('Convite reenviado com sucesso!', 'success')
                 else:
                     flash('Convite criado, mas houve um erro ao enviar o email.', 'warning')
@@ -1053,10 +1076,12 @@ def invite_user():
             db.session.add(invite)
             
             try:
+                # Queue the invitation email in the same transaction; it is
+                # delivered by the mail outbox worker
+                queued = send_invitation_email(invite)
                 db.session.commit()
                 
-                # Send the invitation email
-                if send_invitation_email(invite):
+                if queued:
                     flash('Convite enviado com sucesso!', 'success')
                 else:
                     flash('Convite criado, mas houve um erro ao enviar o email.', 'warning')
@@ -1099,6 +1124,7 @@ def delete_user(user_id):
         user_email = user.email
         db.session.delete(user)
         db.session.commit()
+        activity_tracker.forget(user_id)
         
         log_audit_event(
             current_user.id,
@@ -1127,11 +1153,7 @@ def audit_logs():
     action = request.args.get('action')
     
     # Base query - only show logs for users in same organization
-    query = (
-        AuditLog.query
-        .join(User)
-        .filter(User.organization_id == current_user.organization_id)
-    )
+    query = AuditLog.query.filter(AuditLog.organization_id == current_user.organization_id)
     
     if user_id:
         query = query.filter(AuditLog.user_id == user_id)
@@ -1142,30 +1164,47 @@ def audit_logs():
     # Date range filter
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
+    start = end = None
     
     if start_date:
         try:
             start = datetime.strptime(start_date, '%Y-%m-%d')
             query = query.filter(AuditLog.created_at >= start)
         except ValueError:
-            pass
+            start = None
     
     if end_date:
         try:
             end = datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)  # Include the end date
             query = query.filter(AuditLog.created_at < end)
         except ValueError:
-            pass
-    
-    # Get logs
-    logs = query.order_by(AuditLog.created_at.desc()).paginate(page=request.args.get('page', 1, type=int), per_page=50)
+            end = None
+    
+    # Get one page of logs, newest first, keyed on (created_at, id); older
+    # pages continue into the archived months
+    filters = {
+        'user_id': user_id,
+        'action': action,
+        'start_date': start_date,
+        'end_date': end_date,
+    }
+    logs = keyset_paginate(
+        audit_log_rows(query),
+        [AuditLog.created_at, AuditLog.id],
+        cursor=request.args.get('cursor'),
+        per_page=50,
+        descending=True,
+        filters=filters,
+        tail=archived_audit_logs(current_user.organization_id, user_id, action, start, end)
+    )
     
     # Get users for filter dropdown
-    users = User.query.filter_by(organization_id=current_user.organization_id).order_by(User.name).all()
+    users = choices(
+        User.query.filter_by(organization_id=current_user.organization_id).order_by(User.name), User
+    ).all()
     
-    # Get unique actions for filter dropdown
-    actions = db.session.query(AuditLog.action).distinct().all()
-    actions = [a[0] for a in actions]
+    # Get the organization's actions for filter dropdown
+    actions = action_catalog.get(current_user.organization_id)
     
     return render_template(
         'audit/index.html',
@@ -1189,63 +1228,28 @@ def reports():
 @login_required
 @admin_required
 def export_certificates():
-    from models import Certificate, Company
-    import csv
-    from io import StringIO
+    from exports import EXPORT_FORMATS, iter_certificate_rows
     
-    # Get certificates for this organization
-    certificates = (
-        Certificate.query
-        .join(Company)
-        .filter(Company.organization_id == current_user.organization_id)
-        .order_by(Certificate.expiry_date)
-        .all()
-    )
-    
-    # Create CSV file
-    output = StringIO()
-    writer = csv.writer(output)
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        export_format = 'csv'
+    serializer, mimetype, extension = EXPORT_FORMATS[export_format]
     
-    # Write header
-    writer.writerow([
-        'Nome', 'Tipo', 'Empresa', 'CNPJ', 'Data de Emissão', 
-        'Data de Validade', 'Dias Restantes', 'Status'
-    ])
-    
-    # Write data
-    today = datetime.now().date()
-    for cert in certificates:
-        days_left = (cert.expiry_date - today).days
-        if days_left < 0:
-            status = 'Expirado'
-        elif days_left <= 30:
-            status = 'Expirando em breve'
-        else:
-            status = 'Válido'
-        
-        writer.writerow([
-            cert.name,
-            cert.type,
-            cert.company.name,
-            cert.company.cnpj,
-            cert.issue_date.strftime('%d/%m/%Y'),
-            cert.expiry_date.strftime('%d/%m/%Y'),
-            days_left if days_left >= 0 else 0,
-            status
-        ])
-    
-    # Create response
-    output.seek(0)
+    # Rows are streamed from the database straight into the response
+    rows = iter_certificate_rows(
+        current_user.organization_id,
+        status=request.args.get('status')
+    )
     
     log_audit_event(
         current_user.id,
         'report_generated',
-        f"Relatório de certificados exportado",
+        f"Relatório de certificados exportado ({export_format})",
         request.remote_addr
     )
     
     return Response(
-        output,
-        mimetype='text/csv',
-        headers={'Content-Disposition': 'attachment;filename=certificados.csv'}
+        stream_with_context(serializer(rows)),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment;filename=certificados.{extension}'}
     )
@@ -0,0 +1,65 @@
+import atexit
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def pid_alive(pid):
+    """Whether a process with this id exists (possibly owned by another user)"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class PeriodicFlusher:
+    """Run a flush callable in a daemon thread every `interval` seconds
+
+    The thread is started lazily on the first call to `ensure_started()` and
+    restarted automatically in forked processes (e.g. gunicorn workers), so it
+    is safe to create at import time. `wake()` asks for an immediate flush and,
+    unless `flush_on_exit` is False, the callable runs one last time when the
+    interpreter exits.
+    """
+
+    def __init__(self, name, flush, interval, flush_on_exit=True):
+        self.name = name
+        self.flush = flush
+        self.interval = interval
+        self._thread = None
+        self._pid = None
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        if flush_on_exit:
+            atexit.register(self._run_flush)
+
+    def ensure_started(self):
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._wakeup = threading.Event()
+            self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def _loop(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self._run_flush()
+
+    def _run_flush(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception(f"{self.name}: flush failed")
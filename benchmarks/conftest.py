@@ -0,0 +1,67 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _root)
+sys.path.insert(0, os.path.join(_root, 'tests'))
+
+import factories  # noqa: E402
+
+# The application is configured from the environment when app.py is imported.
+# BENCHMARK_DATABASE_URL points the suite at another database (e.g. a local
+# PostgreSQL); it must be a disposable one, the suite fills it with data.
+os.environ.update(factories.environment(tempfile.mkdtemp(prefix='oguardiao-benchmarks-')))
+if os.environ.get('BENCHMARK_DATABASE_URL'):
+    os.environ['DATABASE_URL'] = os.environ['BENCHMARK_DATABASE_URL']
+
+from app import app as flask_app  # noqa: E402
+
+# Certificates of the organization measured at each scale; companies, users
+# and audit logs grow with it
+SCALES = [int(scale) for scale in os.environ.get('BENCHMARK_SCALES', '100,1000,10000').split(',')]
+USERS = 10
+GROUPS = 5
+AUDIT_LOGS_PER_CERTIFICATE = 3
+
+
+def seed_organization(scale):
+    return factories.seed_organization(
+        f'Organização {scale}', scale, users=USERS, groups=GROUPS,
+        audit_logs_per_certificate=AUDIT_LOGS_PER_CERTIFICATE
+    )
+
+
+@pytest.fixture(scope='session')
+def app():
+    return factories.prepare_app(flask_app)
+
+
+@pytest.fixture(scope='session')
+def admins(app):
+    """Master admin id of the organization seeded for each scale"""
+    with app.app_context():
+        return {scale: seed_organization(scale) for scale in SCALES}
+
+
+@pytest.fixture(scope='session')
+def writer_id(app):
+    """User of an organization of its own, for the benchmarks that write
+    audit logs without growing the measured organizations"""
+    with app.app_context():
+        return seed_organization(0)
+
+
+@pytest.fixture(params=SCALES, ids=lambda scale: f'{scale}-certificates')
+def scale(request):
+    return request.param
+
+
+@pytest.fixture
+def client(app, admins, scale, benchmark):
+    """Test client logged in as the master admin of the current scale"""
+    benchmark.extra_info['scale'] = scale
+    benchmark.extra_info['database'] = app.config['SQLALCHEMY_DATABASE_URI'].split(':')[0]
+    return factories.login(app, admins[scale])
@@ -0,0 +1,42 @@
+import pytest
+
+from audit import audit_sink
+from utils import (
+    decrypt_certificate_password, encrypt_certificate_password, generate_mfa_qr_code, log_audit_event
+)
+
+
+@pytest.fixture
+def app_context(app):
+    with app.app_context():
+        yield
+
+
+@pytest.mark.benchmark(group='log_audit_event')
+def test_log_audit_event_buffered(benchmark, app_context, writer_id):
+    benchmark(log_audit_event, writer_id, 'benchmark', 'Evento de benchmark', '127.0.0.1')
+    audit_sink.flush()
+
+
+@pytest.mark.benchmark(group='log_audit_event')
+def test_log_audit_event_sync(benchmark, app_context, writer_id, monkeypatch):
+    monkeypatch.setattr(audit_sink, 'sync', True)
+    benchmark(log_audit_event, writer_id, 'benchmark', 'Evento de benchmark', '127.0.0.1')
+
+
+@pytest.mark.benchmark(group='certificate_password')
+def test_encrypt_certificate_password(benchmark, app_context):
+    benchmark(encrypt_certificate_password, 'senha-do-certificado')
+
+
+@pytest.mark.benchmark(group='certificate_password')
+def test_decrypt_certificate_password(benchmark, app_context):
+    encrypted, iv, key_version = encrypt_certificate_password('senha-do-certificado')
+    assert benchmark(decrypt_certificate_password, encrypted, iv, key_version) == 'senha-do-certificado'
+
+
+@pytest.mark.benchmark(group='mfa')
+def test_generate_mfa_qr_code(benchmark):
+    # qrcode renders PNGs with Pillow
+    pytest.importorskip('PIL')
+    benchmark(generate_mfa_qr_code, 'usuario@example.com', 'JBSWY3DPEHPK3PXP')
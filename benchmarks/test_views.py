@@ -0,0 +1,44 @@
+import pytest
+
+# Each benchmark is one full request through the test client: routing,
+# session, the view's queries and template rendering
+
+
+def _get(client, path):
+    def request():
+        response = client.get(path)
+        # Streamed responses run their queries while being read
+        response.get_data()
+        assert response.status_code == 200
+    return request
+
+
+@pytest.mark.benchmark(group='dashboard')
+def test_dashboard(benchmark, client):
+    benchmark(_get(client, '/dashboard'))
+
+
+@pytest.mark.benchmark(group='certificates')
+def test_certificates(benchmark, client):
+    benchmark(_get(client, '/certificates'))
+
+
+@pytest.mark.benchmark(group='certificates')
+def test_certificates_search(benchmark, client):
+    benchmark(_get(client, '/certificates?search=Certificado 0001'))
+
+
+@pytest.mark.benchmark(group='companies')
+def test_companies(benchmark, client):
+    benchmark(_get(client, '/companies'))
+
+
+@pytest.mark.benchmark(group='audit_logs')
+def test_audit_logs(benchmark, client):
+    benchmark(_get(client, '/audit-logs'))
+
+
+@pytest.mark.benchmark(group='export_certificates')
+@pytest.mark.parametrize('export_format', ['csv', 'xlsx'])
+def test_export_certificates(benchmark, client, export_format):
+    benchmark(_get(client, f'/reports/export-certificates?format={export_format}'))
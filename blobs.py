@@ -0,0 +1,316 @@
+import hashlib
+import hmac
+import io
+import json
+import logging
+import os
+import tempfile
+from contextlib import contextmanager
+from datetime import date
+
+from flask import abort, current_app, redirect, request
+from sqlalchemy.exc import IntegrityError
+from werkzeug.utils import secure_filename, send_file
+
+from app import db
+from models import Certificate, CertificateBlob
+from storage import StorageError, get_storage, save_many, storage_for
+
+logger = logging.getLogger(__name__)
+
+# Bytes read per step while hashing an upload
+CHUNK_SIZE = 64 * 1024
+
+# Certificates fingerprinted per commit by `flask certificates fingerprint`
+BACKFILL_BATCH = 500
+
+# Passwords remembered per blob as opening its file (keyed digests)
+PASSWORD_DIGESTS_KEPT = 16
+
+_DATE_FIELDS = ('not_before', 'not_after')
+
+
+def fingerprint_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _add_blob(fingerprint, file_name, size, s3_key=None):
+    blob = CertificateBlob(fingerprint=fingerprint, file_name=file_name, size=size, s3_key=s3_key)
+    try:
+        with db.session.begin_nested():
+            db.session.add(blob)
+    except IntegrityError:
+        # The same content was stored concurrently
+        blob = db.session.get(CertificateBlob, fingerprint)
+    return blob
+
+
+class SpooledUpload:
+    """An uploaded file spooled to a temporary file, with its SHA-256 and size"""
+
+    def __init__(self, file, fingerprint, size):
+        self.file = file
+        self.fingerprint = fingerprint
+        self.size = size
+
+    def read(self):
+        self.file.seek(0)
+        return self.file.read()
+
+
+@contextmanager
+def spool_upload(stream):
+    """Hash an uploaded stream while spooling it to a temporary file
+
+    The stream is copied in chunks, so the file is never held in memory
+    unless it is read for parsing. Yields a `SpooledUpload`; the file is
+    removed on exit.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.TemporaryFile() as spool:
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            spool.write(chunk)
+            size += len(chunk)
+        yield SpooledUpload(spool, digest.hexdigest(), size)
+
+
+def store_upload(upload, extension):
+    """Store a spooled upload, reusing the blob of identical content
+
+    Only new content is sent to the storage backend. Returns (blob, created);
+    the blob row is added to the current transaction.
+    """
+    blob = db.session.get(CertificateBlob, upload.fingerprint)
+    if blob is not None:
+        return blob, False
+
+    file_name = f'{upload.fingerprint}{extension}'
+    upload.file.seek(0)
+    s3_key = get_storage().save(file_name, upload.file)
+    return _add_blob(upload.fingerprint, file_name, upload.size, s3_key), True
+
+
+def store_many(files):
+    """Store file contents already in memory, uploading new ones concurrently
+
+    Takes (data, extension, fingerprint) triples with distinct fingerprints
+    and returns (blob, created) pairs in the same order.
+    """
+    files = list(files)
+    fingerprints = [fingerprint for _, _, fingerprint in files]
+    blobs = {
+        blob.fingerprint: blob
+        for blob in CertificateBlob.query.filter(CertificateBlob.fingerprint.in_(fingerprints))
+    } if fingerprints else {}
+
+    new = [(data, f'{fingerprint}{extension}') for data, extension, fingerprint in files if fingerprint not in blobs]
+    s3_keys = iter(save_many(get_storage(), [(file_name, io.BytesIO(data)) for data, file_name in new]))
+
+    stored = []
+    for data, extension, fingerprint in files:
+        if fingerprint in blobs:
+            stored.append((blobs[fingerprint], False))
+        else:
+            blob = _add_blob(fingerprint, f'{fingerprint}{extension}', len(data), next(s3_keys))
+            stored.append((blob, True))
+    return stored
+
+
+def discard_new_blobs(created):
+    """Remove the files of blobs whose rows were rolled back
+
+    Call after a rollback with (fingerprint, file name, S3 key) of the blobs
+    created in the failed transaction; files of rows committed meanwhile are
+    kept.
+    """
+    for fingerprint, file_name, s3_key in created:
+        if db.session.get(CertificateBlob, fingerprint) is None:
+            remove_file(file_name, s3_key)
+
+
+def read_blob(blob):
+    handle = storage_for(blob.s3_key).open(blob.s3_key or blob.file_name)
+    try:
+        return handle.read()
+    finally:
+        handle.close()
+
+
+def download_name(certificate):
+    """ASCII file name offered when downloading a certificate"""
+    extension = os.path.splitext(certificate.file_name)[1].lower()
+    return f'{secure_filename(certificate.name) or "certificado"}{extension}'
+
+
+def send_certificate_file(certificate):
+    """Response downloading a certificate's file
+
+    Files in S3 are downloaded from a presigned URL. Local files are served
+    with ETag (the content hash), Last-Modified and range support, or handed
+    to the front proxy with X-Accel-Redirect/X-Sendfile when
+    CERTIFICATE_DOWNLOAD_OFFLOAD is set, so workers don't stream the bytes.
+    """
+    storage = storage_for(certificate.s3_key)
+    name = download_name(certificate)
+    if certificate.s3_key:
+        ttl = current_app.config['STORAGE_PRESIGNED_URL_TTL']
+        return redirect(storage.presigned_url(certificate.s3_key, name, ttl))
+
+    path = os.path.abspath(storage.path(certificate.file_name))
+    if not os.path.isfile(path):
+        abort(404)
+
+    offload = current_app.config['CERTIFICATE_DOWNLOAD_OFFLOAD']
+    response = send_file(
+        path,
+        request.environ,
+        as_attachment=True,
+        download_name=name,
+        etag=certificate.fingerprint or True,
+        # The proxy answers range requests itself when the file is offloaded
+        conditional=not offload,
+        use_x_sendfile=bool(offload),
+    )
+    response.cache_control.private = True
+    if offload:
+        response.make_conditional(request.environ)
+        if response.status_code == 304:
+            response.headers.pop('X-Sendfile', None)
+        elif offload == 'x-accel-redirect':
+            response.headers.pop('X-Sendfile')
+            response.headers['X-Accel-Redirect'] = (
+                current_app.config['CERTIFICATE_DOWNLOAD_ACCEL_PREFIX'] + certificate.file_name
+            )
+            response.content_length = 0
+    return response
+
+
+def find_duplicate(organization_id, fingerprint):
+    """An organization's certificate with the given content, if any"""
+    return Certificate.query.filter(
+        Certificate.organization_id == organization_id,
+        Certificate.fingerprint == fingerprint
+    ).first()
+
+
+def password_digest(fingerprint, password):
+    """Digest of a password for a file's contents, keyed with SECRET_KEY"""
+    message = f'{fingerprint}:{password or ""}'.encode('utf-8')
+    return hmac.new(current_app.config['SECRET_KEY'].encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+
+def cached_metadata(blob, password=None):
+    """Parsed metadata of a blob, or None if it was never parsed with this password
+
+    Metadata is shared by everyone who uploads the same bytes; the password
+    is not, so the cache only answers for passwords that opened the file
+    before. Any other password goes through the parser.
+    """
+    if blob is None or not blob.parsed_metadata:
+        return None
+    metadata = json.loads(blob.parsed_metadata)
+    if password_digest(blob.fingerprint, password) not in metadata.pop('password_digests', ()):
+        return None
+    for field in _DATE_FIELDS:
+        if metadata.get(field):
+            metadata[field] = date.fromisoformat(metadata[field])
+    return metadata
+
+
+def remember_metadata(blob, parsed, password=None):
+    """Cache a successful parse of the blob's file with the password that opened it"""
+    if not parsed.get('ok'):
+        return
+    digests = json.loads(blob.parsed_metadata).get('password_digests', []) if blob.parsed_metadata else []
+    digest = password_digest(blob.fingerprint, password)
+    if digest in digests:
+        return
+    metadata = {key: value for key, value in parsed.items() if key != 'file_name'}
+    for field in _DATE_FIELDS:
+        if metadata.get(field):
+            metadata[field] = metadata[field].isoformat()
+    metadata['password_digests'] = [digest] + digests[:PASSWORD_DIGESTS_KEPT - 1]
+    blob.parsed_metadata = json.dumps(metadata, ensure_ascii=False)
+
+
+def release_blob(certificate):
+    """Drop the blob of a deleted certificate when nothing else uses it
+
+    Call after the certificate's deletion was flushed. Returns the (file
+    name, S3 key) to pass to `remove_file` once the transaction commits;
+    both are None when the file is still in use.
+    """
+    if certificate.fingerprint is None:
+        return certificate.file_name, certificate.s3_key
+
+    in_use = db.session.query(
+        Certificate.query.filter(Certificate.fingerprint == certificate.fingerprint).exists()
+    ).scalar()
+    if in_use:
+        return None, None
+
+    blob = db.session.get(CertificateBlob, certificate.fingerprint)
+    if blob is None:
+        return None, None
+    location = blob.file_name, blob.s3_key
+    db.session.delete(blob)
+    return location
+
+
+def remove_file(file_name, s3_key=None):
+    if not file_name:
+        return
+    try:
+        storage_for(s3_key).delete(s3_key or file_name)
+    except StorageError as e:
+        logger.warning(f"Could not remove certificate file {s3_key or file_name}: {str(e)}")
+
+
+def fingerprint_existing_certificates():
+    """Hash certificates stored before fingerprinting and share duplicates
+
+    Returns (certificates fingerprinted, duplicate files removed).
+    """
+    done = removed = 0
+    missing = set()
+    while True:
+        query = Certificate.query.filter(Certificate.fingerprint.is_(None))
+        if missing:
+            query = query.filter(Certificate.id.notin_(missing))
+        certificates = query.order_by(Certificate.id).limit(BACKFILL_BATCH).all()
+        if not certificates:
+            return done, removed
+
+        # Certificates from before fingerprinting are always stored locally
+        local = storage_for(None)
+        redundant = []
+        for certificate in certificates:
+            path = local.path(certificate.file_name)
+            try:
+                with open(path, 'rb') as handle:
+                    digest = hashlib.sha256()
+                    for chunk in iter(lambda: handle.read(CHUNK_SIZE), b''):
+                        digest.update(chunk)
+            except OSError:
+                logger.warning(f"Certificate file missing: {certificate.file_name}")
+                missing.add(certificate.id)
+                continue
+
+            fingerprint = digest.hexdigest()
+            blob = db.session.get(CertificateBlob, fingerprint)
+            if blob is None:
+                # Adopt the existing file as the blob
+                blob = _add_blob(fingerprint, certificate.file_name, os.path.getsize(path))
+            elif blob.file_name != certificate.file_name:
+                redundant.append(certificate.file_name)
+            certificate.fingerprint = fingerprint
+            certificate.file_name = blob.file_name
+            done += 1
+
+        db.session.commit()
+        for file_name in redundant:
+            remove_file(file_name)
+            removed += 1
+
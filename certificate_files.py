@@ -0,0 +1,110 @@
+import re
+
+from cryptography import x509
+from cryptography.hazmat.primitives.serialization import pkcs12
+from cryptography.x509.oid import NameOID
+
+# Parsing of certificate files; nothing here touches the application or the
+# database, so it can run in worker processes
+
+PKCS12_EXTENSIONS = ('.pfx', '.p12')
+X509_EXTENSIONS = ('.cer', '.crt', '.pem')
+CERTIFICATE_EXTENSIONS = PKCS12_EXTENSIONS + X509_EXTENSIONS
+
+# ICP-Brasil subject alternative name fields (DOC-ICP-04)
+OID_PF_DATA = x509.ObjectIdentifier('2.16.76.1.3.1')  # birth date + CPF + ...
+OID_PJ_CNPJ = x509.ObjectIdentifier('2.16.76.1.3.3')
+
+
+class CertificateFileError(Exception):
+    """A certificate file could not be read"""
+
+
+def _load(file_name, data, password):
+    lower = file_name.lower()
+    if lower.endswith(PKCS12_EXTENSIONS):
+        try:
+            _, certificate, _ = pkcs12.load_key_and_certificates(
+                data, password.encode('utf-8') if password else None
+            )
+        except ValueError:
+            raise CertificateFileError('Senha incorreta ou arquivo PKCS#12 inválido.')
+        if certificate is None:
+            raise CertificateFileError('O arquivo PKCS#12 não contém um certificado.')
+        return certificate
+
+    try:
+        if data.lstrip().startswith(b'-----BEGIN'):
+            return x509.load_pem_x509_certificate(data)
+        return x509.load_der_x509_certificate(data)
+    except ValueError:
+        raise CertificateFileError('Arquivo de certificado X.509 inválido.')
+
+
+def _der_payload(value):
+    """Contents of a DER string, unwrapping explicit context tags"""
+    while len(value) >= 2:
+        tag, length = value[0], value[1]
+        header = 2 if length < 0x80 else 2 + (length & 0x7f)
+        value = value[header:]
+        if tag & 0xe0 != 0xa0:  # not an explicit [n] wrapper
+            break
+    return value
+
+
+def _other_name_digits(certificate, oid):
+    try:
+        names = certificate.extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+    except x509.ExtensionNotFound:
+        return None
+    for name in names.get_values_for_type(x509.OtherName):
+        if name.type_id == oid:
+            return re.sub(rb'\D', b'', _der_payload(name.value)).decode('ascii')
+    return None
+
+
+def _common_name(name):
+    attributes = name.get_attributes_for_oid(NameOID.COMMON_NAME)
+    return attributes[0].value if attributes else name.rfc4514_string()
+
+
+def parse_certificate_file(file_name, data, password=None):
+    """Extract the identification and validity of a certificate file
+
+    Returns a dict with `file_name`, `ok` and either `error` or the subject
+    name, document (CNPJ or CPF digits), certificate type, serial number and
+    validity dates. Never raises, so it is safe to map over many files.
+    """
+    try:
+        certificate = _load(file_name, data, password)
+    except CertificateFileError as e:
+        return {'file_name': file_name, 'ok': False, 'error': str(e)}
+    except Exception:
+        return {'file_name': file_name, 'ok': False, 'error': 'Arquivo de certificado ilegível.'}
+
+    subject = _common_name(certificate.subject)
+    # e-CNPJ/e-CPF subjects end with ":<document>"
+    name, _, suffix = subject.rpartition(':')
+    suffix_digits = re.sub(r'\D', '', suffix) if name else ''
+
+    cnpj = _other_name_digits(certificate, OID_PJ_CNPJ)
+    cpf_data = _other_name_digits(certificate, OID_PF_DATA)
+    cpf = cpf_data[8:19] if cpf_data and len(cpf_data) >= 19 else None
+    if not cnpj and len(suffix_digits) == 14:
+        cnpj = suffix_digits
+    if not cnpj and not cpf and len(suffix_digits) == 11:
+        cpf = suffix_digits
+
+    return {
+        'file_name': file_name,
+        'ok': True,
+        'subject': name or subject,
+        'cnpj': cnpj if cnpj and len(cnpj) == 14 else None,
+        'cpf': cpf,
+        'type': 'e-cnpj' if cnpj else 'e-cpf',
+        'serial_number': format(certificate.serial_number, 'x'),
+        'issuer': _common_name(certificate.issuer),
+        'not_before': certificate.not_valid_before_utc.date(),
+        'not_after': certificate.not_valid_after_utc.date(),
+    }
+
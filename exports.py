@@ -0,0 +1,210 @@
+import csv
+import io
+import json
+import zipfile
+from datetime import datetime
+from xml.sax.saxutils import escape
+
+from sqlalchemy import select
+
+from app import db
+from models import Certificate, Company
+from stats import certificate_status, certificate_status_condition
+
+EXPORT_HEADER = [
+    'Nome', 'Tipo', 'Empresa', 'CNPJ', 'Data de Emissão',
+    'Data de Validade', 'Dias Restantes', 'Status'
+]
+
+STATUS_LABELS = {
+    'expired': 'Expirado',
+    'expiring-soon': 'Expirando em breve',
+    'valid': 'Válido',
+}
+
+# Rows fetched per round-trip (server-side cursor on PostgreSQL)
+FETCH_SIZE = 1000
+
+# Rows serialized before a chunk is handed to the WSGI server
+CHUNK_ROWS = 500
+
+
+def iter_certificate_rows(organization_id, status=None, today=None):
+    """Yield export rows for an organization's certificates
+
+    Company columns are selected in the same query and results are streamed
+    with `yield_per`, so memory use does not depend on the portfolio size.
+    """
+    today = today or datetime.now().date()
+
+    stmt = (
+        select(
+            Certificate.name,
+            Certificate.type,
+            Company.name,
+            Company.cnpj,
+            Certificate.issue_date,
+            Certificate.expiry_date
+        )
+        .join(Company, Certificate.company_id == Company.id)
+        .where(Certificate.organization_id == organization_id)
+        .order_by(Certificate.expiry_date, Certificate.id)
+        .execution_options(yield_per=FETCH_SIZE)
+    )
+    if status in ('expired', 'expiring-soon'):
+        stmt = stmt.where(certificate_status_condition(status, today))
+
+    for name, cert_type, company_name, cnpj, issue_date, expiry_date in db.session.execute(stmt):
+        days_left = (expiry_date - today).days
+        yield [
+            name,
+            cert_type,
+            company_name,
+            cnpj,
+            issue_date.strftime('%d/%m/%Y'),
+            expiry_date.strftime('%d/%m/%Y'),
+            days_left if days_left >= 0 else 0,
+            STATUS_LABELS[certificate_status(expiry_date, today)]
+        ]
+
+
+def _chunked(rows, write, drain):
+    """Serialize rows with `write` and yield `drain()` every CHUNK_ROWS rows"""
+    for count, row in enumerate(rows, 1):
+        write(row)
+        if count % CHUNK_ROWS == 0:
+            yield drain()
+    data = drain()
+    if data:
+        yield data
+
+
+def _drain_text(buffer):
+    def drain():
+        data = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return data
+    return drain
+
+
+def stream_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_HEADER)
+    yield from _chunked(rows, writer.writerow, _drain_text(buffer))
+
+
+def stream_jsonl(rows):
+    buffer = io.StringIO()
+
+    def write(row):
+        buffer.write(json.dumps(dict(zip(EXPORT_HEADER, row)), ensure_ascii=False))
+        buffer.write('\n')
+
+    yield from _chunked(rows, write, _drain_text(buffer))
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only, unseekable file object collecting bytes for streaming"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+_XLSX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '</Types>'
+)
+
+_XLSX_ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+
+_XLSX_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name="Certificados" sheetId="1" r:id="rId1"/></sheets>'
+    '</workbook>'
+)
+
+_XLSX_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+    'Target="worksheets/sheet1.xml"/>'
+    '</Relationships>'
+)
+
+
+def _xlsx_row(row):
+    cells = []
+    for value in row:
+        if isinstance(value, (int, float)):
+            cells.append(f'<c t="n"><v>{value}</v></c>')
+        else:
+            cells.append(f'<c t="inlineStr"><is><t>{escape(str(value))}</t></is></c>')
+    return f'<row>{"".join(cells)}</row>'.encode('utf-8')
+
+
+def stream_xlsx(rows):
+    """Stream a single-sheet XLSX workbook
+
+    The worksheet is written row by row into a ZIP archive over an unseekable
+    sink, so the workbook is never held in memory or on disk.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('[Content_Types].xml', _XLSX_CONTENT_TYPES)
+        archive.writestr('_rels/.rels', _XLSX_ROOT_RELS)
+        archive.writestr('xl/workbook.xml', _XLSX_WORKBOOK)
+        archive.writestr('xl/_rels/workbook.xml.rels', _XLSX_WORKBOOK_RELS)
+
+        with archive.open('xl/worksheets/sheet1.xml', 'w') as sheet:
+            sheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                b'<sheetData>'
+            )
+            sheet.write(_xlsx_row(EXPORT_HEADER))
+            yield from _chunked(rows, lambda row: sheet.write(_xlsx_row(row)), sink.drain)
+            sheet.write(b'</sheetData></worksheet>')
+    yield sink.drain()
+
+
+# format -> (serializer, mimetype, file extension)
+EXPORT_FORMATS = {
+    'csv': (stream_csv, 'text/csv', 'csv'),
+    'jsonl': (stream_jsonl, 'application/x-ndjson', 'jsonl'),
+    'xlsx': (
+        stream_xlsx,
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        'xlsx'
+    ),
+}
@@ -1,9 +1,8 @@
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileRequired, FileAllowed
-from wtforms import StringField, PasswordField, BooleanField, SelectField, TextAreaField, DateField, HiddenField
+from wtforms import StringField, PasswordField, BooleanField, SelectField, TextAreaField, HiddenField
 from wtforms.validators import DataRequired, Email, EqualTo, Length, ValidationError, Optional, Regexp
 from models import User, Organization, Company
-from datetime import datetime
 
 class LoginForm(FlaskForm):
     email = StringField('Email', validators=[DataRequired(), Email()])
@@ -82,8 +81,6 @@ class CertificateUploadForm(FlaskForm):
         FileAllowed(['pfx', 'p12'], 'Apenas arquivos .pfx ou .p12 são permitidos.')
     ])
     password = PasswordField('Senha do certificado', validators=[DataRequired()])
-    issue_date = DateField('Data de emissão', validators=[DataRequired()], format='%Y-%m-%d')
-    expiry_date = DateField('Data de validade', validators=[DataRequired()], format='%Y-%m-%d')
     
     def __init__(self, *args, organization_id=None, **kwargs):
         super(CertificateUploadForm, self).__init__(*args, **kwargs)
@@ -94,13 +91,16 @@ class CertificateUploadForm(FlaskForm):
                 (c.id, f"{c.name} ({c.cnpj})") 
                 for c in Company.query.filter_by(organization_id=organization_id).all()
             ]
-    
-    def validate_expiry_date(self, expiry_date):
-        if expiry_date.data < datetime.now().date():
-            raise ValidationError('A data de validade não pode ser no passado.')
-        
-        if self.issue_date.data and expiry_date.data <= self.issue_date.data:
-            raise ValidationError('A data de validade deve ser posterior à data de emissão.')
+
+class CertificateImportForm(FlaskForm):
+    archive = FileField('Arquivo ZIP com os certificados', validators=[
+        FileRequired(),
+        FileAllowed(['zip'], 'Apenas arquivos .zip são permitidos.')
+    ])
+    manifest = FileField('Manifesto de senhas (CSV)', validators=[
+        FileAllowed(['csv', 'txt'], 'Apenas arquivos .csv são permitidos.')
+    ])
+    password = PasswordField('Senha padrão', validators=[Optional()])
 
 class UserInviteForm(FlaskForm):
     email = StringField('Email', validators=[DataRequired(), Email()])
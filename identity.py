@@ -0,0 +1,209 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask_login import UserMixin
+
+from app import db
+
+logger = logging.getLogger(__name__)
+
+# Attributes of a user kept in the identity cache
+SNAPSHOT_FIELDS = ('id', 'name', 'email', 'role', 'organization_id', 'mfa_enabled')
+
+# Seconds between two reads of the shared invalidation log by a process
+INVALIDATION_POLL_INTERVAL = 2
+
+
+class CachedUser(UserMixin):
+    """Flask-Login user built from a cached snapshot
+
+    Reads of the snapshot fields cost no query. Any other attribute (e.g.
+    `organization`, `last_login`, `check_password`) loads the `User` row on
+    first use; from then on every read comes from the row. Views that change
+    the user must do so through `db_user`: setting an attribute here raises.
+    """
+
+    def __init__(self, snapshot):
+        self._snapshot = dict(zip(SNAPSHOT_FIELDS, snapshot))
+        self._db_user = None
+
+    @property
+    def db_user(self):
+        if self._db_user is None:
+            from models import User
+
+            self._db_user = db.session.get(User, self._snapshot['id'])
+        return self._db_user
+
+    def __setattr__(self, name, value):
+        if not name.startswith('_'):
+            raise AttributeError(
+                f"CachedUser is read-only; set `{name}` on `current_user.db_user` instead"
+            )
+        super().__setattr__(name, value)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name in self._snapshot and self._db_user is None:
+            return self._snapshot[name]
+        return getattr(self.db_user, name)
+
+    def __repr__(self):
+        return f"<CachedUser {self._snapshot['email']}>"
+
+
+class InvalidationLog:
+    """User ids whose snapshots went stale, shared by the worker processes
+    of one host in a SQLite file
+
+    Each committed change to a user appends a row; every process reads the
+    rows after the last one it saw and drops those entries from its cache.
+    Rows older than `retention` seconds are pruned: any entry they concern
+    has expired.
+    """
+
+    def __init__(self, path, retention):
+        self.path = path
+        self.retention = retention
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS invalidations '
+                '(id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, created REAL NOT NULL)'
+            )
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def publish(self, user_ids):
+        now = time.time()
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany(
+                'INSERT INTO invalidations (user_id, created) VALUES (?, ?)',
+                [(user_id, now) for user_id in user_ids]
+            )
+            connection.execute('DELETE FROM invalidations WHERE created < ?', (now - self.retention,))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    def since(self, last_id):
+        """(user ids logged after `last_id`, id of the newest row); with
+        `last_id` None only the newest id is read"""
+        connection = self._connection()
+        if last_id is None:
+            return [], connection.execute('SELECT coalesce(max(id), 0) FROM invalidations').fetchone()[0]
+        rows = connection.execute(
+            'SELECT id, user_id FROM invalidations WHERE id > ? ORDER BY id', (last_id,)
+        ).fetchall()
+        return [user_id for _, user_id in rows], (rows[-1][0] if rows else last_id)
+
+
+class IdentityCache:
+    """Per-process LRU of user snapshots for `login_manager.user_loader`
+
+    A hit costs no query. Entries expire after IDENTITY_CACHE_TTL seconds
+    and are dropped when a commit updates or deletes the user: in this
+    process right away, and in the other workers of the host within
+    INVALIDATION_POLL_INTERVAL seconds, through the InvalidationLog in
+    IDENTITY_CACHE_SQLITE_PATH. Changes made outside the application (or on
+    another host) show after the TTL.
+    """
+
+    def __init__(self, app=None):
+        self.ttl = 60
+        self.max_size = 10000
+        self.log = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_seen = None
+        self._next_poll = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get("IDENTITY_CACHE_TTL", 60)
+        self.max_size = app.config.get("IDENTITY_CACHE_SIZE", 10000)
+        self.log = InvalidationLog(app.config.get("IDENTITY_CACHE_SQLITE_PATH") or os.path.join(
+            app.instance_path, "identity_cache.db"
+        ), retention=self.ttl + INVALIDATION_POLL_INTERVAL)
+
+    def _poll(self, now):
+        """Apply the invalidations logged by other processes, at most once
+        every INVALIDATION_POLL_INTERVAL seconds"""
+        with self._lock:
+            if now < self._next_poll or self.log is None:
+                return
+            self._next_poll = now + INVALIDATION_POLL_INTERVAL
+            last_seen = self._last_seen
+        try:
+            user_ids, last_seen = self.log.since(last_seen)
+        except sqlite3.Error:
+            logger.exception("Could not read the identity cache invalidations")
+            user_ids, last_seen = None, None
+        with self._lock:
+            if user_ids is None:
+                # Nothing is known about the missed changes
+                self._entries.clear()
+            for user_id in user_ids or ():
+                self._entries.pop(user_id, None)
+            self._last_seen = last_seen
+
+    def load(self, user_id):
+        """The user with this id, from the cache when possible, or None"""
+        from models import User
+
+        if self.ttl <= 0:
+            return db.session.get(User, user_id)
+
+        now = time.monotonic()
+        self._poll(now)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(user_id)
+                return CachedUser(entry[0])
+
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        snapshot = tuple(getattr(user, field) for field in SNAPSHOT_FIELDS)
+        with self._lock:
+            self._entries[user_id] = (snapshot, now + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return user
+
+    def invalidate(self, *user_ids):
+        """Drop users from this cache and from those of the other workers"""
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+        if self.ttl > 0 and self.log is not None and user_ids:
+            try:
+                self.log.publish(user_ids)
+            except sqlite3.Error:
+                logger.exception("Could not log identity cache invalidations")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+identity_cache = IdentityCache()
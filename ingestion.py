@@ -0,0 +1,391 @@
+import csv
+import io
+import logging
+import multiprocessing
+import os
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup
+
+from app import app, db
+from certificate_files import CERTIFICATE_EXTENSIONS, parse_certificate_file
+from key_ring import KeyRingError, get_key_ring
+from blobs import (
+    cached_metadata, discard_new_blobs, fingerprint_bytes, fingerprint_existing_certificates,
+    remember_metadata, store_many
+)
+from models import Certificate, CertificateBlob, Company, User, normalize_cnpj
+from stats import invalidate_certificate_caches, record_certificate_changes
+from storage import StorageError
+
+logger = logging.getLogger(__name__)
+
+# Limits of one import (number of certificate files and size of each file)
+MAX_IMPORT_FILES = 5000
+MAX_FILE_SIZE = 5 * 1024 * 1024
+
+# Below this many files the request's own thread parses them faster than
+# the process pool (a file takes ~10ms, handing a batch over and starting
+# the workers on first use cost more)
+PARALLEL_THRESHOLD = 128
+
+# Process pool of the imports of this process: (pid, workers, executor)
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class CertificateImportError(Exception):
+    """The archive or the manifest of an import is unusable"""
+
+
+def read_manifest(data):
+    """Parse a password manifest: file name, password and optional CNPJ
+
+    Accepts CSV separated by ';', ',' or tabs, with or without a header
+    row. Returns {lowercased file name: (password, cnpj digits or None)}.
+    """
+    if not data:
+        return {}
+    try:
+        content = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        content = data.decode('latin-1')
+    try:
+        dialect = csv.Sniffer().sniff(content[:4096], delimiters=';,\t')
+    except csv.Error:
+        dialect = csv.excel
+
+    manifest = {}
+    for number, row in enumerate(csv.reader(io.StringIO(content), dialect)):
+        row = [value.strip() for value in row]
+        if not row or not row[0]:
+            continue
+        if number == 0 and row[0].lower() in ('arquivo', 'file', 'file_name', 'nome'):
+            continue
+        password = row[1] if len(row) > 1 else ''
+        cnpj = normalize_cnpj(row[2]) if len(row) > 2 else ''
+        manifest[os.path.basename(row[0]).lower()] = (password, cnpj or None)
+    return manifest
+
+
+def read_archive(source):
+    """Return (files, rejected) from a ZIP archive (path, bytes or seekable
+    binary file, such as an uploaded file spooled to disk)
+
+    `files` holds (name, data) of every certificate file; `rejected` holds
+    report rows for the members that were not read.
+    """
+    try:
+        archive = zipfile.ZipFile(io.BytesIO(source) if isinstance(source, bytes) else source)
+    except (zipfile.BadZipFile, OSError):
+        raise CertificateImportError('Arquivo ZIP inválido.')
+
+    files, rejected = [], []
+    with archive:
+        members = [
+            member for member in archive.infolist()
+            if not member.is_dir() and not member.filename.startswith('__MACOSX/')
+            and member.filename.lower().endswith(CERTIFICATE_EXTENSIONS)
+        ]
+        if len(members) > MAX_IMPORT_FILES:
+            raise CertificateImportError(
+                f'O arquivo ZIP contém {len(members)} certificados; o limite é {MAX_IMPORT_FILES}.'
+            )
+        for member in members:
+            name = member.filename
+            if member.file_size > MAX_FILE_SIZE:
+                rejected.append(_report_row(name, 'failed', 'Arquivo maior que 5MB.'))
+                continue
+            try:
+                with archive.open(member) as handle:
+                    data = handle.read(MAX_FILE_SIZE + 1)
+            except (zipfile.BadZipFile, RuntimeError, OSError):
+                rejected.append(_report_row(name, 'failed', 'Não foi possível extrair o arquivo.'))
+                continue
+            if len(data) > MAX_FILE_SIZE:
+                rejected.append(_report_row(name, 'failed', 'Arquivo maior que 5MB.'))
+                continue
+            files.append((name, data))
+    return files, rejected
+
+
+def _executor(workers):
+    """The process pool shared by the imports of this process
+
+    Started on first use and kept for the life of the process, so its
+    workers are spawned once rather than on every import. Spawned, not
+    forked: forking a process that runs background threads may copy locks
+    in a held state; the parser module imports nothing else.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool[0] != os.getpid() or _pool[1] != workers:
+            if _pool is not None and _pool[0] == os.getpid():
+                _pool[2].shutdown(wait=False)
+            context = multiprocessing.get_context('spawn')
+            _pool = (os.getpid(), workers, ProcessPoolExecutor(max_workers=workers, mp_context=context))
+        return _pool[2]
+
+
+def _discard_executor(executor):
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool[2] is executor:
+            _pool = None
+    executor.shutdown(wait=False)
+
+
+def map_files(function, files, passwords, workers=None):
+    """Apply `function(name, data, password)` to (name, data) pairs, in the
+    process pool for large batches"""
+    names = [name for name, _ in files]
+    contents = [data for _, data in files]
+    workers = workers or app.config.get('CERTIFICATE_IMPORT_WORKERS') or os.cpu_count() or 1
+    if workers == 1 or len(files) < PARALLEL_THRESHOLD:
+        return list(map(function, names, contents, passwords))
+
+    executor = _executor(workers)
+    chunksize = max(1, len(files) // (workers * 4))
+    try:
+        return list(executor.map(function, names, contents, passwords, chunksize=chunksize))
+    except BrokenProcessPool:
+        # A worker died (e.g. killed for memory): start a new pool next time
+        logger.warning("Certificate import process pool broken; parsing in-process")
+        _discard_executor(executor)
+        return list(map(function, names, contents, passwords))
+
+
+def parse_files(files, passwords, workers=None):
+    """Parse (name, data) pairs, in a process pool for large batches"""
+    return map_files(parse_certificate_file, files, passwords, workers)
+
+
+def _report_row(file_name, status, message, parsed=None, company=None):
+    parsed = parsed or {}
+    return {
+        'file_name': file_name,
+        'status': status,
+        'message': message,
+        'company': company.name if company else None,
+        'document': parsed.get('cnpj') or parsed.get('cpf'),
+        'serial_number': parsed.get('serial_number'),
+        'expiry_date': parsed.get('not_after'),
+    }
+
+
+def import_certificates(archive, organization_id, user_id, manifest=None, default_password=None,
+                        workers=None, today=None):
+    """Import every certificate of a ZIP archive into an organization
+
+    Files are parsed in parallel (skipping contents already opened with the
+    same password), matched to companies by the CNPJ of the certificate (or
+    the one given in the manifest) and inserted in a single transaction.
+    Files already registered in the organization are reported as duplicates.
+    Returns one report row per file; nothing is inserted if the transaction
+    fails.
+    """
+    from utils import encrypt_certificate_password
+
+    # Fail before storing any file when the passwords cannot be encrypted
+    try:
+        get_key_ring()
+    except KeyRingError as e:
+        raise CertificateImportError(str(e))
+
+    today = today or datetime.now().date()
+    manifest = read_manifest(manifest)
+    files, report = read_archive(archive)
+
+    entries = [manifest.get(os.path.basename(name).lower(), (None, None)) for name, _ in files]
+    passwords = [password if password is not None else default_password for password, _ in entries]
+    fingerprints = [fingerprint_bytes(data) for _, data in files]
+
+    # Stored blobs and certificates already in the organization, by content
+    unique = set(fingerprints)
+    blobs = {
+        blob.fingerprint: blob
+        for blob in CertificateBlob.query.filter(CertificateBlob.fingerprint.in_(unique))
+    } if unique else {}
+    registered = {
+        fingerprint for (fingerprint,) in db.session.query(Certificate.fingerprint).filter(
+            Certificate.organization_id == organization_id, Certificate.fingerprint.in_(unique)
+        )
+    } if unique else set()
+
+    # Only files never opened with their password go through the parser; the
+    # others reuse the cached metadata
+    parsed_files = []
+    pending = []
+    for index, ((name, _), fingerprint) in enumerate(zip(files, fingerprints)):
+        metadata = cached_metadata(blobs.get(fingerprint), passwords[index])
+        parsed_files.append(dict(metadata, file_name=name) if metadata else None)
+        if metadata is None and fingerprint not in registered:
+            pending.append(index)
+    parsed = parse_files([files[index] for index in pending], [passwords[index] for index in pending], workers)
+    for index, result in zip(pending, parsed):
+        parsed_files[index] = result
+
+    # Companies of every CNPJ in the batch, in one query
+    cnpjs = {
+        cnpj or (parsed or {}).get('cnpj') for (_, cnpj), parsed in zip(entries, parsed_files)
+    } - {None}
+    companies = {
+        company.cnpj_digits: company
+        for company in Company.query.filter(
+            Company.organization_id == organization_id, Company.cnpj_digits.in_(cnpjs)
+        )
+    } if cnpjs else {}
+
+    # Certificates already registered, also when repackaged in another file
+    seen = {
+        (parsed['issuer'], parsed['serial_number'])
+        for fingerprint, parsed in zip(fingerprints, parsed_files)
+        if fingerprint in registered and parsed and parsed['ok']
+    }
+    accepted = []
+    rows = zip(files, fingerprints, passwords, entries, parsed_files)
+    for (name, data), fingerprint, password, (_, cnpj), parsed in rows:
+        if fingerprint in registered:
+            report.append(_report_row(name, 'duplicate', 'Certificado já cadastrado.', parsed))
+            continue
+        if not parsed['ok']:
+            report.append(_report_row(name, 'failed', parsed['error']))
+            continue
+        key = (parsed['issuer'], parsed['serial_number'])
+        if key in seen or fingerprint in seen:
+            report.append(_report_row(name, 'duplicate', 'Certificado repetido no arquivo ZIP.', parsed))
+            continue
+        seen.update([key, fingerprint])
+        if parsed['not_after'] < today:
+            report.append(_report_row(name, 'expired', 'Certificado vencido.', parsed))
+            continue
+        company = companies.get(cnpj or parsed['cnpj'])
+        if company is None:
+            report.append(_report_row(name, 'unmatched', 'Nenhuma empresa cadastrada com este CNPJ.', parsed))
+            continue
+        accepted.append((name, data, fingerprint, password, parsed, company))
+
+    # New files are uploaded to the storage backend concurrently
+    try:
+        stored = store_many(
+            (data, os.path.splitext(name)[1].lower(), fingerprint)
+            for name, data, fingerprint, _, _, _ in accepted
+        )
+    except StorageError as e:
+        db.session.rollback()
+        logger.error(f"Certificate import storage failed: {str(e)}")
+        raise CertificateImportError('Erro ao armazenar os arquivos; nenhum certificado foi importado.')
+
+    certificates, created_blobs = [], []
+    for (name, _, _, password, parsed, company), (blob, created) in zip(accepted, stored):
+        if created:
+            created_blobs.append((blob.fingerprint, blob.file_name, blob.s3_key))
+        remember_metadata(blob, parsed, password)
+
+        encrypted_password, iv, key_version = (
+            encrypt_certificate_password(password) if password else (None, None, None)
+        )
+        certificates.append(Certificate(
+            name=parsed['subject'][:100],
+            type=parsed['type'],
+            file_name=blob.file_name,
+            fingerprint=blob.fingerprint,
+            s3_key=blob.s3_key,
+            encrypted_password=encrypted_password,
+            iv=iv,
+            key_version=key_version,
+            company_id=company.id,
+            organization_id=organization_id,
+            issue_date=parsed['not_before'],
+            expiry_date=parsed['not_after'],
+            created_by=user_id
+        ))
+        report.append(_report_row(name, 'imported', 'Certificado importado.', parsed, company))
+
+    if certificates:
+        try:
+            db.session.add_all(certificates)
+            db.session.flush()
+            record_certificate_changes(organization_id, certificates, 1, today)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            discard_new_blobs(created_blobs)
+            logger.error(f"Certificate import failed: {str(e)}")
+            raise CertificateImportError('Erro ao gravar os certificados; nenhum certificado foi importado.')
+        invalidate_certificate_caches(organization_id)
+
+    report.sort(key=lambda row: row['file_name'].lower())
+    return report
+
+
+def summarize(report):
+    """Count report rows by status"""
+    counts = {}
+    for row in report:
+        counts[row['status']] = counts.get(row['status'], 0) + 1
+    return counts
+
+
+# CLI commands
+certificates_cli = AppGroup('certificates', help='Importação e arquivos de certificados.')
+
+
+@certificates_cli.command('import')
+@click.argument('archive', type=click.Path(exists=True, dir_okay=False))
+@click.option('--organization-id', type=int, required=True, help='Organização que receberá os certificados.')
+@click.option('--user-id', type=int, required=True, help='Usuário registrado como responsável pelo envio.')
+@click.option('--manifest', type=click.Path(exists=True, dir_okay=False),
+              help='CSV com arquivo, senha e (opcional) CNPJ da empresa.')
+@click.option('--password', default=None, help='Senha usada para os arquivos fora do manifesto.')
+@click.option('--workers', type=int, default=None, help='Processos usados na leitura dos arquivos.')
+@click.option('--report', 'report_path', type=click.Path(dir_okay=False), help='Grava o relatório em CSV.')
+def import_command(archive, organization_id, user_id, manifest, password, workers, report_path):
+    """Import the certificates of a ZIP archive."""
+    from utils import log_audit_event
+
+    user = db.session.get(User, user_id)
+    if user is None or user.organization_id != organization_id:
+        raise click.ClickException('Usuário não encontrado nesta organização.')
+
+    manifest_data = None
+    if manifest:
+        with open(manifest, 'rb') as handle:
+            manifest_data = handle.read()
+    try:
+        report = import_certificates(archive, organization_id, user_id, manifest_data, password, workers)
+    except CertificateImportError as e:
+        raise click.ClickException(str(e))
+
+    for row in report:
+        click.echo(f"{row['status']:<10} {row['file_name']}: {row['message']}")
+    counts = summarize(report)
+    click.echo(f"{counts.get('imported', 0)} de {len(report)} certificado(s) importado(s).")
+
+    if counts.get('imported'):
+        log_audit_event(
+            user_id,
+            'certificates_imported',
+            f"Importação em lote: {counts['imported']} de {len(report)} certificado(s)"
+        )
+
+    if report_path:
+        with open(report_path, 'w', newline='', encoding='utf-8') as handle:
+            writer = csv.DictWriter(handle, fieldnames=list(report[0]) if report else ['file_name'])
+            writer.writeheader()
+            writer.writerows(report)
+
+
+@certificates_cli.command('fingerprint')
+def fingerprint_command():
+    """Fingerprint certificates stored before deduplication."""
+    done, removed = fingerprint_existing_certificates()
+    click.echo(f'{done} certificado(s) processado(s); {removed} cópia(s) removida(s).')
+
+
+app.cli.add_command(certificates_cli)
@@ -0,0 +1,129 @@
+import logging
+import os
+
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from flask import current_app
+
+# This module imports nothing from the application: it is also loaded by
+# the worker processes of `flask keys rotate`
+
+logger = logging.getLogger(__name__)
+
+KEY_SIZE = 32  # AES-256
+
+# Version of the passwords encrypted before key versioning, with
+# CERTIFICATE_ENCRYPTION_KEY
+LEGACY_KEY_VERSION = 1
+
+
+class KeyRingError(Exception):
+    """Encryption keys missing, invalid or unknown"""
+
+
+def derive_key(secret):
+    """AES key of a configured secret (UTF-8, zero-padded or cut to 32 bytes)"""
+    key = secret.encode('utf-8')
+    if len(key) < KEY_SIZE:
+        logger.warning("Certificate encryption key shorter than 32 bytes; use a longer random key")
+        key = key.ljust(KEY_SIZE, b'\0')
+    return key[:KEY_SIZE]
+
+
+def parse_keys(current_key=None, versioned_keys=None):
+    """Keys by version from CERTIFICATE_ENCRYPTION_KEY and CERTIFICATE_ENCRYPTION_KEYS
+
+    The second is a comma-separated list of `version:secret`; the single key,
+    when set, is version 1.
+    """
+    keys = {}
+    for item in (versioned_keys or '').split(','):
+        if not item.strip():
+            continue
+        version, _, secret = item.strip().partition(':')
+        if not version.isdigit() or int(version) < 1 or not secret:
+            raise KeyRingError('CERTIFICATE_ENCRYPTION_KEYS deve ter o formato "versão:chave,versão:chave".')
+        if int(version) in keys:
+            raise KeyRingError(f'Versão de chave repetida: {version}.')
+        keys[int(version)] = derive_key(secret)
+    if current_key:
+        if LEGACY_KEY_VERSION in keys and keys[LEGACY_KEY_VERSION] != derive_key(current_key):
+            raise KeyRingError('CERTIFICATE_ENCRYPTION_KEY difere da versão 1 de CERTIFICATE_ENCRYPTION_KEYS.')
+        keys[LEGACY_KEY_VERSION] = derive_key(current_key)
+    if not keys:
+        raise KeyRingError('Nenhuma chave de criptografia configurada (CERTIFICATE_ENCRYPTION_KEY).')
+    return keys
+
+
+class KeyRing:
+    """AES-256-CBC keys by version; new data is encrypted with the active one"""
+
+    def __init__(self, keys, active_version=None):
+        if not keys:
+            raise KeyRingError('Nenhuma chave de criptografia configurada (CERTIFICATE_ENCRYPTION_KEY).')
+        self.keys = dict(keys)
+        self.active_version = active_version or max(self.keys)
+        if self.active_version not in self.keys:
+            raise KeyRingError(f'A chave ativa (versão {self.active_version}) não está configurada.')
+        self._algorithms = {version: algorithms.AES(key) for version, key in self.keys.items()}
+
+    def encrypt(self, plaintext):
+        """Returns (ciphertext, iv, key version)"""
+        iv = os.urandom(16)
+        encryptor = Cipher(self._algorithms[self.active_version], modes.CBC(iv)).encryptor()
+        padder = padding.PKCS7(algorithms.AES.block_size).padder()
+        padded = padder.update(plaintext.encode('utf-8')) + padder.finalize()
+        return encryptor.update(padded) + encryptor.finalize(), iv, self.active_version
+
+    def decrypt(self, ciphertext, iv, version=None):
+        """Plaintext of a ciphertext; raises ValueError if it does not decrypt"""
+        version = version or LEGACY_KEY_VERSION
+        if version not in self._algorithms:
+            raise KeyRingError(f'Chave de criptografia versão {version} não configurada.')
+        decryptor = Cipher(self._algorithms[version], modes.CBC(iv)).decryptor()
+        padded = decryptor.update(ciphertext) + decryptor.finalize()
+        unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+        return (unpadder.update(padded) + unpadder.finalize()).decode('utf-8')
+
+    def reencrypt_rows(self, rows):
+        """Re-encrypt (id, ciphertext, iv, version) rows with the active key
+
+        Returns (id, old ciphertext, new ciphertext, new iv) per row, or None
+        for rows that do not decrypt with their key.
+        """
+        results = []
+        for row_id, ciphertext, iv, version in rows:
+            try:
+                plaintext = self.decrypt(ciphertext, iv, version)
+            except (KeyRingError, ValueError):
+                results.append(None)
+                continue
+            new_ciphertext, new_iv, _ = self.encrypt(plaintext)
+            results.append((row_id, ciphertext, new_ciphertext, new_iv))
+        return results
+
+
+def get_key_ring():
+    """The application's key ring, loaded and validated on first use"""
+    key_ring = current_app.extensions.get('key_ring')
+    if key_ring is None:
+        keys = parse_keys(
+            current_app.config.get('CERTIFICATE_ENCRYPTION_KEY'),
+            current_app.config.get('CERTIFICATE_ENCRYPTION_KEYS')
+        )
+        key_ring = KeyRing(keys, current_app.config.get('CERTIFICATE_ENCRYPTION_KEY_VERSION') or None)
+        current_app.extensions['key_ring'] = key_ring
+    return key_ring
+
+
+# Key ring of a `flask keys rotate` worker process
+_worker_key_ring = None
+
+
+def init_worker(keys, active_version):
+    global _worker_key_ring
+    _worker_key_ring = KeyRing(keys, active_version)
+
+
+def reencrypt_rows(rows):
+    return _worker_key_ring.reencrypt_rows(rows)
@@ -0,0 +1,160 @@
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import bindparam, func, or_
+
+from app import app, db
+from key_ring import KeyRingError, get_key_ring, init_worker, reencrypt_rows
+from models import Certificate
+
+# Passwords re-encrypted per transaction
+ROTATION_BATCH = 1000
+
+# Below this many passwords, starting a process pool costs more than it saves
+PARALLEL_THRESHOLD = 20000
+
+_certificates = Certificate.__table__
+
+# Skips rows whose password changed since they were read
+_update_password = (
+    _certificates.update()
+    .where(
+        _certificates.c.id == bindparam('b_id'),
+        _certificates.c.encrypted_password == bindparam('b_old_password')
+    )
+    .values(
+        encrypted_password=bindparam('b_password'),
+        iv=bindparam('b_iv'),
+        key_version=bindparam('b_key_version'),
+        # Not a change of the certificate
+        updated_at=_certificates.c.updated_at
+    )
+)
+
+
+def _outdated(target_version):
+    return or_(Certificate.key_version.is_(None), Certificate.key_version != target_version)
+
+
+def count_outdated(target_version):
+    return db.session.query(func.count(Certificate.id)).filter(
+        Certificate.encrypted_password.isnot(None), _outdated(target_version)
+    ).scalar()
+
+
+def _batches(target_version, batch_size):
+    """Outdated (id, ciphertext, iv, version) rows, in id order"""
+    last_id = 0
+    while True:
+        rows = db.session.query(
+            Certificate.id, Certificate.encrypted_password, Certificate.iv, Certificate.key_version
+        ).filter(
+            Certificate.id > last_id,
+            Certificate.encrypted_password.isnot(None),
+            _outdated(target_version)
+        ).order_by(Certificate.id).limit(batch_size).all()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        yield [tuple(row) for row in rows]
+
+
+def _reencrypted(batches, key_ring, workers):
+    """Re-encrypted batches in order, at most two per worker in flight"""
+    if workers == 1:
+        for rows in batches:
+            yield key_ring.reencrypt_rows(rows)
+        return
+
+    # Spawned workers, as in the certificate import: the key ring module
+    # imports nothing else
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker,
+                             initargs=(key_ring.keys, key_ring.active_version)) as executor:
+        pending = deque()
+        for rows in batches:
+            pending.append(executor.submit(reencrypt_rows, rows))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def rotate_keys(batch_size=ROTATION_BATCH, workers=None, progress=None):
+    """Re-encrypt every certificate password with the active key
+
+    Each batch is committed on its own, so an interrupted rotation resumes
+    where it stopped when run again. Returns (re-encrypted, failed); failed
+    passwords keep their key version.
+    """
+    key_ring = get_key_ring()
+    target = key_ring.active_version
+    total = count_outdated(target)
+    if workers is None:
+        workers = (os.cpu_count() or 1) if total >= PARALLEL_THRESHOLD else 1
+
+    done = failed = 0
+    for results in _reencrypted(_batches(target, batch_size), key_ring, workers):
+        updates = [
+            {'b_id': row_id, 'b_old_password': old, 'b_password': new, 'b_iv': iv, 'b_key_version': target}
+            for row_id, old, new, iv in filter(None, results)
+        ]
+        if updates:
+            db.session.execute(_update_password, updates)
+        db.session.commit()
+        done += len(updates)
+        failed += len(results) - len(updates)
+        if progress:
+            progress(done + failed, total)
+    return done, failed
+
+
+# CLI commands
+keys_cli = AppGroup('keys', help='Chaves de criptografia das senhas de certificados.')
+
+
+@keys_cli.command('status')
+def status_command():
+    """Show how many passwords each key version encrypts."""
+    try:
+        key_ring = get_key_ring()
+    except KeyRingError as e:
+        raise click.ClickException(str(e))
+
+    counts = db.session.query(Certificate.key_version, func.count(Certificate.id)).filter(
+        Certificate.encrypted_password.isnot(None)
+    ).group_by(Certificate.key_version).order_by(Certificate.key_version).all()
+    click.echo(f"Chave ativa: versão {key_ring.active_version} "
+               f"(configuradas: {', '.join(map(str, sorted(key_ring.keys)))})")
+    for version, count in counts:
+        click.echo(f"Versão {version or '-'}: {count} senha(s)")
+
+
+@keys_cli.command('rotate')
+@click.option('--batch-size', type=int, default=ROTATION_BATCH, show_default=True,
+              help='Senhas regravadas por transação.')
+@click.option('--workers', type=int, default=None, help='Processos usados na recriptografia (padrão: um por CPU).')
+def rotate_command(batch_size, workers):
+    """Re-encrypt certificate passwords with the active key."""
+    try:
+        key_ring = get_key_ring()
+    except KeyRingError as e:
+        raise click.ClickException(str(e))
+
+    click.echo(f"Recriptografando senhas com a chave versão {key_ring.active_version}...")
+    done, failed = rotate_keys(
+        batch_size, workers,
+        progress=lambda processed, total: click.echo(f"{processed}/{total}")
+    )
+    click.echo(f"{done} senha(s) recriptografada(s).")
+    if failed:
+        raise click.ClickException(
+            f"{failed} senha(s) não puderam ser decifradas com a chave registrada e foram mantidas."
+        )
+
+
+app.cli.add_command(keys_cli)
@@ -0,0 +1,91 @@
+import logging
+from collections import Counter
+
+from flask import g, has_request_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+# Values of LAZY_LOAD_DETECTION
+DETECTION_MODES = ('off', 'warn', 'raise')
+
+# Lazy loads of one relationship in one template that make an N+1; a single
+# load (e.g. `current_user.organization`) is not reported
+REPEATED_LOADS = 2
+
+
+class LazyLoadError(Exception):
+    """A relationship was lazy loaded while a template was rendering"""
+
+
+class LazyLoadDetector:
+    """Flags relationship lazy loads issued while templates render
+
+    A template reading `certificate.company` or `log.user` on objects whose
+    view did not eager load the relationship runs one query per row. With
+    LAZY_LOAD_DETECTION set to "warn" every request logs the relationships
+    lazy loaded repeatedly during rendering and how many times; with "raise"
+    the second such load fails the request, which is what the test suite
+    uses. Loads answered from the identity map issue no query and are not
+    counted.
+    Meant for development and tests: the default, "off", adds no listeners.
+    """
+
+    def __init__(self, app=None):
+        self.mode = 'off'
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.mode = app.config.get("LAZY_LOAD_DETECTION", "off")
+        if self.mode not in DETECTION_MODES:
+            raise ValueError(f"LAZY_LOAD_DETECTION must be one of {', '.join(DETECTION_MODES)}")
+        if self.mode == 'off':
+            return
+        before_render_template.connect(self._render_started, app)
+        template_rendered.connect(self._render_finished, app)
+        event.listen(Session, 'do_orm_execute', self._orm_execute)
+        app.after_request(self.report)
+
+    def _render_started(self, sender, template, context, **extra):
+        g.setdefault('lazy_load_templates', []).append(template.name)
+
+    def _render_finished(self, sender, template, context, **extra):
+        templates = g.get('lazy_load_templates')
+        if templates:
+            templates.pop()
+
+    def _orm_execute(self, orm_execute_state):
+        if not orm_execute_state.is_select or not has_request_context():
+            return
+        if orm_execute_state.lazy_loaded_from is None:
+            return
+        templates = g.get('lazy_load_templates')
+        if not templates:
+            return
+
+        relationship = str(orm_execute_state.loader_strategy_path[-1])
+        key = (relationship, templates[-1])
+        lazy_loads = g.setdefault('lazy_loads', Counter())
+        lazy_loads[key] += 1
+        if self.mode == 'raise' and lazy_loads[key] >= REPEATED_LOADS:
+            raise LazyLoadError(
+                f"{relationship} lazy loaded once per row while rendering {templates[-1]}; "
+                f"eager load it in the view (selectinload/joinedload)"
+            )
+
+    def report(self, response):
+        lazy_loads = g.pop('lazy_loads', Counter())
+        repeated = [(key, count) for key, count in lazy_loads.most_common() if count >= REPEATED_LOADS]
+        if repeated:
+            logger.warning(
+                f"Lazy loads while rendering {request.endpoint}: " + ', '.join(
+                    f"{relationship} x{count} ({template})"
+                    for (relationship, template), count in repeated
+                )
+            )
+        return response
+
+
+lazy_load_detector = LazyLoadDetector()
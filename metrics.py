@@ -0,0 +1,307 @@
+import fcntl
+import glob
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+from flask import Response, abort, g, has_request_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from background import PeriodicFlusher, pid_alive
+
+# Upper bounds of the histogram buckets
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# Per-process files in METRICS_DIR; totals of exited processes are folded
+# into RETIRED_FILE so the counters never go back
+PROCESS_FILE = re.compile(r'metrics-(\d+)\.json$')
+RETIRED_FILE = 'metrics-retired.json'
+
+# Clients allowed to read /metrics when METRICS_TOKEN is not set
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+# name: (type, help, label names, buckets)
+METRICS = {
+    'oguardiao_requests_total': (
+        'counter', 'Requisições atendidas.', ('endpoint', 'method', 'status'), None),
+    'oguardiao_request_duration_seconds': (
+        'histogram', 'Duração das requisições.', ('endpoint', 'method'), SECONDS_BUCKETS),
+    'oguardiao_request_db_seconds': (
+        'histogram', 'Tempo em consultas SQL por requisição.', ('endpoint',), SECONDS_BUCKETS),
+    'oguardiao_request_queries': (
+        'histogram', 'Consultas SQL por requisição.', ('endpoint',), QUERY_BUCKETS),
+    'oguardiao_request_template_seconds': (
+        'histogram', 'Tempo de renderização de templates por requisição.', ('endpoint',), SECONDS_BUCKETS),
+    'oguardiao_mail_outbox_messages_total': (
+        'counter', 'Emails processados pela fila de envio.', ('result',), None),
+    'oguardiao_mail_outbox_batches_total': (
+        'counter', 'Lotes processados pela fila de envio.', (), None),
+}
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'sql_metrics' in g:
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('query_started')
+    if not started or not has_request_context() or 'sql_metrics' not in g:
+        return
+    sql = g.sql_metrics
+    sql['queries'] += 1
+    sql['db'] += time.perf_counter() - started.pop()
+
+
+@event.listens_for(Engine, 'handle_error')
+def _query_failed(context):
+    # Failed statements are timed too, and their start must not be left for
+    # the next query to pop
+    started = context.connection.info.get('query_started') if context.connection is not None else None
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    if has_request_context() and 'sql_metrics' in g:
+        g.sql_metrics['queries'] += 1
+        g.sql_metrics['db'] += elapsed
+
+
+@before_render_template.connect
+def _render_started(sender, template, context, **extra):
+    if has_request_context() and 'sql_metrics' in g:
+        g.sql_metrics.setdefault('render_started', []).append(time.perf_counter())
+
+
+@template_rendered.connect
+def _render_finished(sender, template, context, **extra):
+    if has_request_context() and g.get('sql_metrics', {}).get('render_started'):
+        g.sql_metrics['render'] += time.perf_counter() - g.sql_metrics['render_started'].pop()
+
+
+class RequestMetrics:
+    """Per-request SQL and rendering instrumentation
+
+    Engine events count the queries and database time of each request
+    and Flask's template signals time rendering, without code in the views.
+    Each response gets a Server-Timing header; the numbers are aggregated
+    per endpoint in this process and written every METRICS_FLUSH_INTERVAL
+    seconds to a file per process in METRICS_DIR, which `/metrics` merges
+    into the Prometheus text format (so all gunicorn workers are counted).
+    Files of processes that exited are folded into one, so restarted
+    workers neither pile up files nor reset the counters. Without
+    METRICS_TOKEN, `/metrics` only answers local requests that did not come
+    through a proxy.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.server_timing = True
+        self.directory = None
+        self.token = None
+        self._values = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.server_timing = app.config.get("SERVER_TIMING_ENABLED", True)
+        self.directory = app.config.get("METRICS_DIR") or os.path.join(app.instance_path, "metrics")
+        self.token = app.config.get("METRICS_TOKEN")
+        self._flusher = PeriodicFlusher(
+            "metrics-flusher",
+            self.flush,
+            app.config.get("METRICS_FLUSH_INTERVAL", 5),
+        )
+        app.before_request(self.start)
+        app.after_request(self.finish)
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+
+    def start(self):
+        if request.endpoint == 'static':
+            return
+        g.sql_metrics = {'started': time.perf_counter(), 'queries': 0, 'db': 0.0, 'render': 0.0}
+
+    def finish(self, response):
+        sql = g.pop('sql_metrics', None)
+        if sql is None:
+            return response
+        total = time.perf_counter() - sql['started']
+
+        if self.server_timing:
+            response.headers.add('Server-Timing', ', '.join([
+                f'db;dur={sql["db"] * 1000:.1f};desc="{sql["queries"]} consultas"',
+                f'tpl;dur={sql["render"] * 1000:.1f}',
+                f'total;dur={total * 1000:.1f}',
+            ]))
+
+        endpoint = request.endpoint or 'unknown'
+        with self._lock:
+            self._count('oguardiao_requests_total', (endpoint, request.method, str(response.status_code)))
+            self._observe('oguardiao_request_duration_seconds', (endpoint, request.method), total)
+            self._observe('oguardiao_request_db_seconds', (endpoint,), sql['db'])
+            self._observe('oguardiao_request_queries', (endpoint,), sql['queries'])
+            self._observe('oguardiao_request_template_seconds', (endpoint,), sql['render'])
+        self._flusher.ensure_started()
+        return response
+
+    def _count(self, name, labels, amount=1):
+        series = self._values.setdefault(name, {})
+        key = json.dumps(labels)
+        series[key] = series.get(key, 0) + amount
+
+    def _observe(self, name, labels, value):
+        buckets = METRICS[name][3]
+        series = self._values.setdefault(name, {})
+        key = json.dumps(labels)
+        observed = series.setdefault(key, {'buckets': [0] * (len(buckets) + 1), 'sum': 0.0, 'count': 0})
+        index = next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))
+        observed['buckets'][index] += 1
+        observed['sum'] += value
+        observed['count'] += 1
+
+    def _snapshot(self):
+        from outbox import outbox_metrics_snapshot
+
+        with self._lock:
+            values = json.loads(json.dumps(self._values))
+        outbox = outbox_metrics_snapshot()
+        if outbox['batches']:
+            values['oguardiao_mail_outbox_messages_total'] = {
+                json.dumps([result]): outbox[result] for result in ('sent', 'retried', 'failed')
+            }
+            values['oguardiao_mail_outbox_batches_total'] = {json.dumps([]): outbox['batches']}
+        return values
+
+    def flush(self):
+        """Write this process's totals to its file in METRICS_DIR"""
+        values = self._snapshot()
+        if not values:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'metrics-{os.getpid()}.json')
+        temporary = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(temporary, 'w') as output:
+            json.dump(values, output)
+        os.replace(temporary, path)
+
+    def retire_dead_processes(self):
+        """Fold the files of processes that exited into RETIRED_FILE"""
+        dead = []
+        for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+            match = PROCESS_FILE.search(os.path.basename(path))
+            if match and int(match.group(1)) != os.getpid() and not pid_alive(int(match.group(1))):
+                dead.append(path)
+        if not dead:
+            return 0
+
+        retired_path = os.path.join(self.directory, RETIRED_FILE)
+        with open(os.path.join(self.directory, '.retire.lock'), 'w') as lock:
+            # Serializes workers scraping at the same time
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            retired = _read(retired_path) or {}
+            folded = []
+            for path in dead:
+                values = _read(path)
+                if values is not None:
+                    _merge(retired, values)
+                    folded.append(path)
+            if not folded:
+                return 0
+            temporary = f'{retired_path}.{uuid.uuid4().hex}.tmp'
+            with open(temporary, 'w') as output:
+                json.dump(retired, output)
+            os.replace(temporary, retired_path)
+            for path in folded:
+                os.remove(path)
+        return len(folded)
+
+    def collect(self):
+        """Totals of every process that wrote to METRICS_DIR"""
+        self.flush()
+        self.retire_dead_processes()
+        merged = {}
+        for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+            values = _read(path)
+            if values is not None:
+                _merge(merged, values)
+        return merged
+
+    def render(self):
+        """Prometheus text exposition of the merged metrics"""
+        merged = self.collect()
+        lines = []
+        for name, (kind, help_text, label_names, buckets) in METRICS.items():
+            series = merged.get(name)
+            if not series:
+                continue
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for key in sorted(series):
+                labels = list(zip(label_names, json.loads(key)))
+                value = series[key]
+                if kind == 'histogram':
+                    cumulative = 0
+                    for bound, count in zip(list(buckets) + ['+Inf'], value['buckets']):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{_labels(labels + [("le", bound)])} {cumulative}')
+                    lines.append(f'{name}_sum{_labels(labels)} {value["sum"]}')
+                    lines.append(f'{name}_count{_labels(labels)} {value["count"]}')
+                else:
+                    lines.append(f'{name}{_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def metrics_view(self):
+        if self.token:
+            if request.headers.get('Authorization') != f'Bearer {self.token}':
+                abort(401)
+        elif request.remote_addr not in LOCAL_ADDRESSES or 'X-Forwarded-For' in request.headers:
+            # A local reverse proxy also connects from 127.0.0.1, but adds
+            # X-Forwarded-For
+            abort(404)
+        return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+
+def _read(path):
+    """Metric values of a file, or None if it is gone or half written"""
+    try:
+        with open(path) as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return None
+
+
+def _merge(merged, values):
+    """Add the series of `values` into `merged`"""
+    for name, series in values.items():
+        target = merged.setdefault(name, {})
+        for key, value in series.items():
+            if isinstance(value, dict):
+                current = target.setdefault(key, {'buckets': [0] * len(value['buckets']), 'sum': 0.0, 'count': 0})
+                current['buckets'] = [a + b for a, b in zip(current['buckets'], value['buckets'])]
+                current['sum'] += value['sum']
+                current['count'] += value['count']
+            else:
+                target[key] = target.get(key, 0) + value
+    return merged
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+request_metrics = RequestMetrics()
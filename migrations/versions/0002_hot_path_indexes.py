@@ -0,0 +1,48 @@
+"""hot path indexes
+
+Composite indexes matching the listing queries: certificates of a company by
+expiry date, companies of an organization by name, audit logs of a user by
+date and pending invites by email. On PostgreSQL they are built concurrently,
+so existing installations keep accepting writes while they are created.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 11:11:40.064828
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+# (index name, table, columns)
+INDEXES = [
+    ('ix_certificates_company_id_expiry_date', 'certificates', ['company_id', 'expiry_date']),
+    ('ix_companies_organization_id_name', 'companies', ['organization_id', 'name']),
+    ('ix_audit_logs_user_id_created_at', 'audit_logs', ['user_id', 'created_at']),
+    ('ix_user_invites_email_organization_id', 'user_invites', ['email', 'organization_id']),
+]
+
+
+def upgrade():
+    if op.get_context().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, table, columns in INDEXES:
+                op.create_index(name, table, columns, unique=False,
+                                postgresql_concurrently=True, if_not_exists=True)
+        return
+
+    # Databases created with db.create_all() may already have the indexes
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns, unique=False, if_not_exists=True)
+
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table_name=table, if_exists=True)
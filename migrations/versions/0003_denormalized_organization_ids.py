@@ -0,0 +1,81 @@
+"""denormalized organization ids
+
+Copies the organization of the company onto certificates and the
+organization of the user onto audit logs, so tenant-scoped listings scan a
+single table. Audit logs are backfilled in id ranges to keep transactions
+short on large tables.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 11:14:15.147412
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+# Audit log rows updated per statement during the backfill
+BACKFILL_BATCH = 50000
+
+
+def upgrade():
+    with op.batch_alter_table('certificates', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('organization_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_certificates_organization_id', 'organizations', ['organization_id'], ['id'])
+
+    with op.batch_alter_table('audit_logs', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('organization_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_audit_logs_organization_id', 'organizations', ['organization_id'], ['id'])
+
+    connection = op.get_bind()
+    connection.execute(sa.text(
+        'UPDATE certificates SET organization_id = '
+        '(SELECT companies.organization_id FROM companies WHERE companies.id = certificates.company_id)'
+    ))
+
+    max_id = connection.execute(sa.text('SELECT MAX(id) FROM audit_logs')).scalar() or 0
+    for start in range(0, max_id, BACKFILL_BATCH):
+        connection.execute(
+            sa.text(
+                'UPDATE audit_logs SET organization_id = '
+                '(SELECT users.organization_id FROM users WHERE users.id = audit_logs.user_id) '
+                'WHERE id > :start AND id <= :end'
+            ),
+            {'start': start, 'end': start + BACKFILL_BATCH}
+        )
+
+    with op.batch_alter_table('certificates', schema=None) as batch_op:
+        batch_op.alter_column('organization_id', existing_type=sa.Integer(), nullable=False)
+
+    indexes = [
+        ('ix_certificates_organization_id_expiry_date', 'certificates', ['organization_id', 'expiry_date', 'id']),
+        ('ix_audit_logs_organization_id_created_at', 'audit_logs', ['organization_id', 'created_at', 'id']),
+    ]
+    if op.get_context().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, table, columns in indexes:
+                op.create_index(name, table, columns, unique=False,
+                                postgresql_concurrently=True, if_not_exists=True)
+    else:
+        for name, table, columns in indexes:
+            op.create_index(name, table, columns, unique=False, if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_audit_logs_organization_id_created_at', table_name='audit_logs', if_exists=True)
+    op.drop_index('ix_certificates_organization_id_expiry_date', table_name='certificates', if_exists=True)
+
+    with op.batch_alter_table('audit_logs', schema=None) as batch_op:
+        batch_op.drop_constraint('fk_audit_logs_organization_id', type_='foreignkey')
+        batch_op.drop_column('organization_id')
+
+    with op.batch_alter_table('certificates', schema=None) as batch_op:
+        batch_op.drop_constraint('fk_certificates_organization_id', type_='foreignkey')
+        batch_op.drop_column('organization_id')
@@ -0,0 +1,132 @@
+"""audit log partitions and archive
+
+Adds the manifest of archived audit log segments and an index on
+audit_logs.created_at. On PostgreSQL, audit_logs becomes a table
+partitioned by month: the existing table is attached as the partition of
+everything logged before the migration ran (audit_logs_legacy), followed
+by the rest of the current month, monthly partitions and a default
+partition. Other databases keep a single table
+that the archiver trims month by month.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 11:17:35.671602
+
+"""
+from datetime import date
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+# Monthly partitions created ahead of the current month
+PARTITIONS_AHEAD = 3
+
+
+def _add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def upgrade():
+    op.create_table('audit_archive_segments',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('organization_id', sa.Integer(), nullable=True),
+    sa.Column('month', sa.Date(), nullable=False),
+    sa.Column('path', sa.String(length=255), nullable=False),
+    sa.Column('row_count', sa.Integer(), nullable=False),
+    sa.Column('first_created_at', sa.DateTime(), nullable=True),
+    sa.Column('last_created_at', sa.DateTime(), nullable=True),
+    sa.Column('archived_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['organization_id'], ['organizations.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('organization_id', 'month', name='uq_audit_archive_segments_organization_month')
+    )
+
+    if op.get_context().dialect.name != 'postgresql':
+        op.create_index('ix_audit_logs_created_at', 'audit_logs', ['created_at'], unique=False, if_not_exists=True)
+        return
+
+    # No rows may arrive while the legacy range is fixed and attached
+    op.execute('LOCK TABLE audit_logs IN ACCESS EXCLUSIVE MODE')
+
+    # The partition key must be part of the primary key and never null
+    op.execute("UPDATE audit_logs SET created_at = timezone('utc', now()) WHERE created_at IS NULL")
+    op.execute('ALTER TABLE audit_logs ALTER COLUMN created_at SET NOT NULL')
+
+    # The legacy partition ends right after its newest row, so the partition
+    # of the current month can take over from there
+    boundary = op.get_bind().execute(sa.text(
+        "SELECT greatest(timezone('utc', now()), max(created_at) + interval '1 microsecond') FROM audit_logs"
+    )).scalar()
+    current = date(boundary.year, boundary.month, 1)
+
+    op.execute('ALTER TABLE audit_logs RENAME TO audit_logs_legacy')
+    op.execute('ALTER TABLE audit_logs_legacy RENAME CONSTRAINT audit_logs_pkey TO audit_logs_legacy_pkey')
+    op.execute('ALTER INDEX ix_audit_logs_user_id_created_at RENAME TO ix_audit_logs_legacy_user_id_created_at')
+    op.execute('ALTER INDEX ix_audit_logs_organization_id_created_at '
+               'RENAME TO ix_audit_logs_legacy_organization_id_created_at')
+
+    op.execute("""
+        CREATE TABLE audit_logs (
+            id integer NOT NULL DEFAULT nextval('audit_logs_id_seq'),
+            action varchar(100) NOT NULL,
+            details text,
+            ip_address varchar(45),
+            user_id integer NOT NULL REFERENCES users (id),
+            organization_id integer REFERENCES organizations (id),
+            created_at timestamp without time zone NOT NULL,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    """)
+    op.execute('ALTER SEQUENCE audit_logs_id_seq OWNED BY audit_logs.id')
+    op.execute('CREATE INDEX ix_audit_logs_user_id_created_at ON audit_logs (user_id, created_at)')
+    op.execute('CREATE INDEX ix_audit_logs_organization_id_created_at ON audit_logs (organization_id, created_at, id)')
+    op.execute('CREATE INDEX ix_audit_logs_created_at ON audit_logs (created_at)')
+
+    # A partition's primary key must match the parent's (id, created_at)
+    op.execute('CREATE UNIQUE INDEX audit_logs_legacy_id_created_at ON audit_logs_legacy (id, created_at)')
+    op.execute('ALTER TABLE audit_logs_legacy DROP CONSTRAINT audit_logs_legacy_pkey, '
+               'ADD CONSTRAINT audit_logs_legacy_pkey PRIMARY KEY USING INDEX audit_logs_legacy_id_created_at')
+    # A validated check constraint lets ATTACH skip its own full scan
+    op.execute(f"ALTER TABLE audit_logs_legacy ADD CONSTRAINT audit_logs_legacy_range "
+               f"CHECK (created_at < '{boundary.isoformat()}') NOT VALID")
+    op.execute('ALTER TABLE audit_logs_legacy VALIDATE CONSTRAINT audit_logs_legacy_range')
+    op.execute(f"ALTER TABLE audit_logs ATTACH PARTITION audit_logs_legacy "
+               f"FOR VALUES FROM (MINVALUE) TO ('{boundary.isoformat()}')")
+
+    # The current month starts at the legacy boundary; the archiver clears
+    # its earlier rows from audit_logs_legacy when the month is archived
+    for offset in range(PARTITIONS_AHEAD + 1):
+        month = _add_months(current, offset)
+        start = boundary if offset == 0 else month
+        op.execute(f"CREATE TABLE audit_logs_p{month:%Y%m} PARTITION OF audit_logs "
+                   f"FOR VALUES FROM ('{start.isoformat()}') TO ('{_add_months(month, 1).isoformat()}')")
+    op.execute('CREATE TABLE audit_logs_default PARTITION OF audit_logs DEFAULT')
+
+
+def downgrade():
+    if op.get_context().dialect.name == 'postgresql':
+        op.execute('CREATE TABLE audit_logs_plain (LIKE audit_logs INCLUDING DEFAULTS)')
+        op.execute('INSERT INTO audit_logs_plain SELECT * FROM audit_logs')
+        op.execute('ALTER SEQUENCE audit_logs_id_seq OWNED BY audit_logs_plain.id')
+        op.execute('DROP TABLE audit_logs CASCADE')
+        op.execute('ALTER TABLE audit_logs_plain RENAME TO audit_logs')
+        op.execute('ALTER TABLE audit_logs ALTER COLUMN created_at DROP NOT NULL')
+        op.execute('ALTER TABLE audit_logs ADD PRIMARY KEY (id)')
+        op.execute('ALTER TABLE audit_logs ADD FOREIGN KEY (user_id) REFERENCES users (id)')
+        op.execute('ALTER TABLE audit_logs ADD CONSTRAINT fk_audit_logs_organization_id '
+                   'FOREIGN KEY (organization_id) REFERENCES organizations (id)')
+        op.execute('CREATE INDEX ix_audit_logs_user_id_created_at ON audit_logs (user_id, created_at)')
+        op.execute('CREATE INDEX ix_audit_logs_organization_id_created_at ON audit_logs (organization_id, created_at, id)')
+    else:
+        op.drop_index('ix_audit_logs_created_at', table_name='audit_logs', if_exists=True)
+
+    op.drop_table('audit_archive_segments')
@@ -0,0 +1,106 @@
+"""search indexes
+
+Adds the digits-only CNPJ of companies for prefix lookups and the text
+search structures used by search.py: FTS5 tables kept in sync by triggers on
+SQLite, tsvector and trigram GIN indexes (built concurrently) on PostgreSQL.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 11:21:54.869453
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+SQLITE_FTS = {
+    'companies_fts': ('companies', ['name', 'trade_name']),
+    'certificates_fts': ('certificates', ['name']),
+}
+
+POSTGRESQL_INDEXES = [
+    ('ix_companies_search_tsv', "companies USING gin "
+     "(to_tsvector('simple', coalesce(name, '') || ' ' || coalesce(trade_name, '')))"),
+    ('ix_companies_name_trgm', 'companies USING gin (name gin_trgm_ops)'),
+    ('ix_companies_trade_name_trgm', 'companies USING gin (trade_name gin_trgm_ops)'),
+    ('ix_certificates_search_tsv', "certificates USING gin (to_tsvector('simple', name))"),
+    ('ix_certificates_name_trgm', 'certificates USING gin (name gin_trgm_ops)'),
+]
+
+
+def _create_sqlite_fts(name, source, columns):
+    fields = ', '.join(columns)
+    new = ', '.join(f'new.{column}' for column in columns)
+    old = ', '.join(f'old.{column}' for column in columns)
+    op.execute(
+        f"CREATE VIRTUAL TABLE {name} USING fts5({fields}, content='{source}', content_rowid='id', "
+        f"tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+    )
+    op.execute(
+        f"CREATE TRIGGER {name}_ai AFTER INSERT ON {source} BEGIN "
+        f"INSERT INTO {name}(rowid, {fields}) VALUES (new.id, {new}); END"
+    )
+    op.execute(
+        f"CREATE TRIGGER {name}_ad AFTER DELETE ON {source} BEGIN "
+        f"INSERT INTO {name}({name}, rowid, {fields}) VALUES ('delete', old.id, {old}); END"
+    )
+    op.execute(
+        f"CREATE TRIGGER {name}_au AFTER UPDATE OF {fields} ON {source} BEGIN "
+        f"INSERT INTO {name}({name}, rowid, {fields}) VALUES ('delete', old.id, {old}); "
+        f"INSERT INTO {name}(rowid, {fields}) VALUES (new.id, {new}); END"
+    )
+    op.execute(f"INSERT INTO {name}({name}) VALUES ('rebuild')")
+
+
+def upgrade():
+    with op.batch_alter_table('companies', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('cnpj_digits', sa.String(length=14), nullable=True))
+
+    op.execute(
+        "UPDATE companies SET cnpj_digits = "
+        "replace(replace(replace(replace(cnpj, '.', ''), '/', ''), '-', ''), ' ', '')"
+    )
+
+    with op.batch_alter_table('companies', schema=None) as batch_op:
+        batch_op.alter_column('cnpj_digits', existing_type=sa.String(length=14), nullable=False)
+
+    dialect = op.get_context().dialect.name
+    if dialect == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        with op.get_context().autocommit_block():
+            op.create_index('ix_companies_organization_id_cnpj_digits', 'companies',
+                            ['organization_id', 'cnpj_digits'], unique=False,
+                            postgresql_concurrently=True, if_not_exists=True)
+            for name, definition in POSTGRESQL_INDEXES:
+                op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}')
+        return
+
+    op.create_index('ix_companies_organization_id_cnpj_digits', 'companies',
+                    ['organization_id', 'cnpj_digits'], unique=False, if_not_exists=True)
+
+    if dialect == 'sqlite':
+        for name, (source, columns) in SQLITE_FTS.items():
+            _create_sqlite_fts(name, source, columns)
+
+
+def downgrade():
+    dialect = op.get_context().dialect.name
+    if dialect == 'postgresql':
+        for name, _ in reversed(POSTGRESQL_INDEXES):
+            op.execute(f'DROP INDEX IF EXISTS {name}')
+    elif dialect == 'sqlite':
+        for name in SQLITE_FTS:
+            for suffix in ('ai', 'ad', 'au'):
+                op.execute(f'DROP TRIGGER IF EXISTS {name}_{suffix}')
+            op.execute(f'DROP TABLE IF EXISTS {name}')
+
+    op.drop_index('ix_companies_organization_id_cnpj_digits', table_name='companies', if_exists=True)
+    with op.batch_alter_table('companies', schema=None) as batch_op:
+        batch_op.drop_column('cnpj_digits')
@@ -0,0 +1,73 @@
+"""certificate blobs
+
+Stores certificate files by content (SHA-256). Certificates with the same
+file share one blob, which also caches the parsed X.509 metadata. Existing
+certificates are fingerprinted afterwards with `flask certificates
+fingerprint`.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 11:27:55.809332
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+# Recreating the table on SQLite drops the search triggers of revision 0005
+SQLITE_CERTIFICATE_TRIGGERS = [
+    "CREATE TRIGGER IF NOT EXISTS certificates_fts_ai AFTER INSERT ON certificates BEGIN "
+    "INSERT INTO certificates_fts(rowid, name) VALUES (new.id, new.name); END",
+    "CREATE TRIGGER IF NOT EXISTS certificates_fts_ad AFTER DELETE ON certificates BEGIN "
+    "INSERT INTO certificates_fts(certificates_fts, rowid, name) VALUES ('delete', old.id, old.name); END",
+    "CREATE TRIGGER IF NOT EXISTS certificates_fts_au AFTER UPDATE OF name ON certificates BEGIN "
+    "INSERT INTO certificates_fts(certificates_fts, rowid, name) VALUES ('delete', old.id, old.name); "
+    "INSERT INTO certificates_fts(rowid, name) VALUES (new.id, new.name); END",
+]
+
+
+def _restore_sqlite_triggers():
+    if op.get_context().dialect.name == 'sqlite':
+        for statement in SQLITE_CERTIFICATE_TRIGGERS:
+            op.execute(statement)
+
+
+def upgrade():
+    op.create_table('certificate_blobs',
+    sa.Column('fingerprint', sa.String(length=64), nullable=False),
+    sa.Column('file_name', sa.String(length=255), nullable=False),
+    sa.Column('size', sa.Integer(), nullable=False),
+    sa.Column('parsed_metadata', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('fingerprint')
+    )
+    with op.batch_alter_table('certificates', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('fingerprint', sa.String(length=64), nullable=True))
+        batch_op.create_foreign_key('fk_certificates_fingerprint', 'certificate_blobs', ['fingerprint'], ['fingerprint'])
+    _restore_sqlite_triggers()
+
+    if op.get_context().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.create_index('ix_certificates_organization_id_fingerprint', 'certificates',
+                            ['organization_id', 'fingerprint'], unique=False,
+                            postgresql_concurrently=True, if_not_exists=True)
+    else:
+        op.create_index('ix_certificates_organization_id_fingerprint', 'certificates',
+                        ['organization_id', 'fingerprint'], unique=False, if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_certificates_organization_id_fingerprint', table_name='certificates', if_exists=True)
+    with op.batch_alter_table('certificates', schema=None) as batch_op:
+        batch_op.drop_constraint('fk_certificates_fingerprint', type_='foreignkey')
+        batch_op.drop_column('fingerprint')
+    _restore_sqlite_triggers()
+
+    op.drop_table('certificate_blobs')
@@ -0,0 +1,29 @@
+"""certificate storage keys
+
+Records the S3 object key of stored certificate files. Blobs without a key
+stay on the local disk, so existing files need no migration.
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18 11:32:09.085591
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('certificate_blobs', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('s3_key', sa.String(length=255), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('certificate_blobs', schema=None) as batch_op:
+        batch_op.drop_column('s3_key')
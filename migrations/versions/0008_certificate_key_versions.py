@@ -0,0 +1,62 @@
+"""certificate key versions
+
+Tags each encrypted certificate password with the version of the key that
+encrypted it. Existing passwords were encrypted with
+CERTIFICATE_ENCRYPTION_KEY, version 1; rotating keys afterwards is done
+online with `flask keys rotate`.
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18 11:36:42.002227
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+
+# Recreating the table on SQLite drops the search triggers of revision 0005
+SQLITE_CERTIFICATE_TRIGGERS = [
+    "CREATE TRIGGER IF NOT EXISTS certificates_fts_ai AFTER INSERT ON certificates BEGIN "
+    "INSERT INTO certificates_fts(rowid, name) VALUES (new.id, new.name); END",
+    "CREATE TRIGGER IF NOT EXISTS certificates_fts_ad AFTER DELETE ON certificates BEGIN "
+    "INSERT INTO certificates_fts(certificates_fts, rowid, name) VALUES ('delete', old.id, old.name); END",
+    "CREATE TRIGGER IF NOT EXISTS certificates_fts_au AFTER UPDATE OF name ON certificates BEGIN "
+    "INSERT INTO certificates_fts(certificates_fts, rowid, name) VALUES ('delete', old.id, old.name); "
+    "INSERT INTO certificates_fts(rowid, name) VALUES (new.id, new.name); END",
+]
+
+
+def _restore_sqlite_triggers():
+    if op.get_context().dialect.name == 'sqlite':
+        for statement in SQLITE_CERTIFICATE_TRIGGERS:
+            op.execute(statement)
+
+
+def upgrade():
+    with op.batch_alter_table('certificates', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('key_version', sa.Integer(), nullable=True))
+    _restore_sqlite_triggers()
+
+    op.execute("UPDATE certificates SET key_version = 1 WHERE encrypted_password IS NOT NULL")
+
+    if op.get_context().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.create_index('ix_certificates_key_version', 'certificates', ['key_version'], unique=False,
+                            postgresql_concurrently=True, if_not_exists=True)
+    else:
+        op.create_index('ix_certificates_key_version', 'certificates', ['key_version'], unique=False,
+                        if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_certificates_key_version', table_name='certificates', if_exists=True)
+    with op.batch_alter_table('certificates', schema=None) as batch_op:
+        batch_op.drop_column('key_version')
+    _restore_sqlite_triggers()
@@ -1,14 +1,17 @@
 from datetime import datetime
+import re
 import uuid
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Text, Date, LargeBinary
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Text, Date, LargeBinary, event, inspect, select, update
+from sqlalchemy.orm import Session, relationship
 from app import db, login_manager
+from identity import identity_cache
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # Snapshot from the per-process identity cache; see identity.py
+    return identity_cache.load(int(user_id))
 
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
@@ -33,6 +36,11 @@ class User(UserMixin, db.Model):
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
         
+    @property
+    def db_user(self):
+        """The row itself; matches `CachedUser.db_user` for views editing current_user"""
+        return self
+    
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
@@ -77,11 +85,16 @@ class Group(db.Model):
 
 class Company(db.Model):
     __tablename__ = 'companies'
+    __table_args__ = (
+        db.Index('ix_companies_organization_id_name', 'organization_id', 'name'),
+        db.Index('ix_companies_organization_id_cnpj_digits', 'organization_id', 'cnpj_digits'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     trade_name = db.Column(db.String(100), nullable=True)
     cnpj = db.Column(db.String(18), nullable=False)
+    cnpj_digits = db.Column(db.String(14), nullable=False)  # CNPJ without punctuation, for prefix search
     organization_id = db.Column(db.Integer, db.ForeignKey('organizations.id'), nullable=False)
     group_id = db.Column(db.Integer, db.ForeignKey('groups.id'), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -97,15 +110,26 @@ class Company(db.Model):
 
 class Certificate(db.Model):
     __tablename__ = 'certificates'
+    __table_args__ = (
+        db.Index('ix_certificates_company_id_expiry_date', 'company_id', 'expiry_date'),
+        db.Index('ix_certificates_organization_id_expiry_date', 'organization_id', 'expiry_date', 'id'),
+        db.Index('ix_certificates_organization_id_fingerprint', 'organization_id', 'fingerprint'),
+        db.Index('ix_certificates_key_version', 'key_version'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     type = db.Column(db.String(20), nullable=False)  # e-cnpj, e-cpf
     file_name = db.Column(db.String(255), nullable=False)
+    # SHA-256 of the file; certificates with the same content share one blob
+    fingerprint = db.Column(db.String(64), db.ForeignKey('certificate_blobs.fingerprint'), nullable=True)
     encrypted_password = db.Column(db.LargeBinary, nullable=True)
     iv = db.Column(db.LargeBinary, nullable=True)  # Initialization vector for AES
+    key_version = db.Column(db.Integer, nullable=True)  # Key ring version of encrypted_password
     s3_key = db.Column(db.String(255), nullable=True)
     company_id = db.Column(db.Integer, db.ForeignKey('companies.id'), nullable=False)
+    # Copy of company.organization_id, kept in sync by the listeners below
+    organization_id = db.Column(db.Integer, db.ForeignKey('organizations.id'), nullable=False)
     issue_date = db.Column(db.Date, nullable=False)
     expiry_date = db.Column(db.Date, nullable=False)
     created_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -115,18 +139,105 @@ class Certificate(db.Model):
     # Relationships
     company = relationship("Company", back_populates="certificates")
     creator = relationship("User", foreign_keys=[created_by])
+    blob = relationship("CertificateBlob")
+    alerts = relationship("CertificateAlert", back_populates="certificate",
+                          cascade="all, delete-orphan", passive_deletes=True)
     
     def __repr__(self):
         return f'<Certificate {self.name}>'
 
+class CertificateBlob(db.Model):
+    """A stored certificate file, shared by every certificate with the same content"""
+    __tablename__ = 'certificate_blobs'
+    
+    fingerprint = db.Column(db.String(64), primary_key=True)  # SHA-256, hex
+    file_name = db.Column(db.String(255), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    # Object key when stored in S3; files without one are on the local disk
+    s3_key = db.Column(db.String(255), nullable=True)
+    # JSON of certificate_files.parse_certificate_file, filled on the first parse
+    parsed_metadata = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<CertificateBlob {self.fingerprint[:12]}>'
+
+class CertificateAlert(db.Model):
+    __tablename__ = 'certificate_alerts'
+    __table_args__ = (
+        db.UniqueConstraint('certificate_id', 'threshold_days', 'expiry_date',
+                            name='uq_certificate_alerts_certificate_threshold'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    certificate_id = db.Column(db.Integer, db.ForeignKey('certificates.id', ondelete='CASCADE'), nullable=False)
+    organization_id = db.Column(db.Integer, db.ForeignKey('organizations.id'), nullable=False)
+    threshold_days = db.Column(db.Integer, nullable=False)  # 30, 15, 5
+    expiry_date = db.Column(db.Date, nullable=False)  # Expiry date the alert was sent for
+    sent_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Relationships
+    certificate = relationship("Certificate", back_populates="alerts")
+    
+    def __repr__(self):
+        return f'<CertificateAlert {self.certificate_id} {self.threshold_days}d>'
+
+class MailOutbox(db.Model):
+    __tablename__ = 'mail_outbox'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(100), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    html = db.Column(db.Text, nullable=False)
+    dedup_key = db.Column(db.String(255), unique=True, nullable=True)  # One message per key and recipient
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, sending, sent, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    claim_token = db.Column(db.String(36), nullable=True)  # Worker batch currently sending it
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f'<MailOutbox {self.recipient} {self.status}>'
+
+class OrganizationCertificateStats(db.Model):
+    __tablename__ = 'organization_certificate_stats'
+    
+    organization_id = db.Column(db.Integer, db.ForeignKey('organizations.id'), primary_key=True)
+    total_certificates = db.Column(db.Integer, nullable=False, default=0)
+    ecnpj_count = db.Column(db.Integer, nullable=False, default=0)
+    ecpf_count = db.Column(db.Integer, nullable=False, default=0)
+    # Expiry buckets relative to as_of: expired (<= as_of), 30d (as_of, +30],
+    # 60d (+30, +60] and 90d (+60, +90]
+    expired_count = db.Column(db.Integer, nullable=False, default=0)
+    expiring_30d = db.Column(db.Integer, nullable=False, default=0)
+    expiring_60d = db.Column(db.Integer, nullable=False, default=0)
+    expiring_90d = db.Column(db.Integer, nullable=False, default=0)
+    as_of = db.Column(db.Date, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    # Relationships
+    organization = relationship("Organization")
+    
+    def __repr__(self):
+        return f'<OrganizationCertificateStats {self.organization_id}>'
+
 class AuditLog(db.Model):
     __tablename__ = 'audit_logs'
+    __table_args__ = (
+        db.Index('ix_audit_logs_user_id_created_at', 'user_id', 'created_at'),
+        db.Index('ix_audit_logs_organization_id_created_at', 'organization_id', 'created_at', 'id'),
+        db.Index('ix_audit_logs_created_at', 'created_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     action = db.Column(db.String(100), nullable=False)
     details = db.Column(db.Text, nullable=True)
     ip_address = db.Column(db.String(45), nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    # Organization of the user when the event was logged
+    organization_id = db.Column(db.Integer, db.ForeignKey('organizations.id'), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
@@ -135,8 +246,41 @@ class AuditLog(db.Model):
     def __repr__(self):
         return f'<AuditLog {self.action}>'
 
+class AuditArchiveSegment(db.Model):
+    """Compressed JSONL file holding one month of an organization's audit logs"""
+    __tablename__ = 'audit_archive_segments'
+    __table_args__ = (
+        db.UniqueConstraint('organization_id', 'month', name='uq_audit_archive_segments_organization_month'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    organization_id = db.Column(db.Integer, db.ForeignKey('organizations.id', ondelete='CASCADE'), nullable=True)
+    month = db.Column(db.Date, nullable=False)  # first day of the month
+    path = db.Column(db.String(255), nullable=False)  # relative to AUDIT_ARCHIVE_DIR
+    row_count = db.Column(db.Integer, nullable=False, default=0)
+    first_created_at = db.Column(db.DateTime, nullable=True)
+    last_created_at = db.Column(db.DateTime, nullable=True)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<AuditArchiveSegment {self.organization_id} {self.month}>'
+
+class AuditActionCatalog(db.Model):
+    """Distinct audit actions seen per organization, for the log filters"""
+    __tablename__ = 'audit_action_catalog'
+    
+    organization_id = db.Column(db.Integer, db.ForeignKey('organizations.id', ondelete='CASCADE'), primary_key=True)
+    action = db.Column(db.String(100), primary_key=True)
+    first_seen_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<AuditActionCatalog {self.organization_id} {self.action}>'
+
 class UserInvite(db.Model):
     __tablename__ = 'user_invites'
+    __table_args__ = (
+        db.Index('ix_user_invites_email_organization_id', 'email', 'organization_id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(100), nullable=False)
@@ -158,3 +302,148 @@ class UserInvite(db.Model):
     
     def __repr__(self):
         return f'<UserInvite {self.email}>'
+
+
+def normalize_cnpj(value):
+    """Return only the digits of a CNPJ"""
+    return re.sub(r'\D', '', value or '')
+
+
+@event.listens_for(Company, 'before_insert')
+@event.listens_for(Company, 'before_update')
+def _set_cnpj_digits(mapper, connection, target):
+    target.cnpj_digits = normalize_cnpj(target.cnpj)
+
+
+# Denormalized organization_id consistency
+@event.listens_for(Session, 'before_flush')
+def _sync_organization_ids(session, flush_context, instances):
+    """Keep Certificate.organization_id equal to its company's organization
+
+    Covers new certificates, certificates moved to another company and
+    companies moved to another organization.
+    """
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Certificate):
+            state = inspect(obj)
+            moved_by_relationship = state.attrs.company.history.has_changes()
+            moved = moved_by_relationship or state.attrs.company_id.history.has_changes()
+            if obj.organization_id is not None and not moved:
+                continue
+            if moved_by_relationship and obj.company is not None:
+                obj.organization_id = obj.company.organization_id
+            elif obj.company_id is not None:
+                obj.organization_id = session.execute(
+                    select(Company.organization_id).where(Company.id == obj.company_id)
+                ).scalar()
+        elif isinstance(obj, Company) and obj in session.dirty:
+            history = inspect(obj).attrs.organization_id.history
+            if history.has_changes() and history.deleted:
+                # The bulk update bypasses _record_certificate_edits, so the
+                # stats of both organizations are shifted here
+                moved = session.execute(
+                    select(Certificate.type, Certificate.expiry_date)
+                    .where(Certificate.company_id == obj.id)
+                ).all()
+                session.execute(
+                    update(Certificate)
+                    .where(Certificate.company_id == obj.id)
+                    .values(organization_id=obj.organization_id)
+                    .execution_options(synchronize_session='fetch')
+                )
+                if moved:
+                    from stats import shift_certificate_stats
+
+                    changes = []
+                    for cert_type, expiry_date in moved:
+                        changes.append((history.deleted[0], cert_type, expiry_date, -1))
+                        changes.append((obj.organization_id, cert_type, expiry_date, 1))
+                    shift_certificate_stats(changes)
+                    session.info.setdefault('changed_stats_organization_ids', set()).update(
+                        (history.deleted[0], obj.organization_id)
+                    )
+
+
+# Certificate stats read model
+@event.listens_for(Session, 'before_flush')
+def _record_certificate_edits(session, flush_context, instances):
+    """Shift the stats read model for certificates edited in place
+
+    Uploads and deletions are recorded by the code making them (see
+    stats.record_certificate_changes); this covers an existing certificate
+    whose type, expiry date or organization changes. Runs after
+    _sync_organization_ids, so organization moves are already applied.
+    """
+    changes = []
+    for obj in session.dirty:
+        if not isinstance(obj, Certificate):
+            continue
+        state = inspect(obj)
+        previous = {}
+        for key in ('organization_id', 'type', 'expiry_date'):
+            history = state.attrs[key].history
+            if history.has_changes():
+                # An attribute changed before it was loaded has no old value
+                previous[key] = history.deleted[0] if history.deleted else None
+        if not previous:
+            continue
+        changes.append((
+            previous.get('organization_id') or obj.organization_id,
+            previous.get('type', obj.type),
+            previous.get('expiry_date', obj.expiry_date),
+            -1
+        ))
+        changes.append((obj.organization_id, obj.type, obj.expiry_date, 1))
+
+    if changes:
+        from stats import shift_certificate_stats
+
+        shift_certificate_stats(changes)
+        session.info.setdefault('changed_stats_organization_ids', set()).update(
+            organization_id for organization_id, *_ in changes
+        )
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_certificate_caches(session):
+    changed = session.info.pop('changed_stats_organization_ids', None)
+    if changed:
+        from stats import invalidate_certificate_caches
+
+        for organization_id in changed:
+            invalidate_certificate_caches(organization_id)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_certificate_edits(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop('changed_stats_organization_ids', None)
+
+
+@event.listens_for(AuditLog, 'before_insert')
+def _set_audit_log_organization(mapper, connection, target):
+    if target.organization_id is None and target.user_id is not None:
+        target.organization_id = connection.execute(
+            select(User.organization_id).where(User.id == target.user_id)
+        ).scalar()
+
+
+# Identity cache invalidation
+@event.listens_for(Session, 'after_flush')
+def _collect_changed_users(session, flush_context):
+    changed = {obj.id for obj in list(session.dirty) + list(session.deleted) if isinstance(obj, User)}
+    if changed:
+        session.info.setdefault('changed_user_ids', set()).update(changed)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_changed_users(session):
+    changed = session.info.pop('changed_user_ids', None)
+    if changed:
+        identity_cache.invalidate(*changed)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_changed_users(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop('changed_user_ids', None)
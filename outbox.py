@@ -0,0 +1,225 @@
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import AppGroup
+from flask_mail import Message
+from sqlalchemy import or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db, mail
+from background import PeriodicFlusher
+from models import MailOutbox
+
+logger = logging.getLogger(__name__)
+
+# Cumulative delivery counters for this process
+outbox_metrics = {
+    'sent': 0,
+    'retried': 0,
+    'failed': 0,
+    'batches': 0,
+    'seconds': 0.0,
+}
+_metrics_lock = threading.Lock()
+
+
+def outbox_metrics_snapshot():
+    """Copy of this process's delivery counters"""
+    with _metrics_lock:
+        return dict(outbox_metrics)
+
+
+def enqueue_mail(recipients, subject, html, dedup_key=None):
+    """Queue one message per recipient in the outbox
+
+    Rows are added to the current session, so they are committed (or rolled
+    back) together with the caller's transaction. With a dedup_key, a
+    recipient who already has a message for that key is skipped.
+    Returns the number of messages queued.
+    """
+    queued = 0
+    for recipient in recipients:
+        key = f"{dedup_key}:{recipient}" if dedup_key else None
+        if key and db.session.execute(
+            select(MailOutbox.id).where(MailOutbox.dedup_key == key)
+        ).first():
+            continue
+        try:
+            with db.session.begin_nested():
+                db.session.add(MailOutbox(
+                    recipient=recipient,
+                    subject=subject,
+                    html=html,
+                    dedup_key=key
+                ))
+            queued += 1
+        except IntegrityError:
+            # Queued concurrently by another transaction
+            continue
+
+    if queued and app.config.get('MAIL_OUTBOX_BACKGROUND', True):
+        _drainer.ensure_started()
+    return queued
+
+
+def _claim_batch(batch_size, lease):
+    """Mark a batch of due messages as being sent and return them"""
+    now = datetime.utcnow()
+    ids = db.session.execute(
+        select(MailOutbox.id)
+        .where(
+            or_(MailOutbox.status == 'pending', MailOutbox.status == 'sending'),
+            MailOutbox.next_attempt_at <= now
+        )
+        .order_by(MailOutbox.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    ).scalars().all()
+    if not ids:
+        db.session.commit()
+        return []
+
+    # The lease makes messages of a worker that died retryable later
+    token = str(uuid.uuid4())
+    db.session.execute(
+        update(MailOutbox)
+        .where(MailOutbox.id.in_(ids), MailOutbox.next_attempt_at <= now)
+        .values(status='sending', claim_token=token,
+                next_attempt_at=now + timedelta(seconds=lease))
+    )
+    db.session.commit()
+    return MailOutbox.query.filter_by(claim_token=token).order_by(MailOutbox.id).all()
+
+
+def _schedule_retry(message, error):
+    max_attempts = app.config.get('MAIL_OUTBOX_MAX_ATTEMPTS', 5)
+    base = app.config.get('MAIL_OUTBOX_RETRY_BACKOFF', 60)
+
+    message.attempts += 1
+    message.claim_token = None
+    message.last_error = str(error)[:1000]
+    if message.attempts >= max_attempts:
+        message.status = 'failed'
+        return 'failed'
+    message.status = 'pending'
+    message.next_attempt_at = datetime.utcnow() + timedelta(seconds=base * 2 ** (message.attempts - 1))
+    return 'retried'
+
+
+def drain_outbox(batch_size=None):
+    """Send a batch of due messages over a single SMTP connection
+
+    Returns a dict with the number of messages sent, retried and failed and
+    the throughput of the batch.
+    """
+    batch_size = batch_size or app.config.get('MAIL_OUTBOX_BATCH_SIZE', 100)
+    lease = app.config.get('MAIL_OUTBOX_LEASE', 600)
+    result = {'sent': 0, 'retried': 0, 'failed': 0}
+
+    started = time.monotonic()
+    messages = _claim_batch(batch_size, lease)
+    if not messages:
+        return dict(result, seconds=0.0, per_second=0.0)
+
+    try:
+        with mail.connect() as connection:
+            for message in messages:
+                try:
+                    connection.send(Message(
+                        subject=message.subject,
+                        recipients=[message.recipient],
+                        html=message.html
+                    ))
+                except Exception as e:
+                    logger.warning(f"Failed to send outbox message {message.id}: {str(e)}")
+                    result[_schedule_retry(message, e)] += 1
+                else:
+                    message.status = 'sent'
+                    message.claim_token = None
+                    message.sent_at = datetime.utcnow()
+                    message.last_error = None
+                    result['sent'] += 1
+    except Exception as e:
+        # Could not open (or lost) the SMTP session: retry the unsent rest
+        logger.error(f"SMTP connection failed: {str(e)}")
+        for message in messages:
+            if message.status == 'sending':
+                result[_schedule_retry(message, e)] += 1
+    db.session.commit()
+
+    elapsed = time.monotonic() - started
+    with _metrics_lock:
+        for key, value in result.items():
+            outbox_metrics[key] += value
+        outbox_metrics['batches'] += 1
+        outbox_metrics['seconds'] += elapsed
+
+    result['seconds'] = elapsed
+    result['per_second'] = result['sent'] / elapsed if elapsed else 0.0
+    logger.info(
+        f"Outbox batch: {result['sent']} sent, {result['retried']} retried, "
+        f"{result['failed']} failed ({result['per_second']:.1f} msg/s)"
+    )
+    return result
+
+
+def drain_all():
+    """Drain batches until no due message is left"""
+    totals = {'sent': 0, 'retried': 0, 'failed': 0}
+    while True:
+        result = drain_outbox()
+        for key in totals:
+            totals[key] += result[key]
+        if not (result['sent'] or result['retried'] or result['failed']):
+            return totals
+
+
+def _drain_in_background():
+    with app.app_context():
+        drain_all()
+
+
+# In-process drainer for deployments without a dedicated outbox worker
+_drainer = PeriodicFlusher(
+    'mail-outbox-drainer',
+    _drain_in_background,
+    app.config.get('MAIL_OUTBOX_POLL_INTERVAL', 10),
+    flush_on_exit=False,
+)
+
+
+# CLI commands
+outbox_cli = AppGroup('outbox', help='Fila de envio de emails.')
+
+
+@outbox_cli.command('drain')
+def drain_command():
+    """Send every due message once."""
+    totals = drain_all()
+    click.echo(
+        f"{totals['sent']} enviado(s), {totals['retried']} reagendado(s), "
+        f"{totals['failed']} com falha."
+    )
+
+
+@outbox_cli.command('worker')
+@click.option('--interval', type=int, default=5, show_default=True,
+              help='Intervalo entre verificações da fila, em segundos.')
+def worker_command(interval):
+    """Drain the outbox continuously."""
+    while True:
+        try:
+            drain_all()
+        except Exception:
+            db.session.rollback()
+            logger.exception("Outbox drain failed")
+        finally:
+            db.session.remove()
+        time.sleep(interval)
+
+
+app.cli.add_command(outbox_cli)
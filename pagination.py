@@ -0,0 +1,218 @@
+import base64
+import hashlib
+import json
+from datetime import date, datetime
+
+from sqlalchemy import func, select, text, tuple_
+
+from app import db
+
+# Upper bound for the cheap total on databases without planner estimates
+ESTIMATE_CAP = 1000
+
+
+class KeysetPage:
+    """One page of a keyset-paginated query"""
+
+    def __init__(self, items, per_page, next_cursor=None, prev_cursor=None,
+                 total=None, total_is_estimate=False):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+        self.total_is_estimate = total_is_estimate
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def _filters_fingerprint(filters):
+    payload = json.dumps(filters or {}, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:12]
+
+
+def _dump_value(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def _load_value(column, raw):
+    python_type = column.type.python_type
+    if python_type is datetime:
+        return datetime.fromisoformat(raw)
+    if python_type is date:
+        return date.fromisoformat(raw)
+    return python_type(raw)
+
+
+def _encode(payload, filters):
+    payload = dict(payload, f=_filters_fingerprint(filters))
+    raw = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def _decode(token, filters):
+    """Payload of a cursor, or None if malformed or built for other filters"""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        payload = json.loads(raw)
+        if payload['f'] != _filters_fingerprint(filters):
+            return None
+    except (ValueError, KeyError, TypeError):
+        return None
+    return payload
+
+
+def encode_cursor(values, direction, filters=None):
+    """Build an opaque cursor for the row with the given key values"""
+    return _encode({'k': [_dump_value(value) for value in values], 'd': direction}, filters)
+
+
+def decode_cursor(token, columns, filters=None):
+    """Return (key values, direction) for a cursor, or None if unusable
+
+    A cursor built for a different set of filters is ignored, so changing a
+    filter always restarts from the first page.
+    """
+    payload = _decode(token, filters)
+    if payload is None:
+        return None
+    try:
+        if payload['d'] not in ('next', 'prev') or len(payload['k']) != len(columns):
+            return None
+        values = [_load_value(column, value) for column, value in zip(columns, payload['k'])]
+    except (ValueError, KeyError, TypeError):
+        return None
+    return values, payload['d']
+
+
+def estimate_count(query):
+    """Return (total, is_estimate) for a query without a full count
+
+    PostgreSQL answers from the planner's row estimate; other databases count
+    at most ESTIMATE_CAP rows.
+    """
+    statement = query.order_by(None).statement
+    if db.engine.dialect.name == 'postgresql':
+        compiled = statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True})
+        plan = db.session.execute(text(f'EXPLAIN (FORMAT JSON) {compiled}')).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows']), True
+
+    capped = statement.limit(ESTIMATE_CAP + 1).subquery()
+    total = db.session.execute(select(func.count()).select_from(capped)).scalar()
+    if total > ESTIMATE_CAP:
+        return ESTIMATE_CAP, True
+    return total, False
+
+
+def keyset_paginate(query, columns, cursor=None, per_page=50, descending=False,
+                    filters=None, with_total=False, tail=None):
+    """Paginate an ORM query on a unique, ordered key
+
+    `columns` are the key columns (e.g. expiry date then id, which makes the
+    key unique); the query is ordered by them in the requested direction and
+    each page starts strictly after (or before) the cursor row, so the cost
+    of a page does not depend on how deep it is.
+
+    `tail` optionally continues the listing past the end of the query with
+    rows from another source whose keys all sort after the query's (e.g.
+    archived rows). It is called as `tail(values, backwards, limit)` and
+    returns up to `limit` items beyond `values`, in the order walked.
+    """
+    decoded = decode_cursor(cursor, columns, filters)
+    values, direction = decoded if decoded else (None, 'next')
+
+    # Walking backwards reverses both the comparison and the ordering
+    backwards = direction == 'prev'
+    reverse = descending != backwards
+
+    page_query = query
+    if values is not None:
+        key = tuple_(*columns)
+        page_query = page_query.filter(key < tuple_(*values) if reverse else key > tuple_(*values))
+    page_query = page_query.order_by(
+        None
+    ).order_by(*[column.desc() if reverse else column.asc() for column in columns])
+
+    def key_of(item):
+        return [getattr(item, column.key) for column in columns]
+
+    limit = per_page + 1
+    if tail is None:
+        items = page_query.limit(limit).all()
+    elif not backwards:
+        items = page_query.limit(limit).all()
+        if len(items) < limit:
+            after = key_of(items[-1]) if items else values
+            items += tail(after, False, limit - len(items))
+    else:
+        # Walking back from the tail reaches the query's rows last
+        items = tail(values, True, limit)
+        if len(items) < limit:
+            items += page_query.limit(limit - len(items)).all()
+
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    if backwards:
+        items.reverse()
+
+    next_cursor = prev_cursor = None
+    if items:
+        if has_more if not backwards else values is not None:
+            next_cursor = encode_cursor(key_of(items[-1]), 'next', filters)
+        if has_more if backwards else values is not None:
+            prev_cursor = encode_cursor(key_of(items[0]), 'prev', filters)
+
+    total, total_is_estimate = (None, False)
+    if with_total:
+        total, total_is_estimate = estimate_count(query)
+
+    return KeysetPage(items, per_page, next_cursor, prev_cursor, total, total_is_estimate)
+
+
+def ranked_paginate(query, key_column, ids, cursor=None, per_page=50, filters=None, truncated=False):
+    """Paginate rows given by a precomputed, ranked list of ids
+
+    Used for search results, whose order (relevance) is not a key the
+    database can seek on: the ranked ids are bounded, so the cursor holds a
+    position in the list and each page loads only its own rows. `truncated`
+    marks the length of the list as a lower bound of the total.
+    """
+    payload = _decode(cursor, filters)
+    try:
+        offset = int(payload['o']) if payload is not None else 0
+    except (KeyError, TypeError, ValueError):
+        offset = 0
+    offset = min(max(offset, 0), len(ids))
+
+    page_ids = ids[offset:offset + per_page]
+    rows = {}
+    if page_ids:
+        rows = {getattr(item, key_column.key): item
+                for item in query.order_by(None).filter(key_column.in_(page_ids)).all()}
+    items = [rows[item_id] for item_id in page_ids if item_id in rows]
+
+    next_cursor = prev_cursor = None
+    if offset + per_page < len(ids):
+        next_cursor = _encode({'o': offset + per_page}, filters)
+    if offset > 0:
+        prev_cursor = _encode({'o': max(offset - per_page, 0)}, filters)
+
+    return KeysetPage(items, per_page, next_cursor, prev_cursor, len(ids), truncated)
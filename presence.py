@@ -0,0 +1,97 @@
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import case, update
+
+from app import db
+from background import PeriodicFlusher
+
+
+class ActivityTracker:
+    """Write-behind tracker for `User.last_active`
+
+    Activity is recorded in memory and throttled per user to at most one write
+    every LAST_ACTIVITY_WRITE_INTERVAL seconds. Pending timestamps are flushed
+    by a background thread in bulk `UPDATE ... WHERE id IN (...)` statements,
+    so authenticated requests no longer pay for an UPDATE and a commit.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.write_interval = 60
+        self.batch_size = 500
+        self._pending = {}
+        self._last_recorded = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.write_interval = app.config.get("LAST_ACTIVITY_WRITE_INTERVAL", 60)
+        self.batch_size = app.config.get("LAST_ACTIVITY_BATCH_SIZE", 500)
+        self._flusher = PeriodicFlusher(
+            "last-activity-flusher",
+            self.flush,
+            app.config.get("LAST_ACTIVITY_FLUSH_INTERVAL", 15),
+        )
+
+    def touch(self, user_id, when=None):
+        """Record activity for a user, skipping it if recorded recently"""
+        now = time.monotonic()
+        with self._lock:
+            last = self._last_recorded.get(user_id)
+            if last is not None and now - last < self.write_interval:
+                return False
+            self._last_recorded[user_id] = now
+            self._pending[user_id] = when or datetime.utcnow()
+            pending = len(self._pending)
+
+        self._flusher.ensure_started()
+        if pending >= self.batch_size:
+            self._flusher.wake()
+        return True
+
+    def forget(self, user_id):
+        """Drop pending activity for a user (e.g. after the user is deleted)"""
+        with self._lock:
+            self._pending.pop(user_id, None)
+            self._last_recorded.pop(user_id, None)
+
+    def flush(self):
+        """Write all pending timestamps to the database"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        from models import User
+
+        users = User.__table__
+        items = sorted(pending.items())
+        try:
+            with self.app.app_context():
+                with db.engine.begin() as connection:
+                    for start in range(0, len(items), self.batch_size):
+                        batch = dict(items[start:start + self.batch_size])
+                        connection.execute(
+                            update(users)
+                            .where(users.c.id.in_(list(batch)))
+                            .values(
+                                last_active=case(batch, value=users.c.id),
+                                # Activity is not a profile change
+                                updated_at=users.c.updated_at,
+                            )
+                        )
+        except Exception:
+            # Keep the timestamps for the next flush unless newer ones arrived
+            with self._lock:
+                for user_id, when in pending.items():
+                    self._pending.setdefault(user_id, when)
+            raise
+        return len(items)
+
+
+activity_tracker = ActivityTracker()
@@ -0,0 +1,72 @@
+from models import AuditLog, Certificate, Company, Group, User
+
+# Read-model projections for the list views
+#
+# Each function narrows a filtered ORM query down to the columns its listing
+# renders, joining the names of related rows. The results are SQLAlchemy
+# rows (named tuples): no identity map entries, no change tracking and no
+# binary columns such as Certificate.encrypted_password. The field names
+# match the model attributes, so keyset pagination and templates read them
+# the same way; related names are flattened (`company_name`, not
+# `company.name`).
+
+
+def certificate_rows(query):
+    """(id, name, type, issue_date, expiry_date, company_id, company_name)"""
+    return query.join(Company, Certificate.company_id == Company.id).with_entities(
+        Certificate.id,
+        Certificate.name,
+        Certificate.type,
+        Certificate.issue_date,
+        Certificate.expiry_date,
+        Certificate.company_id,
+        Company.name.label('company_name')
+    )
+
+
+def company_rows(query):
+    """(id, name, trade_name, cnpj, group_id, group_name); group_name is None
+    for companies without a group"""
+    return query.outerjoin(Group, Company.group_id == Group.id).with_entities(
+        Company.id,
+        Company.name,
+        Company.trade_name,
+        Company.cnpj,
+        Company.group_id,
+        Group.name.label('group_name')
+    )
+
+
+def user_rows(query):
+    """(id, name, email, role, mfa_enabled, last_login, last_active)"""
+    return query.with_entities(
+        User.id,
+        User.name,
+        User.email,
+        User.role,
+        User.mfa_enabled,
+        User.last_login,
+        User.last_active
+    )
+
+
+def audit_log_rows(query):
+    """(id, created_at, action, details, ip_address, user_id, user_name)
+
+    Same fields as `audit_archive.ArchivedAuditLog`, so archived months
+    continue the listing seamlessly.
+    """
+    return query.join(User, AuditLog.user_id == User.id).with_entities(
+        AuditLog.id,
+        AuditLog.created_at,
+        AuditLog.action,
+        AuditLog.details,
+        AuditLog.ip_address,
+        AuditLog.user_id,
+        User.name.label('user_name')
+    )
+
+
+def choices(query, model):
+    """(id, name) of the rows of a query, for filter dropdowns"""
+    return query.with_entities(model.id, model.name)
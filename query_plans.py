@@ -0,0 +1,173 @@
+import json
+import sys
+from datetime import date
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import select, text
+
+from app import app, db
+from models import AuditLog, Certificate, Company, UserInvite
+
+# Placeholder parameters; plans depend on the query shape, not on the values
+_ORGANIZATION_ID = 1
+_COMPANY_ID = 1
+_USER_ID = 1
+_TODAY = date(2000, 1, 1)
+
+
+def _certificates_listing():
+    # auth.certificates (first page) and the dashboard's expiring list
+    return (
+        select(Certificate)
+        .where(Certificate.organization_id == _ORGANIZATION_ID, Certificate.expiry_date >= _TODAY)
+        .order_by(Certificate.expiry_date, Certificate.id)
+        .limit(49)
+    )
+
+
+def _company_certificates():
+    # auth.certificates filtered by company
+    return (
+        select(Certificate)
+        .where(Certificate.organization_id == _ORGANIZATION_ID, Certificate.company_id == _COMPANY_ID)
+        .order_by(Certificate.expiry_date, Certificate.id)
+        .limit(49)
+    )
+
+
+def _companies_listing():
+    # auth.companies and the company filters
+    return (
+        select(Company)
+        .where(Company.organization_id == _ORGANIZATION_ID)
+        .order_by(Company.name)
+    )
+
+
+def _company_cnpj_search():
+    # search.search_companies with a CNPJ prefix
+    return (
+        select(Company)
+        .where(
+            Company.organization_id == _ORGANIZATION_ID,
+            Company.cnpj_digits >= '1234',
+            Company.cnpj_digits < '1234:'
+        )
+        .order_by(Company.cnpj_digits)
+    )
+
+
+def _certificate_duplicate():
+    # blobs.find_duplicate on every upload
+    return (
+        select(Certificate)
+        .where(Certificate.organization_id == _ORGANIZATION_ID, Certificate.fingerprint == '0' * 64)
+        .limit(1)
+    )
+
+
+def _audit_logs_listing():
+    # auth.audit_logs (first page) and the dashboard's recent activity
+    return (
+        select(AuditLog)
+        .where(AuditLog.organization_id == _ORGANIZATION_ID)
+        .order_by(AuditLog.created_at.desc(), AuditLog.id.desc())
+        .limit(51)
+    )
+
+
+def _user_audit_logs():
+    # auth.audit_logs filtered by user
+    return (
+        select(AuditLog)
+        .where(AuditLog.organization_id == _ORGANIZATION_ID, AuditLog.user_id == _USER_ID)
+        .order_by(AuditLog.created_at.desc(), AuditLog.id.desc())
+        .limit(51)
+    )
+
+
+def _pending_invite():
+    # auth.invite_user: existing invite for the same email
+    return (
+        select(UserInvite)
+        .where(
+            UserInvite.email == 'user@example.com',
+            UserInvite.organization_id == _ORGANIZATION_ID,
+            UserInvite.accepted.is_(False)
+        )
+        .limit(1)
+    )
+
+
+# name -> (statement builder, indexes of which the plan must use at least one)
+HOT_QUERIES = {
+    'certificates_listing': (_certificates_listing, ['ix_certificates_organization_id_expiry_date']),
+    'company_certificates': (_company_certificates, [
+        'ix_certificates_company_id_expiry_date',
+        'ix_certificates_organization_id_expiry_date',
+    ]),
+    'certificate_duplicate': (_certificate_duplicate, ['ix_certificates_organization_id_fingerprint']),
+    'companies_listing': (_companies_listing, ['ix_companies_organization_id_name']),
+    'company_cnpj_search': (_company_cnpj_search, ['ix_companies_organization_id_cnpj_digits']),
+    'audit_logs_listing': (_audit_logs_listing, ['ix_audit_logs_organization_id_created_at']),
+    'user_audit_logs': (_user_audit_logs, [
+        'ix_audit_logs_user_id_created_at',
+        'ix_audit_logs_organization_id_created_at',
+    ]),
+    'pending_invite': (_pending_invite, ['ix_user_invites_email_organization_id']),
+}
+
+
+def explain(statement):
+    """Return the database's query plan for a statement as text"""
+    dialect = db.engine.dialect
+    compiled = str(statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+
+    with db.engine.connect() as connection:
+        if dialect.name == 'postgresql':
+            # Small or empty tables are always scanned sequentially; disabling
+            # sequential scans shows whether an index is usable at all
+            with connection.begin():
+                connection.execute(text('SET LOCAL enable_seqscan = off'))
+                plan = connection.execute(text(f'EXPLAIN (FORMAT JSON) {compiled}')).scalar()
+            return plan if isinstance(plan, str) else json.dumps(plan)
+        if dialect.name == 'sqlite':
+            rows = connection.execute(text(f'EXPLAIN QUERY PLAN {compiled}')).all()
+            return '\n'.join(row[-1] for row in rows)
+        rows = connection.execute(text(f'EXPLAIN {compiled}')).all()
+        return '\n'.join(' '.join(str(value) for value in row) for row in rows)
+
+
+def check_query_plans():
+    """Return {name: (passed, expected indexes, plan)} for every hot query"""
+    results = {}
+    for name, (build, indexes) in HOT_QUERIES.items():
+        plan = explain(build())
+        results[name] = (any(index in plan for index in indexes), indexes, plan)
+    return results
+
+
+# CLI commands
+schema_cli = AppGroup('schema', help='Verificações do esquema do banco de dados.')
+
+
+@schema_cli.command('check-plans')
+@click.option('--verbose', is_flag=True, help='Exibe o plano de cada consulta.')
+def check_plans_command(verbose):
+    """Check that the hot queries use their composite indexes."""
+    failed = 0
+    for name, (passed, indexes, plan) in check_query_plans().items():
+        if passed:
+            click.echo(f'OK      {name}')
+        else:
+            failed += 1
+            click.echo(f'FALHOU  {name}: não usa {" nem ".join(indexes)}')
+        if verbose or not passed:
+            click.echo('        ' + plan.replace('\n', '\n        '))
+    if failed:
+        click.echo(f'{failed} consulta(s) sem o índice esperado.')
+        sys.exit(1)
+
+
+app.cli.add_command(schema_cli)
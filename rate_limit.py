@@ -0,0 +1,235 @@
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from flask import g, jsonify, render_template, request
+from flask_login import current_user
+
+logger = logging.getLogger(__name__)
+
+# Requests per minute of each user and of the whole organization, by plan
+PLAN_QUOTAS = {
+    'basic': (100, 300),
+    'premium': (300, 1000),
+    'enterprise': (1000, 5000),
+}
+
+# Endpoints whose POSTs are also limited per IP by RATE_LIMIT_LOGIN_PER_MINUTE
+LOGIN_ENDPOINTS = {'login', 'mfa_verify', 'register', 'accept_invite'}
+
+# Seconds an organization's plan is reused before it is read again
+PLAN_CACHE_TTL = 60
+
+# Buckets are pruned once every this many requests
+PRUNE_EVERY = 1000
+
+
+def _refill(state, capacity, rate, now):
+    """Tokens of a bucket at `now`; a bucket never seen before is full"""
+    if state is None:
+        return float(capacity)
+    tokens, updated = state
+    return min(float(capacity), tokens + max(0.0, now - updated) * rate)
+
+
+def _take(states, buckets, now):
+    """Apply one request to the buckets; all or none are debited
+
+    `states` maps keys to (tokens, updated). Returns (allowed, new states,
+    limits) where limits has (capacity, tokens left, seconds to refill,
+    seconds to the next token) per bucket.
+    """
+    levels = [(key, capacity, rate, _refill(states.get(key), capacity, rate, now))
+              for key, capacity, rate in buckets]
+    allowed = all(tokens >= 1 for _, _, _, tokens in levels)
+    new_states, limits = {}, []
+    for key, capacity, rate, tokens in levels:
+        if allowed:
+            tokens -= 1
+        new_states[key] = (tokens, now)
+        limits.append((capacity, tokens, (capacity - tokens) / rate, max(0.0, (1 - tokens) / rate)))
+    return allowed, new_states, limits
+
+
+class MemoryStore:
+    """Buckets of a single process (one worker, or tests)
+
+    Every worker process keeps its own buckets: with N gunicorn workers a
+    client may make up to N times the configured requests.
+    """
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._calls = 0
+
+    def consume(self, buckets, now):
+        with self._lock:
+            allowed, states, limits = _take(self._buckets, buckets, now)
+            self._buckets.update(states)
+            self._calls += 1
+            if self._calls % PRUNE_EVERY == 0:
+                self._prune(buckets, now)
+        return allowed, limits
+
+    def _prune(self, buckets, now):
+        # A bucket idle for a minute is full again: forgetting it changes nothing
+        self._buckets = {
+            key: state for key, state in self._buckets.items() if now - state[1] < 60
+        }
+
+
+class SQLiteStore:
+    """Buckets shared by the worker processes of one host in a SQLite file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._calls = 0
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS buckets '
+                '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)'
+            )
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def consume(self, buckets, now):
+        connection = self._connection()
+        keys = [key for key, _, _ in buckets]
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = connection.execute(
+                f"SELECT key, tokens, updated FROM buckets WHERE key IN ({', '.join('?' * len(keys))})",
+                keys
+            ).fetchall()
+            allowed, states, limits = _take({key: (tokens, updated) for key, tokens, updated in rows},
+                                            buckets, now)
+            connection.executemany(
+                'INSERT INTO buckets (key, tokens, updated) VALUES (?, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated',
+                [(key, tokens, updated) for key, (tokens, updated) in states.items()]
+            )
+            self._calls += 1
+            if self._calls % PRUNE_EVERY == 0:
+                connection.execute('DELETE FROM buckets WHERE updated < ?', (now - 60,))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return allowed, limits
+
+
+class RateLimiter:
+    """Token-bucket request limits per IP, user and organization
+
+    Every request takes one token from the bucket of its IP and, when
+    authenticated, from the buckets of its user and organization, sized by
+    the organization's plan (PLAN_QUOTAS, per minute). A request is refused
+    with 429 and Retry-After when any bucket is empty; the tightest bucket
+    is reported in the X-RateLimit-* headers. RATE_LIMIT_STORAGE selects
+    in-process buckets ("memory") or a SQLite file shared by the gunicorn
+    workers of the host ("sqlite").
+    """
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.store = None
+        self.ip_per_minute = 300
+        self.login_per_minute = 10
+        self._plans = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get("RATE_LIMIT_ENABLED", True)
+        self.ip_per_minute = app.config.get("RATE_LIMIT_IP_PER_MINUTE", 300)
+        self.login_per_minute = app.config.get("RATE_LIMIT_LOGIN_PER_MINUTE", 10)
+        if app.config.get("RATE_LIMIT_STORAGE", "memory") == "sqlite":
+            self.store = SQLiteStore(app.config.get("RATE_LIMIT_SQLITE_PATH") or os.path.join(
+                app.instance_path, "rate_limit.db"
+            ))
+        else:
+            self.store = MemoryStore()
+        app.before_request(self.check)
+        app.after_request(self.add_headers)
+
+    def _plan(self, organization_id):
+        """An organization's plan, cached for PLAN_CACHE_TTL seconds"""
+        now = time.monotonic()
+        cached = self._plans.get(organization_id)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
+        from app import db
+        from models import Organization
+
+        plan = db.session.query(Organization.plan).filter(Organization.id == organization_id).scalar()
+        self._plans[organization_id] = (plan, now + PLAN_CACHE_TTL)
+        return plan
+
+    def buckets(self):
+        """(key, capacity, tokens per second) of the current request"""
+        per_minute = lambda limit: limit / 60.0
+        ip = request.remote_addr or 'unknown'
+        buckets = [(f'ip:{ip}', self.ip_per_minute, per_minute(self.ip_per_minute))]
+        if request.method == 'POST' and request.endpoint in LOGIN_ENDPOINTS:
+            buckets.append((f'login:{ip}', self.login_per_minute, per_minute(self.login_per_minute)))
+        if current_user.is_authenticated:
+            organization_id = current_user.organization_id
+            user_limit, organization_limit = PLAN_QUOTAS.get(
+                self._plan(organization_id) if organization_id else None, PLAN_QUOTAS['basic']
+            )
+            buckets.append((f'user:{current_user.id}', user_limit, per_minute(user_limit)))
+            if organization_id:
+                buckets.append((f'org:{organization_id}', organization_limit, per_minute(organization_limit)))
+        return buckets
+
+    def check(self):
+        if not self.enabled or request.endpoint == 'static':
+            return None
+
+        now = time.time()
+        try:
+            allowed, limits = self.store.consume(self.buckets(), now)
+        except Exception as e:
+            # Never take the application down with the limiter
+            logger.warning(f"Rate limit store unavailable: {str(e)}")
+            return None
+
+        capacity, tokens, to_full, to_next = min(limits, key=lambda limit: limit[1] / limit[0])
+        g.rate_limit = (capacity, max(0, int(tokens)), int(math.ceil(now + to_full)))
+        if allowed:
+            return None
+
+        retry_after = int(math.ceil(max(limit[3] for limit in limits if limit[1] < 1)))
+        g.rate_limit_retry_after = max(1, retry_after)
+        message = 'Muitas requisições. Tente novamente em alguns instantes.'
+        if request.path.startswith('/api/') or request.accept_mimetypes.best == 'application/json':
+            return jsonify({'error': message}), 429
+        return render_template('error.html', error=429, message=message), 429
+
+    def add_headers(self, response):
+        limit = g.pop('rate_limit', None)
+        if limit is not None:
+            response.headers['X-RateLimit-Limit'] = str(limit[0])
+            response.headers['X-RateLimit-Remaining'] = str(limit[1])
+            response.headers['X-RateLimit-Reset'] = str(limit[2])
+        retry_after = g.pop('rate_limit_retry_after', None)
+        if retry_after is not None:
+            response.headers['Retry-After'] = str(retry_after)
+        return response
+
+
+rate_limiter = RateLimiter()
@@ -17,7 +17,7 @@ from forms import (
 )
 from utils import (
     encrypt_certificate_password, decrypt_certificate_password, 
-    upload_certificate_to_s3, log_audit, check_for_expiring_certificates
+    upload_certificate_to_s3, log_audit
 )
 
 logger = logging.getLogger(__name__)
@@ -611,14 +611,3 @@ def page_not_found(e):
 @app.errorhandler(500)
 def internal_server_error(e):
     return render_template('errors/500.html'), 500
-
-# Scheduled task to check for expiring certificates
-@app.before_request
-def before_request():
-    # Run once a day
-    now = datetime.utcnow()
-    last_check = app.config.get('LAST_CERTIFICATE_CHECK')
-    
-    if not last_check or (now - last_check).days >= 1:
-        check_for_expiring_certificates()
-        app.config['LAST_CERTIFICATE_CHECK'] = now
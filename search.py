@@ -0,0 +1,224 @@
+import logging
+import re
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import func, literal_column, or_, table, column, text
+from sqlalchemy.exc import SQLAlchemyError
+
+from app import app, db
+from models import Certificate, Company, normalize_cnpj
+
+logger = logging.getLogger(__name__)
+
+# Ranked matches loaded for a search; refining the term narrows the list
+SEARCH_RESULT_LIMIT = 500
+
+# Terms made only of digits and CNPJ punctuation are looked up by CNPJ prefix
+_CNPJ_TERM = re.compile(r'^[\d\s./-]+$')
+
+# Shortest CNPJ prefix worth an index lookup
+_CNPJ_MIN_DIGITS = 2
+
+# SQLite: FTS5 external-content tables kept in sync by triggers
+SQLITE_SEARCH_DDL = {
+    'companies_fts': [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS companies_fts USING fts5("
+        "name, trade_name, content='companies', content_rowid='id', "
+        "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+        "CREATE TRIGGER IF NOT EXISTS companies_fts_ai AFTER INSERT ON companies BEGIN "
+        "INSERT INTO companies_fts(rowid, name, trade_name) VALUES (new.id, new.name, new.trade_name); END",
+        "CREATE TRIGGER IF NOT EXISTS companies_fts_ad AFTER DELETE ON companies BEGIN "
+        "INSERT INTO companies_fts(companies_fts, rowid, name, trade_name) "
+        "VALUES ('delete', old.id, old.name, old.trade_name); END",
+        "CREATE TRIGGER IF NOT EXISTS companies_fts_au AFTER UPDATE OF name, trade_name ON companies BEGIN "
+        "INSERT INTO companies_fts(companies_fts, rowid, name, trade_name) "
+        "VALUES ('delete', old.id, old.name, old.trade_name); "
+        "INSERT INTO companies_fts(rowid, name, trade_name) VALUES (new.id, new.name, new.trade_name); END",
+    ],
+    'certificates_fts': [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS certificates_fts USING fts5("
+        "name, content='certificates', content_rowid='id', "
+        "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+        "CREATE TRIGGER IF NOT EXISTS certificates_fts_ai AFTER INSERT ON certificates BEGIN "
+        "INSERT INTO certificates_fts(rowid, name) VALUES (new.id, new.name); END",
+        "CREATE TRIGGER IF NOT EXISTS certificates_fts_ad AFTER DELETE ON certificates BEGIN "
+        "INSERT INTO certificates_fts(certificates_fts, rowid, name) VALUES ('delete', old.id, old.name); END",
+        "CREATE TRIGGER IF NOT EXISTS certificates_fts_au AFTER UPDATE OF name ON certificates BEGIN "
+        "INSERT INTO certificates_fts(certificates_fts, rowid, name) VALUES ('delete', old.id, old.name); "
+        "INSERT INTO certificates_fts(rowid, name) VALUES (new.id, new.name); END",
+    ],
+}
+
+# PostgreSQL: tsvector and trigram GIN indexes (expressions must match the queries below)
+POSTGRESQL_SEARCH_INDEXES = [
+    "ix_companies_search_tsv ON companies USING gin "
+    "(to_tsvector('simple', coalesce(name, '') || ' ' || coalesce(trade_name, '')))",
+    "ix_companies_name_trgm ON companies USING gin (name gin_trgm_ops)",
+    "ix_companies_trade_name_trgm ON companies USING gin (trade_name gin_trgm_ops)",
+    "ix_certificates_search_tsv ON certificates USING gin (to_tsvector('simple', name))",
+    "ix_certificates_name_trgm ON certificates USING gin (name gin_trgm_ops)",
+]
+
+
+def _words(term):
+    return re.findall(r'\w+', term.lower())
+
+
+def _cnpj_prefix(term):
+    """Digits of a term that looks like (part of) a CNPJ, else None"""
+    if not _CNPJ_TERM.match(term):
+        return None
+    digits = normalize_cnpj(term)
+    return digits if len(digits) >= _CNPJ_MIN_DIGITS else None
+
+
+def _cnpj_filter(digits):
+    # Range instead of LIKE so both databases use the (organization_id,
+    # cnpj_digits) index; ':' is the character right after '9'
+    return (Company.cnpj_digits >= digits) & (Company.cnpj_digits < digits + ':')
+
+
+def _fts_available(name):
+    return db.session.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': name}
+    ).first() is not None
+
+
+def _fts_match(name, term):
+    """Join clause, filter and rank ordering against an FTS5 table"""
+    fts = table(name, column('rowid'))
+    # Every word must match, as a prefix of some indexed word
+    expression = ' '.join(f'"{word}"*' for word in _words(term))
+    return fts, literal_column(name).op('MATCH')(expression), func.bm25(literal_column(name))
+
+
+def _pg_tsquery(term):
+    return func.to_tsquery(
+        literal_column("'simple'"), ' & '.join(f'{word}:*' for word in _words(term))
+    )
+
+
+def search_companies(query, term):
+    """Restrict a Company query to a search term, best matches first
+
+    Digit-only terms are CNPJ prefixes; other terms match the words of the
+    name and trade name through the database's text index.
+    """
+    term = term.strip()
+    digits = _cnpj_prefix(term)
+    if digits:
+        return query.filter(_cnpj_filter(digits)).order_by(None).order_by(Company.cnpj_digits)
+    if not _words(term):
+        return query.order_by(None).order_by(Company.name)
+
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite' and _fts_available('companies_fts'):
+        fts, match, rank = _fts_match('companies_fts', term)
+        return query.join(fts, fts.c.rowid == Company.id).filter(match).order_by(None).order_by(rank, Company.name)
+
+    if dialect == 'postgresql':
+        document = func.to_tsvector(
+            literal_column("'simple'"),
+            func.coalesce(Company.name, '') + ' ' + func.coalesce(Company.trade_name, '')
+        )
+        tsquery = _pg_tsquery(term)
+        rank = func.ts_rank(document, tsquery) + func.greatest(
+            func.similarity(Company.name, term), func.similarity(func.coalesce(Company.trade_name, ''), term)
+        )
+        return query.filter(or_(
+            document.op('@@')(tsquery),
+            Company.name.ilike(f'%{term}%'),
+            Company.trade_name.ilike(f'%{term}%'),
+        )).order_by(None).order_by(rank.desc(), Company.name)
+
+    return query.filter(or_(
+        Company.name.ilike(f'%{term}%'),
+        Company.trade_name.ilike(f'%{term}%'),
+    )).order_by(None).order_by(Company.name)
+
+
+def search_certificates(query, term):
+    """Restrict a Certificate query to a search term, best matches first
+
+    Digit-only terms match the CNPJ prefix of the certificate's company;
+    other terms match the words of the certificate name.
+    """
+    term = term.strip()
+    digits = _cnpj_prefix(term)
+    if digits:
+        companies = db.session.query(Company.id).filter(
+            Company.organization_id == Certificate.organization_id, _cnpj_filter(digits)
+        )
+        return query.filter(Certificate.company_id.in_(companies.scalar_subquery())).order_by(None).order_by(
+            Certificate.expiry_date, Certificate.id
+        )
+    if not _words(term):
+        return query.order_by(None).order_by(Certificate.expiry_date, Certificate.id)
+
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite' and _fts_available('certificates_fts'):
+        fts, match, rank = _fts_match('certificates_fts', term)
+        return query.join(fts, fts.c.rowid == Certificate.id).filter(match).order_by(None).order_by(
+            rank, Certificate.expiry_date, Certificate.id
+        )
+
+    if dialect == 'postgresql':
+        document = func.to_tsvector(literal_column("'simple'"), Certificate.name)
+        tsquery = _pg_tsquery(term)
+        rank = func.ts_rank(document, tsquery) + func.similarity(Certificate.name, term)
+        return query.filter(or_(
+            document.op('@@')(tsquery),
+            Certificate.name.ilike(f'%{term}%'),
+        )).order_by(None).order_by(rank.desc(), Certificate.expiry_date, Certificate.id)
+
+    return query.filter(Certificate.name.ilike(f'%{term}%')).order_by(None).order_by(
+        Certificate.expiry_date, Certificate.id
+    )
+
+
+def ranked_ids(query, key_column, limit=SEARCH_RESULT_LIMIT):
+    """Ids of the first `limit` rows of a ranked query, in rank order"""
+    return [row[0] for row in query.with_entities(key_column).limit(limit).all()]
+
+
+# Index maintenance
+
+def ensure_search_index(rebuild=False):
+    """Create the text search structures of the current database
+
+    On SQLite the FTS tables are (re)filled when created or when `rebuild`
+    is set; on PostgreSQL the GIN indexes need the pg_trgm extension.
+    """
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        for name, statements in SQLITE_SEARCH_DDL.items():
+            created = not _fts_available(name)
+            for statement in statements:
+                db.session.execute(text(statement))
+            if created or rebuild:
+                db.session.execute(text(f"INSERT INTO {name}({name}) VALUES ('rebuild')"))
+        db.session.commit()
+    elif dialect == 'postgresql':
+        try:
+            db.session.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+            for index in POSTGRESQL_SEARCH_INDEXES:
+                db.session.execute(text(f'CREATE INDEX IF NOT EXISTS {index}'))
+            db.session.commit()
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            logger.error(f"Could not create the search indexes: {str(e)}")
+
+
+# CLI commands
+search_cli = AppGroup('search', help='Índices de busca de empresas e certificados.')
+
+
+@search_cli.command('rebuild')
+def rebuild_command():
+    """Recreate the search triggers and rebuild the text index."""
+    ensure_search_index(rebuild=True)
+    click.echo('Índices de busca reconstruídos.')
+
+
+app.cli.add_command(search_cli)
@@ -31,7 +31,8 @@ function initCertificateExpiryStatus() {
     let statusClass = '';
     let statusText = '';
     
-    if (daysLeft < 0) {
+    // Same rule as stats.certificate_status: expiring today is expired
+    if (daysLeft <= 0) {
       statusClass = 'certificate-expired';
       statusText = 'Expirado';
     } else if (daysLeft <= 30) {
@@ -48,7 +49,7 @@ function initCertificateExpiryStatus() {
     if (statusElement) {
       statusElement.textContent = statusText;
       
-      if (daysLeft < 0) {
+      if (daysLeft <= 0) {
         statusElement.classList.add('badge-danger');
       } else if (daysLeft <= 30) {
         statusElement.classList.add('badge-warning');
@@ -206,33 +207,17 @@ function initCertificateFileValidation() {
 
 // Download certificate
 function downloadCertificate(certificateId, certificateName) {
-  // In a real implementation, this would make an AJAX request to a route that:
-  // 1. Checks permissions
-  // 2. Decrypts the certificate from S3
-  // 3. Returns it as a download
-  const downloadUrl = `/api/certificates/${certificateId}/download`;
-  
-  fetch(downloadUrl)
-    .then(response => {
-      if (!response.ok) {
-        throw new Error('Erro ao baixar o certificado');
-      }
-      return response.blob();
-    })
-    .then(blob => {
-      const url = window.URL.createObjectURL(blob);
-      const a = document.createElement('a');
-      a.style.display = 'none';
-      a.href = url;
-      a.download = certificateName + '.pfx';
-      document.body.appendChild(a);
-      a.click();
-      window.URL.revokeObjectURL(url);
-    })
-    .catch(error => {
-      console.error('Download error:', error);
-      showNotification('Erro ao baixar o certificado. Por favor, tente novamente.', 'error');
-    });
+  // The route checks permissions and answers with the file (or a redirect to
+  // a temporary storage URL); the browser downloads it directly, without
+  // holding the whole file in memory
+  const a = document.createElement('a');
+  a.style.display = 'none';
+  a.href = `/api/certificates/${certificateId}/download`;
+  // Name and extension come from the Content-Disposition header
+  a.setAttribute('download', '');
+  document.body.appendChild(a);
+  a.click();
+  document.body.removeChild(a);
 }
 
 // Request certificate password
@@ -0,0 +1,431 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app, g, has_request_context
+from flask.cli import AppGroup
+from sqlalchemy import case, delete, func, select, update
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from models import Certificate, Company, OrganizationCertificateStats
+
+# Upper bound (in days from as_of) of each expiry bucket kept in the read model
+EXPIRY_BUCKETS = (
+    (0, 'expired_count'),
+    (30, 'expiring_30d'),
+    (60, 'expiring_60d'),
+    (90, 'expiring_90d'),
+)
+
+TYPE_COLUMNS = {
+    'e-cnpj': 'ecnpj_count',
+    'e-cpf': 'ecpf_count',
+}
+
+# Certificates expiring within this many days (after today) are "expiring soon"
+EXPIRING_SOON_DAYS = 30
+
+STATS_COLUMNS = ('total_certificates',) + tuple(TYPE_COLUMNS.values()) + tuple(
+    column for _, column in EXPIRY_BUCKETS
+)
+
+
+class _OrganizationCache:
+    """Per-process cache keyed by organization id
+
+    Entries expire after the number of seconds in the `ttl_setting` config
+    key (0 disables caching) and never survive a change of date, since expiry
+    buckets are relative to today.
+    """
+
+    def __init__(self, ttl_setting, default_ttl):
+        self.ttl_setting = ttl_setting
+        self.default_ttl = default_ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, organization_id, today):
+        ttl = current_app.config.get(self.ttl_setting, self.default_ttl)
+        with self._lock:
+            entry = self._entries.get(organization_id)
+        if entry is not None:
+            stored_at, day, value = entry
+            if day == today and time.monotonic() - stored_at < ttl:
+                return value
+        return None
+
+    def set(self, organization_id, today, value):
+        if current_app.config.get(self.ttl_setting, self.default_ttl) > 0:
+            with self._lock:
+                self._entries[organization_id] = (time.monotonic(), today, value)
+
+    def pop(self, organization_id):
+        with self._lock:
+            self._entries.pop(organization_id, None)
+
+
+_dashboard_cache = _OrganizationCache('DASHBOARD_STATS_CACHE_TTL', 300)
+_badge_cache = _OrganizationCache('EXPIRING_BADGE_CACHE_TTL', 60)
+
+
+def certificate_status(expiry_date, today=None):
+    """'expired', 'expiring-soon' or 'valid'
+
+    The one definition shared by the list filters, the exports, the
+    templates and the stats buckets: a certificate expiring today counts as
+    expired.
+    """
+    days_left = (expiry_date - (today or datetime.now().date())).days
+    if days_left <= 0:
+        return 'expired'
+    if days_left <= EXPIRING_SOON_DAYS:
+        return 'expiring-soon'
+    return 'valid'
+
+
+def certificate_status_condition(status, today):
+    """SQL condition of a status filter, or None for an unknown status
+
+    Matches `certificate_status`, except that "valid" selects every
+    certificate that has not expired, the ones expiring soon included.
+    """
+    if status == 'expired':
+        return Certificate.expiry_date <= today
+    if status == 'expiring-soon':
+        return (Certificate.expiry_date > today) & (
+            Certificate.expiry_date <= today + timedelta(days=EXPIRING_SOON_DAYS)
+        )
+    if status == 'valid':
+        return Certificate.expiry_date > today
+    return None
+
+
+def _count_if(condition):
+    return func.coalesce(func.sum(case((condition, 1), else_=0)), 0)
+
+
+def _bucket_for(expiry_date, as_of):
+    """Return the stats column an expiry date falls into, if any"""
+    days_left = (expiry_date - as_of).days
+    for upper, column in EXPIRY_BUCKETS:
+        if days_left <= upper:
+            return column
+    return None
+
+
+def compute_certificate_stats(organization_id, today=None):
+    """Recount the certificate totals of an organization in a single query"""
+    today = today or datetime.now().date()
+
+    columns = [
+        func.count(Certificate.id).label('total_certificates'),
+    ]
+    for cert_type, column in TYPE_COLUMNS.items():
+        columns.append(_count_if(Certificate.type == cert_type).label(column))
+
+    lower = None
+    for upper, column in EXPIRY_BUCKETS:
+        condition = Certificate.expiry_date <= today + timedelta(days=upper)
+        if lower is not None:
+            condition = condition & (Certificate.expiry_date > today + timedelta(days=lower))
+        columns.append(_count_if(condition).label(column))
+        lower = upper
+
+    stmt = (
+        select(*columns)
+        .select_from(Certificate)
+        .where(Certificate.organization_id == organization_id)
+    )
+
+    row = db.session.execute(stmt).one()
+    return {key: int(value or 0) for key, value in row._mapping.items()}
+
+
+def rebuild_organization_stats(organization_id, today=None):
+    """Recompute the stats row of an organization from the certificates table"""
+    today = today or datetime.now().date()
+    counts = compute_certificate_stats(organization_id, today)
+
+    stats = db.session.get(OrganizationCertificateStats, organization_id)
+    if stats is None:
+        stats = OrganizationCertificateStats(organization_id=organization_id)
+        db.session.add(stats)
+    for column, value in counts.items():
+        setattr(stats, column, value)
+    stats.as_of = today
+    db.session.flush()
+    return stats
+
+
+def rollover_organization_stats(today=None, organization_id=None):
+    """Shift certificates between expiry buckets for stats rows older than today
+
+    A certificate whose expiry date lies in (as_of + b, today + b] crossed the
+    bucket boundary b since the row was last rolled over, so only those
+    certificates are counted; the rest of the portfolio is never rescanned.
+    Returns the number of stats rows rolled over.
+    """
+    today = today or datetime.now().date()
+
+    query = db.session.query(
+        OrganizationCertificateStats.as_of,
+        OrganizationCertificateStats.organization_id,
+    ).filter(OrganizationCertificateStats.as_of < today)
+    if organization_id is not None:
+        query = query.filter(OrganizationCertificateStats.organization_id == organization_id)
+
+    stale = {}
+    for as_of, org_id in query:
+        stale.setdefault(as_of, []).append(org_id)
+
+    for as_of, org_ids in stale.items():
+        crossings = [
+            _count_if(
+                (Certificate.expiry_date > as_of + timedelta(days=upper))
+                & (Certificate.expiry_date <= today + timedelta(days=upper))
+            ).label(column)
+            for upper, column in EXPIRY_BUCKETS
+        ]
+        rows = db.session.execute(
+            select(Certificate.organization_id, *crossings)
+            .where(
+                Certificate.organization_id.in_(org_ids),
+                Certificate.expiry_date > as_of,
+                Certificate.expiry_date <= today + timedelta(days=EXPIRY_BUCKETS[-1][0]),
+            )
+            .group_by(Certificate.organization_id)
+        ).all()
+
+        for row in rows:
+            # Certificates crossing boundary b enter the bucket ending at b
+            # and leave the bucket above it (untracked beyond the last one)
+            values = {}
+            for index, (upper, column) in enumerate(EXPIRY_BUCKETS):
+                delta = int(row._mapping[column])
+                values[column] = values.get(column, 0) + delta
+                if index + 1 < len(EXPIRY_BUCKETS):
+                    above = EXPIRY_BUCKETS[index + 1][1]
+                    values[above] = values.get(above, 0) - delta
+
+            db.session.execute(
+                update(OrganizationCertificateStats)
+                .where(OrganizationCertificateStats.organization_id == row.organization_id)
+                .values({
+                    column: getattr(OrganizationCertificateStats, column) + delta
+                    for column, delta in values.items() if delta
+                } | {'as_of': today})
+            )
+
+        db.session.execute(
+            update(OrganizationCertificateStats)
+            .where(
+                OrganizationCertificateStats.organization_id.in_(org_ids),
+                OrganizationCertificateStats.as_of == as_of,
+            )
+            .values(as_of=today)
+        )
+
+    db.session.flush()
+    return sum(len(org_ids) for org_ids in stale.values())
+
+
+def _ensure_stats_row(organization_id, today):
+    """Make sure an up-to-date stats row exists
+
+    Returns True when the row had to be rebuilt from the certificates table,
+    in which case it already reflects every change flushed in the session.
+    """
+    exists = db.session.execute(
+        select(OrganizationCertificateStats.as_of)
+        .where(OrganizationCertificateStats.organization_id == organization_id)
+    ).scalar_one_or_none()
+
+    if exists is None:
+        try:
+            with db.session.begin_nested():
+                rebuild_organization_stats(organization_id, today)
+            return True
+        except IntegrityError:
+            # Another transaction created the row concurrently
+            pass
+    elif exists < today:
+        rollover_organization_stats(today, organization_id)
+    return False
+
+
+def _add_deltas(deltas, cert_type, expiry_date, sign, today):
+    """Add one certificate's contribution to a {column: delta} dict"""
+    for column in ('total_certificates', TYPE_COLUMNS.get(cert_type), _bucket_for(expiry_date, today)):
+        if column:
+            deltas[column] = deltas.get(column, 0) + sign
+
+
+def record_certificate_changes(organization_id, certificates, sign=1, today=None):
+    """Apply added (sign=1) or removed (sign=-1) certificates to the stats row
+
+    Must be called after the certificates were flushed, inside the same
+    transaction, so the read model commits or rolls back with them.
+    """
+    today = today or datetime.now().date()
+    if _ensure_stats_row(organization_id, today):
+        return
+
+    deltas = {}
+    for certificate in certificates:
+        _add_deltas(deltas, certificate.type, certificate.expiry_date, sign, today)
+
+    if deltas:
+        db.session.execute(
+            update(OrganizationCertificateStats)
+            .where(OrganizationCertificateStats.organization_id == organization_id)
+            .values({
+                column: getattr(OrganizationCertificateStats, column) + delta
+                for column, delta in deltas.items()
+            })
+        )
+
+
+def shift_certificate_stats(changes, today=None):
+    """Apply certificates edited in place to the stats rows, without flushing
+
+    `changes` holds (organization_id, type, expiry_date, sign) entries: an
+    edited certificate's previous values with sign -1 and its new ones with
+    sign 1. Safe to call while the session flushes. A row that is not
+    current for today (or an entry with an unknown expiry date) drops the
+    organization's row instead, to be rebuilt on its next read.
+    """
+    today = today or datetime.now().date()
+    by_organization = {}
+    for organization_id, cert_type, expiry_date, sign in changes:
+        deltas = by_organization.setdefault(organization_id, {})
+        if expiry_date is None:
+            deltas['rebuild'] = True
+            continue
+        _add_deltas(deltas, cert_type, expiry_date, sign, today)
+
+    for organization_id, deltas in by_organization.items():
+        where = OrganizationCertificateStats.organization_id == organization_id
+        as_of = db.session.execute(select(OrganizationCertificateStats.as_of).where(where)).scalar_one_or_none()
+        if as_of is None:
+            continue
+        if deltas.pop('rebuild', False) or as_of < today:
+            db.session.execute(delete(OrganizationCertificateStats).where(where))
+            continue
+        deltas = {column: delta for column, delta in deltas.items() if delta}
+        if deltas:
+            db.session.execute(update(OrganizationCertificateStats).where(where).values({
+                column: getattr(OrganizationCertificateStats, column) + delta
+                for column, delta in deltas.items()
+            }))
+
+
+def record_certificate_added(certificate, organization_id):
+    record_certificate_changes(organization_id, [certificate], 1)
+
+
+def record_certificate_removed(certificate, organization_id):
+    record_certificate_changes(organization_id, [certificate], -1)
+
+
+def get_organization_stats(organization_id):
+    """Return the certificate totals of an organization from the read model"""
+    today = datetime.now().date()
+    stats = db.session.execute(
+        select(OrganizationCertificateStats)
+        .where(OrganizationCertificateStats.organization_id == organization_id)
+    ).scalar_one_or_none()
+
+    if stats is None or stats.as_of < today:
+        try:
+            if stats is None:
+                stats = rebuild_organization_stats(organization_id, today)
+            else:
+                rollover_organization_stats(today, organization_id)
+                db.session.refresh(stats)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            stats = db.session.get(OrganizationCertificateStats, organization_id)
+
+    return {column: getattr(stats, column) for column in STATS_COLUMNS}
+
+
+def get_dashboard_stats(organization_id):
+    """Return cached dashboard counters for an organization"""
+    today = datetime.now().date()
+    stats = _dashboard_cache.get(organization_id, today)
+    if stats is None:
+        stats = get_organization_stats(organization_id)
+        stats['total_companies'] = Company.query.filter_by(organization_id=organization_id).count()
+        _dashboard_cache.set(organization_id, today, stats)
+    return dict(stats)
+
+
+def get_expiring_badge_count(organization_id):
+    """Return the number of certificates expiring in the next 30 days
+
+    Memoized for the current request and cached across requests for
+    EXPIRING_BADGE_CACHE_TTL seconds.
+    """
+    memo = g.setdefault('_expiring_badge_counts', {})
+    if organization_id in memo:
+        return memo[organization_id]
+
+    today = datetime.now().date()
+    count = _badge_cache.get(organization_id, today)
+    if count is None:
+        count = get_organization_stats(organization_id)['expiring_30d']
+        _badge_cache.set(organization_id, today, count)
+
+    memo[organization_id] = count
+    return count
+
+
+def invalidate_dashboard_stats(organization_id):
+    """Drop the cached dashboard counters for an organization"""
+    _dashboard_cache.pop(organization_id)
+
+
+def invalidate_certificate_caches(organization_id):
+    """Drop every cached certificate counter for an organization"""
+    _dashboard_cache.pop(organization_id)
+    _badge_cache.pop(organization_id)
+    if has_request_context():
+        g.pop('_expiring_badge_counts', None)
+
+
+# CLI commands
+stats_cli = AppGroup('stats', help='Manutenção das estatísticas de certificados.')
+
+
+@stats_cli.command('rollover')
+def rollover_command():
+    """Shift certificates between expiry buckets (run nightly)."""
+    count = rollover_organization_stats()
+    db.session.commit()
+    click.echo(f'{count} organização(ões) atualizada(s).')
+
+
+@stats_cli.command('rebuild')
+@click.option('--organization-id', type=int, default=None,
+              help='Reconstruir apenas esta organização.')
+def rebuild_command(organization_id):
+    """Recompute the stats read model from the certificates table."""
+    from models import Organization
+
+    if organization_id is not None:
+        organization_ids = [organization_id]
+    else:
+        organization_ids = [org_id for (org_id,) in db.session.query(Organization.id)]
+
+    for org_id in organization_ids:
+        rebuild_organization_stats(org_id)
+    db.session.commit()
+    for org_id in organization_ids:
+        invalidate_certificate_caches(org_id)
+    click.echo(f'{len(organization_ids)} organização(ões) reconstruída(s).')
+
+
+app.cli.add_command(stats_cli)
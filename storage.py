@@ -0,0 +1,197 @@
+import os
+import shutil
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+# Bytes copied per step when streaming to the local backend
+CHUNK_SIZE = 64 * 1024
+
+
+class StorageError(Exception):
+    """A certificate file could not be stored, read or removed"""
+
+
+class LocalStorage:
+    """Files under a local directory (single node or shared volume)"""
+
+    name = 'local'
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def save(self, key, stream):
+        """Copy a stream to `key` atomically; returns the location to record (None)"""
+        os.makedirs(self.root, exist_ok=True)
+        temporary = self.path(f'.upload-{uuid.uuid4()}.tmp')
+        try:
+            with open(temporary, 'wb') as output:
+                shutil.copyfileobj(stream, output, CHUNK_SIZE)
+            os.replace(temporary, self.path(key))
+        except OSError as e:
+            raise StorageError(str(e))
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+        return None
+
+    def open(self, key):
+        try:
+            return open(self.path(key), 'rb')
+        except OSError as e:
+            raise StorageError(str(e))
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            raise StorageError(str(e))
+
+
+class S3Storage:
+    """Objects in an S3-compatible bucket (AWS S3, MinIO, ...)
+
+    Uploads go through boto3's managed transfer: streams larger than the
+    chunk size are sent as multipart uploads, parts in parallel, without
+    reading the whole file into memory. One client is created per process
+    and shared by its threads.
+    """
+
+    name = 's3'
+
+    def __init__(self, bucket, prefix='', region=None, endpoint_url=None,
+                 chunk_size=8 * 1024 * 1024, max_concurrency=8):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.region = region
+        self.endpoint_url = endpoint_url
+        self.chunk_size = chunk_size
+        self.max_concurrency = max_concurrency
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._pid != os.getpid():
+                    import boto3
+                    from botocore.config import Config
+
+                    self._client = boto3.client(
+                        's3',
+                        region_name=self.region,
+                        endpoint_url=self.endpoint_url,
+                        config=Config(max_pool_connections=self.max_concurrency * 2)
+                    )
+                    self._pid = os.getpid()
+        return self._client
+
+    def _transfer_config(self):
+        from boto3.s3.transfer import TransferConfig
+
+        return TransferConfig(
+            multipart_threshold=self.chunk_size,
+            multipart_chunksize=self.chunk_size,
+            max_concurrency=self.max_concurrency,
+        )
+
+    def key(self, name):
+        return f'{self.prefix}{name}'
+
+    def save(self, name, stream):
+        """Upload a stream; returns the object key to record as `s3_key`"""
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        key = self.key(name)
+        try:
+            self.client.upload_fileobj(stream, self.bucket, key, Config=self._transfer_config())
+        except (BotoCoreError, ClientError) as e:
+            raise StorageError(str(e))
+        return key
+
+    def open(self, key):
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=key)['Body']
+        except (BotoCoreError, ClientError) as e:
+            raise StorageError(str(e))
+
+    def presigned_url(self, key, download_name, expires_in):
+        """Temporary URL downloading the object directly from the bucket"""
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        try:
+            return self.client.generate_presigned_url('get_object', Params={
+                'Bucket': self.bucket,
+                'Key': key,
+                'ResponseContentDisposition': f'attachment; filename="{download_name}"',
+            }, ExpiresIn=expires_in)
+        except (BotoCoreError, ClientError) as e:
+            raise StorageError(str(e))
+
+    def delete(self, key):
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        try:
+            self.client.delete_object(Bucket=self.bucket, Key=key)
+        except (BotoCoreError, ClientError) as e:
+            raise StorageError(str(e))
+
+
+def _create_storage(config):
+    if config.get('STORAGE_BACKEND') == 's3':
+        return S3Storage(
+            bucket=config['AWS_S3_BUCKET_NAME'],
+            prefix=config.get('AWS_S3_PREFIX', ''),
+            region=config.get('AWS_S3_REGION'),
+            endpoint_url=config.get('AWS_S3_ENDPOINT_URL'),
+            chunk_size=config.get('STORAGE_MULTIPART_CHUNK_SIZE', 8 * 1024 * 1024),
+            max_concurrency=config.get('STORAGE_MAX_CONCURRENCY', 8),
+        )
+    return LocalStorage(config.get('STORAGE_LOCAL_DIR', 'certificates'))
+
+
+def get_storage():
+    """The storage backend that receives new certificate files"""
+    extension = current_app.extensions.get('certificate_storage')
+    if extension is None:
+        extension = current_app.extensions['certificate_storage'] = {}
+    if 'default' not in extension:
+        extension['default'] = _create_storage(current_app.config)
+    return extension['default']
+
+
+def storage_for(s3_key):
+    """The backend holding a file: S3 when it has an object key, else local
+
+    Files written before switching STORAGE_BACKEND stay readable.
+    """
+    if s3_key:
+        storage = get_storage()
+        if storage.name != 's3':
+            raise StorageError('Arquivo armazenado no S3, mas STORAGE_BACKEND não é "s3".')
+        return storage
+    extension = current_app.extensions.setdefault('certificate_storage', {})
+    if 'local' not in extension:
+        extension['local'] = LocalStorage(current_app.config.get('STORAGE_LOCAL_DIR', 'certificates'))
+    return extension['local']
+
+
+def save_many(storage, items):
+    """Store (name, stream) pairs concurrently; returns their locations in order"""
+    items = list(items)
+    if len(items) <= 1:
+        return [storage.save(name, stream) for name, stream in items]
+    workers = min(len(items), current_app.config.get('STORAGE_MAX_CONCURRENCY', 8))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda item: storage.save(*item), items))
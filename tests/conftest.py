@@ -0,0 +1,90 @@
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+
+import pytest
+from flask import has_request_context
+from sqlalchemy import event
+
+import factories
+
+# The application is configured from the environment when app.py is imported
+os.environ.update(factories.environment(tempfile.mkdtemp(prefix='oguardiao-tests-')))
+os.environ.update({
+    'LAZY_LOAD_DETECTION': 'raise',
+    'AUDIT_LOG_SYNC': 'True',
+    # Budgets must not depend on the order the tests run in
+    'IDENTITY_CACHE_TTL': '0',
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app as flask_app, db  # noqa: E402
+
+# Size of the seeded organizations; budgets must hold whatever this is
+SEED_CERTIFICATES = 150
+
+
+@pytest.fixture(scope='session')
+def app():
+    return factories.prepare_app(flask_app)
+
+
+@pytest.fixture(scope='session')
+def seeded_admins(app):
+    """Master admin ids of the two seeded organizations"""
+    with app.app_context():
+        return (
+            factories.seed_organization('Organização de Teste', SEED_CERTIFICATES, plan='basic'),
+            factories.seed_organization('Outra Organização', SEED_CERTIFICATES, plan='basic'),
+        )
+
+
+@pytest.fixture(scope='session')
+def seeded_admin_id(seeded_admins):
+    """Id of the master admin of the seeded organization"""
+    return seeded_admins[0]
+
+
+@pytest.fixture
+def login(app):
+    """Factory of test clients logged in as a given user"""
+    return lambda user_id: factories.login(app, user_id)
+
+
+@pytest.fixture
+def client(login, seeded_admin_id):
+    """Test client logged in as the seeded organization's master admin"""
+    return login(seeded_admin_id)
+
+
+@pytest.fixture
+def query_budget(app):
+    """Context manager failing the test when the requests made inside it run
+    more than `limit` SQL statements
+
+    Only statements issued in a request context are counted (background
+    flushers are not), including those of streamed responses.
+    """
+    @contextmanager
+    def budget(limit):
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            if has_request_context():
+                statements.append(statement)
+
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+        assert len(statements) <= limit, (
+            f'{len(statements)} queries, budget is {limit}:\n' + '\n'.join(
+                f'{number}. {" ".join(statement.split())}' for number, statement in enumerate(statements, 1)
+            )
+        )
+
+    return budget
@@ -0,0 +1,182 @@
+import datetime
+import io
+import os
+import zipfile
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.serialization import pkcs12
+from cryptography.x509.oid import NameOID
+
+# ICP-Brasil CNPJ field of the subject alternative name
+OID_PJ_CNPJ = x509.ObjectIdentifier('2.16.76.1.3.3')
+
+_KEY = ec.generate_private_key(ec.SECP256R1())
+
+# Data factories shared by tests/ and benchmarks/. Nothing here imports the
+# application at module level: each conftest sets the environment first.
+
+
+def environment(data_dir):
+    """Settings both suites run with, for os.environ before app.py is
+    imported; files go under `data_dir`"""
+    return {
+        'DATABASE_URL': 'sqlite:///' + os.path.join(data_dir, 'oguardiao.db'),
+        'AUTO_CREATE_SCHEMA': 'True',
+        'RATE_LIMIT_ENABLED': 'False',
+        'AUDIT_LOG_SPOOL_DIR': os.path.join(data_dir, 'audit-spool'),
+        'AUDIT_ARCHIVE_DIR': os.path.join(data_dir, 'audit-archive'),
+        'STORAGE_LOCAL_DIR': os.path.join(data_dir, 'certificates'),
+        'METRICS_DIR': os.path.join(data_dir, 'metrics'),
+        'MAIL_OUTBOX_BACKGROUND': 'False',
+        'CERTIFICATE_ENCRYPTION_KEY': 'chave-de-testes-0123456789abcdef',
+        # Caches off, so every request is measured cold
+        'DASHBOARD_STATS_CACHE_TTL': '0',
+        'EXPIRING_BADGE_CACHE_TTL': '0',
+        'AUDIT_ACTION_CATALOG_CACHE_TTL': '0',
+    }
+
+
+def prepare_app(app):
+    """Configure the application for the test client"""
+    app.config.update(
+        TESTING=True,
+        WTF_CSRF_ENABLED=False,
+        SESSION_COOKIE_SECURE=False,
+    )
+    app.extensions['mail'].suppress = True
+    return app
+
+
+def login(app, user_id):
+    """Test client logged in as a user"""
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+    return client
+
+
+def seed_organization(name, certificates, certificates_per_company=5, users=4, groups=3,
+                      audit_logs_per_certificate=2, plan='enterprise'):
+    """Bulk insert an organization with `certificates` certificates spread
+    over companies, plus users, groups and audit logs; returns the id of its
+    master admin
+
+    Certificate `index` belongs to company `index % companies`, expires
+    `index % 400 - 30` days from today and is named `Certificado {index:06d}`.
+    """
+    from sqlalchemy import insert
+
+    from app import db
+    from models import AuditLog, Certificate, Company, Group, Organization, User
+    from stats import rebuild_organization_stats
+
+    organization = Organization(name=name, plan=plan)
+    db.session.add(organization)
+    db.session.flush()
+    org_id = organization.id
+
+    members = []
+    for index in range(users):
+        user = User(
+            name=f'Usuário {index:02d}',
+            email=f'usuario{index}@org{org_id}.test',
+            role='master_admin' if index == 0 else ('admin' if index < 3 else 'operator'),
+            organization_id=org_id
+        )
+        user.set_password('senha-de-teste')
+        members.append(user)
+    teams = [Group(name=f'Grupo {index}', organization_id=org_id) for index in range(groups)]
+    db.session.add_all(members + teams)
+    db.session.flush()
+    user_ids = [user.id for user in members]
+    group_ids = [group.id for group in teams]
+
+    companies = max(1, certificates // certificates_per_company)
+    company_rows = []
+    for index in range(companies):
+        digits = f'{org_id:03d}{index:07d}0001'
+        company_rows.append({
+            'name': f'Empresa {index:06d}',
+            'trade_name': f'Fantasia {index:06d}',
+            'cnpj': f'{digits[:2]}.{digits[2:5]}.{digits[5:8]}/{digits[8:12]}-{digits[12:]}',
+            'cnpj_digits': digits,
+            'organization_id': org_id,
+            'group_id': group_ids[index % groups] if groups and index % 4 else None,
+        })
+    company_ids = db.session.scalars(
+        insert(Company).returning(Company.id, sort_by_parameter_order=True), company_rows
+    ).all()
+
+    today = datetime.date.today()
+    if certificates:
+        db.session.execute(insert(Certificate), [
+            {
+                'name': f'Certificado {index:06d}',
+                'type': 'e-cnpj' if index % 3 else 'e-cpf',
+                'file_name': f'{index:06d}.pfx',
+                'company_id': company_ids[index % len(company_ids)],
+                'organization_id': org_id,
+                'issue_date': today - datetime.timedelta(days=365),
+                'expiry_date': today + datetime.timedelta(days=index % 400 - 30),
+                'created_by': user_ids[index % users],
+            }
+            for index in range(certificates)
+        ])
+
+        now = datetime.datetime.utcnow()
+        actions = ('login', 'certificate_uploaded', 'certificate_downloaded', 'company_created')
+        db.session.execute(insert(AuditLog), [
+            {
+                'user_id': user_ids[index % users],
+                'organization_id': org_id,
+                'action': actions[index % len(actions)],
+                'details': f'Evento {index}',
+                'ip_address': '127.0.0.1',
+                'created_at': now - datetime.timedelta(minutes=index),
+            }
+            for index in range(certificates * audit_logs_per_certificate)
+        ])
+
+    rebuild_organization_stats(org_id, today)
+    db.session.commit()
+    return user_ids[0]
+
+
+def make_certificate(common_name, cnpj=None, days=365, serial=None):
+    """Self-signed X.509 certificate valid for `days` more days"""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    builder = (
+        x509.CertificateBuilder()
+        .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)]))
+        .issuer_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'AC Testes')]))
+        .public_key(_KEY.public_key())
+        .serial_number(serial or x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=10))
+        .not_valid_after(now + datetime.timedelta(days=days))
+    )
+    if cnpj:
+        value = cnpj.encode('ascii')
+        builder = builder.add_extension(
+            x509.SubjectAlternativeName([x509.OtherName(OID_PJ_CNPJ, bytes([0x04, len(value)]) + value)]),
+            critical=False
+        )
+    return builder.sign(_KEY, hashes.SHA256())
+
+
+def make_pfx(certificate, password):
+    """PKCS#12 bytes of a certificate and its key, protected by `password`"""
+    return pkcs12.serialize_key_and_certificates(
+        b'teste', _KEY, certificate, None, serialization.BestAvailableEncryption(password.encode('utf-8'))
+    )
+
+
+def make_zip(files):
+    """ZIP archive bytes holding {name: data}"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, data in files.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
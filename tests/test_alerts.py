@@ -0,0 +1,18 @@
+def test_failed_enqueue_releases_the_claim(app, seeded_admin_id, monkeypatch):
+    import utils
+    from alerts import find_due_alerts, run_expiration_alerts
+    from models import CertificateAlert, MailOutbox
+
+    with app.app_context():
+        due = len(find_due_alerts())
+        assert due
+
+        monkeypatch.setattr(utils, 'send_expiration_alert', lambda *args, **kwargs: False)
+        assert run_expiration_alerts() == 0
+        assert CertificateAlert.query.count() == 0
+
+        monkeypatch.undo()
+        assert run_expiration_alerts() == due
+        assert CertificateAlert.query.count() == due
+        assert MailOutbox.query.filter(MailOutbox.dedup_key.like('alert:%')).count() >= due
+        assert run_expiration_alerts() == 0
@@ -0,0 +1,89 @@
+from datetime import date, datetime, timedelta
+
+MONTH = date(2020, 1, 1)
+
+
+def _log(user, minutes):
+    from models import AuditLog
+
+    return AuditLog(user_id=user.id, organization_id=user.organization_id, action='login',
+                    details=f'Evento {minutes}', ip_address='127.0.0.1',
+                    created_at=datetime(2020, 1, 10) + timedelta(minutes=minutes))
+
+
+def test_archived_month_pages_in_both_directions(app, seeded_admins):
+    from app import db
+    from audit_archive import archive_month, archived_audit_logs
+    from models import AuditArchiveSegment, AuditLog, User
+
+    with app.app_context():
+        user = db.session.get(User, seeded_admins[1])
+        db.session.add_all([_log(user, minutes) for minutes in range(0, 50, 2)])
+        # A newer log keeps SQLite from reusing the archived ids
+        db.session.add(AuditLog(user_id=user.id, organization_id=user.organization_id, action='login'))
+        db.session.commit()
+        assert archive_month(MONTH) == 25
+
+        # Late events of an archived month are merged into its segment
+        db.session.add_all([_log(user, minutes) for minutes in range(1, 10, 2)])
+        db.session.commit()
+        assert archive_month(MONTH) == 5
+        segment = AuditArchiveSegment.query.filter_by(organization_id=user.organization_id, month=MONTH).one()
+        assert segment.row_count == 30
+
+        tail = archived_audit_logs(user.organization_id)
+        newest_first = []
+        key = None
+        while True:
+            page = tail(key, False, 7)
+            newest_first.extend(page)
+            if len(page) < 7:
+                break
+            key = (page[-1].created_at, page[-1].id)
+        positions = [(log.created_at, log.id) for log in newest_first]
+        assert len(positions) == 30
+        assert positions == sorted(positions, reverse=True)
+
+        # Going back towards newer logs returns the ones right after the key
+        page = tail(positions[20], True, 4)
+        assert [(log.created_at, log.id) for log in page] == positions[16:20][::-1]
+
+        filtered = archived_audit_logs(user.organization_id, start=datetime(2020, 1, 10, 0, 40))
+        assert len(filtered(None, False, 100)) == 5
+
+
+def test_events_arriving_during_archiving_are_kept(app, seeded_admins, monkeypatch):
+    import audit_archive
+    from app import db
+    from models import AuditLog, User
+
+    month = date(2020, 2, 1)
+    with app.app_context():
+        user = db.session.get(User, seeded_admins[1])
+        logs = [_log(user, minutes) for minutes in range(10)]
+        for log in logs:
+            log.created_at += timedelta(days=31)
+        db.session.add_all(logs)
+        db.session.commit()
+
+        drop_month = audit_archive._drop_month
+        late = []
+
+        def replay_then_drop(month, archived_ids):
+            # A spooled event of the month replayed after the rows were read
+            log = _log(user, 60)
+            log.created_at = datetime(2020, 2, 20)
+            db.session.add(log)
+            db.session.commit()
+            late.append(log.id)
+            drop_month(month, archived_ids)
+
+        monkeypatch.setattr(audit_archive, '_drop_month', replay_then_drop)
+        assert audit_archive.archive_month(month) == 10
+        in_month = AuditLog.query.filter(AuditLog.created_at >= datetime(2020, 2, 1),
+                                         AuditLog.created_at < datetime(2020, 3, 1))
+        assert [log.id for log in in_month] == late
+
+        monkeypatch.setattr(audit_archive, '_drop_month', drop_month)
+        assert audit_archive.archive_month(month) == 1
+        assert in_month.count() == 0
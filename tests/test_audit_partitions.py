@@ -0,0 +1,183 @@
+import os
+from datetime import date, datetime
+
+import pytest
+from sqlalchemy import text
+
+# Runs against TEST_POSTGRESQL_URL (a disposable database: its public schema
+# is dropped) or, without it, a throwaway server started with pgserver
+pytest.importorskip('psycopg2')
+
+MIGRATIONS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+
+
+@pytest.fixture(scope='module')
+def postgresql_url(tmp_path_factory):
+    if os.environ.get('TEST_POSTGRESQL_URL'):
+        yield os.environ['TEST_POSTGRESQL_URL']
+        return
+    pgserver = pytest.importorskip('pgserver')
+    server = pgserver.get_server(str(tmp_path_factory.mktemp('postgresql')), cleanup_mode='stop')
+    yield server.get_uri().replace('postgresql://', 'postgresql+psycopg2://', 1)
+    server.cleanup()
+
+
+@pytest.fixture(scope='module')
+def postgresql(app, postgresql_url):
+    """App context on PostgreSQL migrated through 0004, with audit logs
+    written before the migration in the previous months"""
+    from flask import Flask
+    from flask_migrate import Migrate, upgrade
+
+    from app import db
+
+    pg_app = Flask('oguardiao-postgresql')
+    pg_app.config.update(SQLALCHEMY_DATABASE_URI=postgresql_url)
+    db.init_app(pg_app)
+    Migrate(pg_app, db, directory=MIGRATIONS)
+    with pg_app.app_context():
+        with db.engine.begin() as connection:
+            connection.execute(text('DROP SCHEMA public CASCADE'))
+            connection.execute(text('CREATE SCHEMA public'))
+        upgrade(directory=MIGRATIONS, revision='0003')
+        db.session.execute(text("INSERT INTO organizations (id, name, plan) VALUES (1, 'Organização', 'basic')"))
+        db.session.execute(text(
+            "INSERT INTO users (id, name, email, password_hash, role, organization_id) "
+            "VALUES (1, 'Usuário', 'usuario@teste.test', '-', 'admin', 1)"
+        ))
+        db.session.execute(text(
+            "INSERT INTO audit_logs (action, user_id, organization_id, created_at) "
+            "SELECT 'login', 1, 1, timezone('utc', now()) - make_interval(hours => i) "
+            "FROM generate_series(1, 2000) i"
+        ))
+        db.session.commit()
+        upgrade(directory=MIGRATIONS, revision='0004')
+        yield
+        db.session.remove()
+
+
+@pytest.fixture
+def archive_dir(app, monkeypatch, tmp_path):
+    monkeypatch.setitem(app.config, 'AUDIT_ARCHIVE_DIR', str(tmp_path))
+
+
+def _partitions():
+    from app import db
+
+    return dict(db.session.execute(text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = 'audit_logs'::regclass"
+    )).all())
+
+
+def _log(created_at):
+    from app import db
+
+    return db.session.execute(text(
+        "INSERT INTO audit_logs (action, user_id, organization_id, created_at) "
+        "VALUES ('login', 1, 1, :created_at) RETURNING id"
+    ), {'created_at': created_at}).scalar()
+
+
+def _count(table, start, end):
+    from app import db
+
+    return db.session.execute(text(
+        f"SELECT count(*) FROM {table} WHERE created_at >= :start AND created_at < :end"
+    ), {'start': start, 'end': end}).scalar()
+
+
+def test_migration_partitions_the_table(postgresql):
+    from app import db
+    from audit_archive import PARTITIONS_AHEAD, _add_months, _month_start, partition_name
+
+    current = _month_start(datetime.utcnow().date())
+    partitions = _partitions()
+    assert set(partitions) == {'audit_logs_legacy', 'audit_logs_default'} | {
+        partition_name(_add_months(current, offset)) for offset in range(PARTITIONS_AHEAD + 1)
+    }
+    assert partitions['audit_logs_legacy'].startswith('FOR VALUES FROM (MINVALUE)')
+    assert db.session.execute(text('SELECT count(*) FROM audit_logs')).scalar() == 2000
+
+    # New events go to the partition of the current month
+    log_id = _log(datetime.utcnow())
+    assert db.session.execute(
+        text(f'SELECT count(*) FROM {partition_name(current)} WHERE id = :id'), {'id': log_id}
+    ).scalar() == 1
+    db.session.rollback()
+
+
+def test_new_partitions_take_rows_from_the_default_one(postgresql):
+    from app import db
+    from audit_archive import PARTITIONS_AHEAD, _add_months, _month_start, ensure_partitions, partition_name
+
+    month = _add_months(_month_start(datetime.utcnow().date()), PARTITIONS_AHEAD + 2)
+    _log(datetime(month.year, month.month, 15))
+    db.session.commit()
+    end = _add_months(month, 1)
+    assert _count('audit_logs_default', month, end) == 1
+
+    assert ensure_partitions(month) >= 1
+    assert partition_name(month) in _partitions()
+    assert _count('audit_logs_default', month, end) == 0
+    assert _count(partition_name(month), month, end) == 1
+
+
+def test_archiving_a_partitioned_month(postgresql, archive_dir):
+    from app import db
+    from audit_archive import _add_months, _month_start, archive_month, partition_name
+
+    month = _add_months(_month_start(datetime.utcnow().date()), 1)
+    end = _add_months(month, 1)
+    for day in range(1, 11):
+        _log(datetime(month.year, month.month, day))
+    db.session.commit()
+
+    assert archive_month(month) == 10
+    assert partition_name(month) not in _partitions()
+    assert _count('audit_logs', month, end) == 0
+
+
+def test_events_arriving_during_archiving_are_kept(postgresql, archive_dir, monkeypatch):
+    import audit_archive
+    from app import db
+
+    month = audit_archive._add_months(audit_archive._month_start(datetime.utcnow().date()), 2)
+    end = audit_archive._add_months(month, 1)
+    for day in range(1, 11):
+        _log(datetime(month.year, month.month, day))
+    db.session.commit()
+
+    drop_month = audit_archive._drop_month
+    late = []
+
+    def replay_then_drop(month, archived_ids):
+        # A spooled event of the month replayed after the rows were read
+        late.append(_log(datetime(month.year, month.month, 20)))
+        db.session.commit()
+        drop_month(month, archived_ids)
+
+    monkeypatch.setattr(audit_archive, '_drop_month', replay_then_drop)
+    assert audit_archive.archive_month(month) == 10
+
+    assert audit_archive.partition_name(month) in _partitions()
+    assert db.session.execute(text('SELECT id FROM audit_logs WHERE created_at >= :start AND created_at < :end'),
+                              {'start': month, 'end': end}).scalars().all() == late
+
+    monkeypatch.setattr(audit_archive, '_drop_month', drop_month)
+    assert audit_archive.archive_month(month) == 1
+    assert _count('audit_logs', month, end) == 0
+
+
+def test_archiving_a_month_of_the_legacy_partition(postgresql, archive_dir):
+    from app import db
+    from audit_archive import _add_months, _month_start, archive_month
+
+    month = _add_months(_month_start(date.today()), -1)
+    end = _add_months(month, 1)
+    before = _count('audit_logs_legacy', month, end)
+    assert before
+
+    assert archive_month(month) == before
+    assert _count('audit_logs', month, end) == 0
+    assert db.session.execute(text('SELECT count(*) FROM audit_logs')).scalar() > 0
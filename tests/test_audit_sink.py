@@ -0,0 +1,95 @@
+import json
+import os
+import subprocess
+import sys
+from datetime import datetime
+
+import pytest
+
+
+@pytest.fixture
+def sink(app, tmp_path, monkeypatch):
+    """Buffered sink spooling to a temporary directory, flushed by hand"""
+    from audit import AuditSink
+
+    sink = AuditSink()
+    sink.init_app(app)
+    sink.sync = False
+    sink.spool_dir = str(tmp_path)
+    monkeypatch.setattr(sink._flusher, 'ensure_started', lambda: None)
+    return sink
+
+
+def _dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def _spool_line(user_id, details):
+    return json.dumps({'user_id': user_id, 'action': 'spool_teste', 'details': details,
+                       'ip_address': None, 'created_at': datetime.utcnow().isoformat()}) + '\n'
+
+
+def _logged(app, details):
+    from models import AuditLog
+
+    with app.app_context():
+        return AuditLog.query.filter(AuditLog.details.in_(details)).count()
+
+
+def test_orphaned_spools_are_replayed(app, sink, tmp_path, seeded_admin_id):
+    orphan = tmp_path / f'audit-{_dead_pid()}.jsonl'
+    # The last line was cut short by the worker dying mid-write
+    orphan.write_text(_spool_line(seeded_admin_id, 'órfão 1') + _spool_line(seeded_admin_id, 'órfão 2')
+                      + '{"user_id": 1, "act')
+    # A live worker's spool is left alone
+    live = tmp_path / f'audit-{os.getppid()}.jsonl'
+    live.write_text(_spool_line(seeded_admin_id, 'vivo'))
+
+    sink.log(seeded_admin_id, 'spool_teste', 'novo', '127.0.0.1')
+    assert sink.flush() == 3
+    assert _logged(app, ['órfão 1', 'órfão 2', 'novo']) == 3
+    assert _logged(app, ['vivo']) == 0
+    assert sorted(os.listdir(tmp_path)) == [live.name]
+
+
+def test_rejected_events_are_set_aside(app, sink, tmp_path, seeded_admin_id):
+    for index in range(7):
+        sink.log(seeded_admin_id, 'spool_teste', f'lote {index}', '127.0.0.1')
+    # NOT NULL violations
+    sink.log(None, 'spool_teste', 'sem usuário', '127.0.0.1')
+    sink.log(seeded_admin_id, None, 'sem ação', '127.0.0.1')
+
+    assert sink.flush() == 7
+    assert _logged(app, [f'lote {index}' for index in range(7)]) == 7
+    rejected = [json.loads(line) for line in (tmp_path / f'rejected-{os.getpid()}.jsonl').open()]
+    assert sorted(record['details'] for record in rejected) == ['sem ação', 'sem usuário']
+    assert all(record['error'] for record in rejected)
+    assert sink.flush() == 0
+
+
+def test_transient_errors_requeue_what_is_left(app, sink, seeded_admin_id, monkeypatch):
+    from sqlalchemy.exc import OperationalError
+
+    for index in range(4):
+        sink.log(seeded_admin_id, 'spool_teste', f'transitório {index}', '127.0.0.1')
+    sink.log(None, 'spool_teste', 'transitório inválido', '127.0.0.1')
+
+    insert, calls = sink._insert, []
+
+    def flaky(events):
+        calls.append(len(events))
+        if len(calls) == 3:
+            raise OperationalError('INSERT', {}, Exception('database is locked'))
+        insert(events)
+
+    monkeypatch.setattr(sink, '_insert', flaky)
+    with pytest.raises(OperationalError):
+        sink.flush()
+    # 5 rejected, then 2 inserted, then the other 3 failed
+    assert calls == [5, 2, 3]
+    assert _logged(app, [f'transitório {index}' for index in range(4)]) == 2
+
+    assert sink.flush() == 2
+    assert _logged(app, [f'transitório {index}' for index in range(4)]) == 4
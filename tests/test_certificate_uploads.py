@@ -0,0 +1,112 @@
+import io
+
+from factories import make_certificate, make_pfx, make_zip
+
+
+def _company(app, admin_id):
+    from app import db
+    from models import Company, User
+
+    with app.app_context():
+        organization_id = db.session.get(User, admin_id).organization_id
+        company = Company.query.filter_by(organization_id=organization_id).order_by(Company.id).first()
+        return company.id, company.cnpj_digits
+
+
+def _certificates(app, fingerprint):
+    from models import Certificate
+
+    with app.app_context():
+        return [(certificate.organization_id, certificate.name)
+                for certificate in Certificate.query.filter_by(fingerprint=fingerprint)]
+
+
+def _upload(client, company_id, data, password, name='Certificado enviado'):
+    return client.post('/certificates/upload', data={
+        'name': name,
+        'type': 'e-cnpj',
+        'company_id': company_id,
+        'password': password,
+        'certificate_file': (io.BytesIO(data), 'certificado.pfx'),
+    }, content_type='multipart/form-data')
+
+
+def test_cached_metadata_requires_the_right_password(app, login, seeded_admins):
+    from blobs import fingerprint_bytes
+
+    first, second = (login(admin_id) for admin_id in seeded_admins)
+    first_company, cnpj = _company(app, seeded_admins[0])
+    second_company, _ = _company(app, seeded_admins[1])
+    data = make_pfx(make_certificate(f'EMPRESA COMPARTILHADA:{cnpj}', cnpj), 'senha-certa')
+    fingerprint = fingerprint_bytes(data)
+
+    assert _upload(first, first_company, data, 'senha-certa').status_code == 302
+    assert len(_certificates(app, fingerprint)) == 1
+
+    # Same bytes in another organization: the cached metadata must not
+    # stand in for the password check
+    response = _upload(second, second_company, data, 'senha-errada')
+    assert response.status_code == 200
+    assert 'Senha incorreta' in response.get_data(as_text=True)
+    assert len(_certificates(app, fingerprint)) == 1
+
+    assert _upload(second, second_company, data, 'senha-certa').status_code == 302
+    assert len(_certificates(app, fingerprint)) == 2
+
+
+def test_import_checks_passwords_of_cached_files(app, seeded_admins):
+    from app import db
+    from blobs import cached_metadata, fingerprint_bytes
+    from ingestion import import_certificates
+    from models import CertificateBlob, User
+
+    _, cnpj = _company(app, seeded_admins[1])
+    certificate = make_certificate(f'EMPRESA IMPORTADA:{cnpj}', cnpj)
+    right, wrong = make_pfx(certificate, 'certa'), make_pfx(certificate, 'outra')
+    with app.app_context():
+        organization_id = db.session.get(User, seeded_admins[1]).organization_id
+        report = import_certificates(
+            make_zip({'primeiro.pfx': right}), organization_id, seeded_admins[1], default_password='certa'
+        )
+        assert [row['status'] for row in report] == ['imported']
+        blob = db.session.get(CertificateBlob, fingerprint_bytes(right))
+        assert cached_metadata(blob, 'certa')['ok']
+        assert cached_metadata(blob, 'errada') is None
+
+    with app.app_context():
+        organization_id = db.session.get(User, seeded_admins[0]).organization_id
+        report = import_certificates(
+            make_zip({'mesmo.pfx': right, 'outro.pfx': wrong}), organization_id, seeded_admins[0],
+            default_password='errada'
+        )
+    assert {row['file_name']: row['status'] for row in report} == {'mesmo.pfx': 'failed', 'outro.pfx': 'failed'}
+
+
+def test_uploads_parse_the_spooled_file(app, login, seeded_admins, monkeypatch):
+    import certificate_files
+    from storage import LocalStorage
+
+    first, second = (login(admin_id) for admin_id in seeded_admins)
+    first_company, cnpj = _company(app, seeded_admins[0])
+    second_company, _ = _company(app, seeded_admins[1])
+    data = make_pfx(make_certificate(f'EMPRESA EM CACHE:{cnpj}', cnpj), 'senha')
+
+    def no_reads(self, key):
+        raise AssertionError('uploads must not read the file back from storage')
+
+    saved, parses = [], []
+    save, parse = LocalStorage.save, certificate_files.parse_certificate_file
+    monkeypatch.setattr(LocalStorage, 'open', no_reads)
+    monkeypatch.setattr(LocalStorage, 'save', lambda self, key, stream: saved.append(key) or save(self, key, stream))
+    monkeypatch.setattr(certificate_files, 'parse_certificate_file', lambda *args: parses.append(args) or parse(*args))
+
+    # A wrong password is turned down before the file is stored
+    assert _upload(first, first_company, data, 'errada').status_code == 200
+    assert (len(parses), saved) == (1, [])
+
+    assert _upload(first, first_company, data, 'senha').status_code == 302
+    assert (len(parses), len(saved)) == (2, 1)
+
+    # The same bytes and password elsewhere reuse the cached metadata
+    assert _upload(second, second_company, data, 'senha').status_code == 302
+    assert (len(parses), len(saved)) == (2, 1)
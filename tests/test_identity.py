@@ -0,0 +1,75 @@
+import pytest
+from sqlalchemy import event, update
+
+import factories
+
+
+@pytest.fixture
+def workers(app, monkeypatch, tmp_path):
+    """Two identity caches sharing an invalidation log, as two workers of a
+    host would, inside an app context"""
+    import identity
+
+    monkeypatch.setattr(identity, 'INVALIDATION_POLL_INTERVAL', 0)
+    with app.app_context():
+        caches = []
+        for _ in range(2):
+            cache = identity.IdentityCache()
+            cache.ttl = 3600
+            cache.log = identity.InvalidationLog(str(tmp_path / 'identity_cache.db'), retention=3600)
+            caches.append(cache)
+        yield caches
+
+
+def test_hits_run_no_queries(workers):
+    from app import db
+    from identity import CachedUser
+
+    cache = workers[0]
+    user_id = factories.seed_organization('Organização sem Consultas', 0)
+    cache.load(user_id)
+    db.session.remove()
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        user = cache.load(user_id)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+    assert isinstance(user, CachedUser) and user.role == 'master_admin'
+    assert statements == []
+
+
+def test_commits_in_other_workers_invalidate(workers):
+    from app import db
+    from models import User
+
+    cache, other = workers
+    user_id = factories.seed_organization('Organização de Identidade', 0)
+    cache.load(user_id)
+
+    # Committed by another worker, which logs the invalidation
+    db.session.execute(update(User).where(User.id == user_id).values(role='operator'))
+    db.session.commit()
+    db.session.remove()
+    assert cache.load(user_id).role == 'master_admin'
+
+    other.invalidate(user_id)
+    db.session.remove()
+    assert cache.load(user_id).role == 'operator'
+
+
+def test_cached_user_is_read_only(workers):
+    cache = workers[0]
+    user_id = factories.seed_organization('Organização Somente Leitura', 0)
+    cache.load(user_id)
+    user = cache.load(user_id)
+
+    with pytest.raises(AttributeError, match='db_user'):
+        user.name = 'Outro nome'
+    user.db_user.name = 'Outro nome'
+    assert user.name == 'Outro nome'
@@ -0,0 +1,107 @@
+import io
+
+import pytest
+
+import factories
+from factories import make_certificate, make_pfx, make_zip
+
+
+@pytest.fixture
+def organization(app):
+    """(organization id, admin id, CNPJ digits of its two companies)"""
+    from app import db
+    from models import Company, User
+
+    with app.app_context():
+        admin_id = factories.seed_organization('Organização de Importação', 10)
+        organization_id = db.session.get(User, admin_id).organization_id
+        cnpjs = [company.cnpj_digits for company in
+                 Company.query.filter_by(organization_id=organization_id).order_by(Company.id)]
+        yield organization_id, admin_id, cnpjs
+
+
+def _archive(cnpjs):
+    first = make_certificate('EMPRESA UM', cnpjs[0])
+    return make_zip({
+        'empresa-um.pfx': make_pfx(first, 'senha-um'),
+        # Same certificate repackaged with another password
+        'copia/empresa-um.p12': make_pfx(first, 'senha-padrao'),
+        'sem-cnpj.pfx': make_pfx(make_certificate('EMPRESA DOIS'), 'senha-padrao'),
+        'outra-empresa.pfx': make_pfx(make_certificate('EMPRESA DE FORA', '99888777000166'), 'senha-padrao'),
+        'senha-errada.pfx': make_pfx(make_certificate('EMPRESA ERRADA', cnpjs[0]), 'outra-senha'),
+        'vencido.pfx': make_pfx(make_certificate('EMPRESA VENCIDA', cnpjs[0], days=-1), 'senha-padrao'),
+        'leia-me.txt': b'ignorado',
+    })
+
+
+def test_import_reports_every_file(organization):
+    from app import db
+    from ingestion import import_certificates
+    from models import Certificate, OrganizationCertificateStats
+
+    organization_id, admin_id, cnpjs = organization
+    manifest = f'arquivo;senha;cnpj\nempresa-um.pfx;senha-um;\nsem-cnpj.pfx;senha-padrao;{cnpjs[1]}\n'.encode()
+    before = db.session.get(OrganizationCertificateStats, organization_id).total_certificates
+
+    archive = _archive(cnpjs)
+    report = import_certificates(archive, organization_id, admin_id, manifest,
+                                 default_password='senha-padrao', workers=1)
+    assert {row['file_name']: row['status'] for row in report} == {
+        'empresa-um.pfx': 'imported',
+        'copia/empresa-um.p12': 'duplicate',
+        'sem-cnpj.pfx': 'imported',
+        'outra-empresa.pfx': 'unmatched',
+        'senha-errada.pfx': 'failed',
+        'vencido.pfx': 'expired',
+    }
+    imported = Certificate.query.filter(Certificate.organization_id == organization_id,
+                                        Certificate.name.like('EMPRESA%')).all()
+    assert sorted(certificate.name for certificate in imported) == ['EMPRESA DOIS', 'EMPRESA UM']
+    db.session.expire_all()
+    assert db.session.get(OrganizationCertificateStats, organization_id).total_certificates == before + 2
+
+    # Importing the same archive again adds nothing
+    report = import_certificates(archive, organization_id, admin_id, manifest,
+                                 default_password='senha-padrao', workers=1)
+    assert [row['status'] for row in report if row['file_name'] == 'empresa-um.pfx'] == ['duplicate']
+    assert Certificate.query.filter(Certificate.organization_id == organization_id,
+                                    Certificate.name.like('EMPRESA%')).count() == 2
+
+
+def test_invalid_archive(organization):
+    from ingestion import CertificateImportError, import_certificates
+
+    organization_id, admin_id, _ = organization
+    with pytest.raises(CertificateImportError, match='ZIP inválido'):
+        import_certificates(b'isto nao e um zip', organization_id, admin_id)
+
+
+def test_import_view(app, organization, login):
+    from models import Certificate
+
+    organization_id, admin_id, cnpjs = organization
+    archive = make_zip({'pela-tela.pfx': make_pfx(make_certificate('EMPRESA PELA TELA', cnpjs[0]), 'senha')})
+    response = login(admin_id).post('/certificates/import', data={
+        'archive': (io.BytesIO(archive), 'certificados.zip'),
+        'password': 'senha',
+    }, content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert '1 de 1 certificado(s) importado(s).' in response.get_data(as_text=True)
+    assert Certificate.query.filter_by(organization_id=organization_id, name='EMPRESA PELA TELA').count() == 1
+
+
+def test_large_batches_share_one_process_pool(app, monkeypatch):
+    import ingestion
+    from certificate_files import parse_certificate_file
+
+    monkeypatch.setattr(ingestion, 'PARALLEL_THRESHOLD', 2)
+    data = make_pfx(make_certificate('EMPRESA PARALELA', '11222333000181'), 'senha')
+    files = [(f'{index}.pfx', data) for index in range(4)]
+    with app.app_context():
+        first = ingestion.map_files(parse_certificate_file, files, ['senha'] * 4, workers=2)
+        executor = ingestion._executor(2)
+        second = ingestion.parse_files(files, ['senha', 'errada', 'senha', 'senha'], workers=2)
+        assert ingestion._executor(2) is executor
+
+    assert [result['cnpj'] for result in first] == ['11222333000181'] * 4
+    assert [result['ok'] for result in second] == [True, False, True, True]
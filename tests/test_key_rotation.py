@@ -0,0 +1,69 @@
+import os
+
+import pytest
+
+import factories
+
+
+@pytest.fixture
+def rings(app, monkeypatch):
+    """(configured, rotated) key rings: the second adds an active version 2"""
+    from key_ring import KeyRing, derive_key, get_key_ring
+
+    with app.app_context():
+        old = get_key_ring()
+    new = KeyRing({**old.keys, 2: derive_key('chave-nova-0123456789abcdef012345')})
+    monkeypatch.setitem(app.extensions, 'key_ring', old)
+    return old, new
+
+
+def test_rotation_is_idempotent_and_resumable(app, rings, monkeypatch):
+    from app import db
+    from key_rotation import count_outdated, rotate_keys
+    from models import Certificate, User
+
+    old, new = rings
+    with app.app_context():
+        organization_id = db.session.get(User, factories.seed_organization('Organização de Chaves', 25)).organization_id
+        certificates = Certificate.query.filter_by(organization_id=organization_id).all()
+        passwords = {}
+        for certificate in certificates:
+            passwords[certificate.id] = f'senha-{certificate.id}'
+            certificate.encrypted_password, certificate.iv, certificate.key_version = old.encrypt(
+                passwords[certificate.id]
+            )
+        # Does not decrypt with its key: counted as failed, left untouched
+        broken = certificates[0]
+        broken.encrypted_password = os.urandom(32)
+        db.session.commit()
+
+        monkeypatch.setitem(app.extensions, 'key_ring', new)
+        outdated = count_outdated(2)
+        assert outdated >= len(certificates)
+
+        # Interrupted after the first batch: that batch stays committed
+        def interrupt(processed, total):
+            raise KeyboardInterrupt
+
+        with pytest.raises(KeyboardInterrupt):
+            rotate_keys(batch_size=10, workers=1, progress=interrupt)
+        db.session.rollback()
+        remaining = count_outdated(2)
+        assert outdated - 10 <= remaining < outdated
+
+        done, failed = rotate_keys(batch_size=10, workers=1)
+        assert failed == 1
+        assert done + failed == remaining
+
+        db.session.expire_all()
+        for certificate in Certificate.query.filter_by(organization_id=organization_id):
+            if certificate.id == broken.id:
+                assert certificate.key_version == 1
+                continue
+            assert certificate.key_version == 2
+            assert new.decrypt(certificate.encrypted_password, certificate.iv, 2) == passwords[certificate.id]
+
+        snapshot = {certificate.id: certificate.encrypted_password for certificate in Certificate.query}
+        assert rotate_keys(batch_size=10, workers=1) == (0, 1)
+        db.session.expire_all()
+        assert {certificate.id: certificate.encrypted_password for certificate in Certificate.query} == snapshot
@@ -0,0 +1,80 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+COUNTER = 'oguardiao_requests_total'
+
+
+@pytest.fixture
+def metrics(app, monkeypatch, tmp_path):
+    """The app's request metrics writing to an empty directory"""
+    from metrics import request_metrics
+
+    monkeypatch.setattr(request_metrics, 'directory', str(tmp_path))
+    monkeypatch.setattr(request_metrics, 'token', None)
+    return request_metrics
+
+
+def _dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def test_metrics_without_token_are_local_only(app, metrics):
+    client = app.test_client()
+
+    assert client.get('/metrics').status_code == 200
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '203.0.113.7'}).status_code == 404
+    assert client.get('/metrics', headers={'X-Forwarded-For': '203.0.113.7'}).status_code == 404
+
+
+def test_metrics_token(app, metrics, monkeypatch):
+    monkeypatch.setattr(metrics, 'token', 'segredo')
+    client = app.test_client()
+
+    assert client.get('/metrics').status_code == 401
+    response = client.get('/metrics', environ_base={'REMOTE_ADDR': '203.0.113.7'},
+                          headers={'Authorization': 'Bearer segredo'})
+    assert response.status_code == 200
+
+
+def test_dead_processes_are_folded_into_one_file(metrics):
+    from metrics import RETIRED_FILE
+
+    key = json.dumps(['login', 'POST', '302'])
+    dead = [os.path.join(metrics.directory, f'metrics-{_dead_pid()}.json') for _ in range(2)]
+    alive = os.path.join(metrics.directory, f'metrics-{os.getppid()}.json')
+    for path, count in [(dead[0], 10), (dead[1], 10), (alive, 1)]:
+        with open(path, 'w') as output:
+            json.dump({COUNTER: {key: count}}, output)
+
+    # Collected twice: folding must not count the dead processes again
+    for _ in range(2):
+        own = metrics._snapshot().get(COUNTER, {}).get(key, 0)
+        assert metrics.collect()[COUNTER][key] == 21 + own
+    assert not any(os.path.exists(path) for path in dead)
+    assert os.path.exists(alive)
+    assert os.path.exists(os.path.join(metrics.directory, RETIRED_FILE))
+
+
+def test_failed_queries_are_timed(app, metrics):
+    from flask import g
+
+    from app import db
+
+    with app.test_request_context('/'):
+        metrics.start()
+        with db.engine.connect() as connection:
+            with pytest.raises(OperationalError):
+                connection.execute(text('SELECT * FROM tabela_inexistente'))
+            assert g.sql_metrics['queries'] == 1
+            assert not connection.info['query_started']
+
+            connection.execute(text('SELECT 1'))
+            assert g.sql_metrics['queries'] == 2
@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta
+from smtplib import SMTPException
+
+import pytest
+
+
+@pytest.fixture
+def outbox(app):
+    """App context with an empty queue of due messages"""
+    from outbox import drain_all
+
+    with app.app_context():
+        drain_all()
+        yield
+
+
+def _overdue(message_ids):
+    """Make messages due now, as if their lease or backoff had passed"""
+    from sqlalchemy import update
+
+    from app import db
+    from models import MailOutbox
+
+    db.session.execute(
+        update(MailOutbox).where(MailOutbox.id.in_(message_ids))
+        .values(next_attempt_at=datetime.utcnow() - timedelta(seconds=1))
+    )
+    db.session.commit()
+
+
+def test_dedup_and_lease(app, outbox):
+    from app import db, mail
+    from models import MailOutbox
+    from outbox import _claim_batch, drain_outbox, enqueue_mail
+
+    for _ in range(2):
+        enqueue_mail(['a@teste.test', 'b@teste.test'], 'Assunto', '<p>Olá</p>', dedup_key='teste:lease')
+        db.session.commit()
+    ids = [message.id for message in MailOutbox.query.filter(MailOutbox.dedup_key.like('teste:lease:%'))]
+    assert len(ids) == 2
+
+    # A worker claims the batch and dies before sending: the lease keeps the
+    # messages from being sent twice until it expires
+    assert [message.id for message in _claim_batch(10, lease=600)] == ids
+    with mail.record_messages() as sent:
+        assert drain_outbox()['sent'] == 0
+        _overdue(ids)
+        assert drain_outbox()['sent'] == 2
+    assert sorted(message.recipients[0] for message in sent) == ['a@teste.test', 'b@teste.test']
+    assert {message.status for message in MailOutbox.query.filter(MailOutbox.id.in_(ids))} == {'sent'}
+
+    # Sent messages are not queued again under the same key
+    assert enqueue_mail(['a@teste.test'], 'Assunto', '<p>Olá</p>', dedup_key='teste:lease') == 0
+
+
+def test_retry_backoff(app, outbox, monkeypatch):
+    import flask_mail
+
+    from app import db, mail
+    from models import MailOutbox
+    from outbox import drain_outbox, enqueue_mail
+
+    monkeypatch.setitem(app.config, 'MAIL_OUTBOX_RETRY_BACKOFF', 60)
+    monkeypatch.setitem(app.config, 'MAIL_OUTBOX_MAX_ATTEMPTS', 3)
+    enqueue_mail(['c@teste.test'], 'Assunto', '<p>Olá</p>', dedup_key='teste:retry')
+    db.session.commit()
+    message = MailOutbox.query.filter_by(dedup_key='teste:retry:c@teste.test').one()
+
+    def refuse(self, message, envelope_from=None):
+        raise SMTPException('451 tente mais tarde')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(flask_mail.Connection, 'send', refuse)
+        for attempt, delay in ((1, 60), (2, 120)):
+            started = datetime.utcnow()
+            assert drain_outbox()['retried'] == 1
+            db.session.refresh(message)
+            assert (message.status, message.attempts) == ('pending', attempt)
+            assert '451' in message.last_error
+            assert abs((message.next_attempt_at - started).total_seconds() - delay) < 5
+            # Not due again before the backoff
+            assert drain_outbox()['retried'] == 0
+            _overdue([message.id])
+
+        assert drain_outbox()['failed'] == 1
+        db.session.refresh(message)
+        assert (message.status, message.attempts) == ('failed', 3)
+
+    with mail.record_messages() as sent:
+        assert drain_outbox()['sent'] == 0
+    assert not sent
@@ -0,0 +1,146 @@
+from datetime import date, datetime
+
+import pytest
+
+import factories
+
+
+def test_cursor_round_trip(app):
+    from models import AuditLog, Certificate
+    from pagination import decode_cursor, encode_cursor
+
+    filters = {'type': 'e-cnpj', 'search': ''}
+    token = encode_cursor([date(2026, 3, 1), 42], 'next', filters)
+    assert decode_cursor(token, [Certificate.expiry_date, Certificate.id], filters) == (
+        [date(2026, 3, 1), 42], 'next'
+    )
+
+    moment = datetime(2026, 3, 1, 12, 30, 5, 123456)
+    token = encode_cursor([moment, 7], 'prev')
+    assert decode_cursor(token, [AuditLog.created_at, AuditLog.id]) == ([moment, 7], 'prev')
+
+
+@pytest.mark.parametrize('token', [
+    None, '', 'não-é-base64', 'eyJrIjpbXX0', 'bm90IGpzb24',
+])
+def test_malformed_cursors_are_ignored(app, token):
+    from models import Certificate
+    from pagination import decode_cursor
+
+    assert decode_cursor(token, [Certificate.expiry_date, Certificate.id]) is None
+
+
+def test_cursor_of_other_filters_is_ignored(app):
+    from models import Certificate
+    from pagination import decode_cursor, encode_cursor
+
+    columns = [Certificate.expiry_date, Certificate.id]
+    token = encode_cursor([date(2026, 3, 1), 42], 'next', {'type': 'e-cnpj'})
+    assert decode_cursor(token, columns, {'type': 'e-cpf'}) is None
+    assert decode_cursor(token, columns, {'type': 'e-cnpj', 'company_id': 3}) is None
+    # Wrong number of key values
+    assert decode_cursor(token, [Certificate.id], {'type': 'e-cnpj'}) is None
+
+
+def test_walk_certificates_both_ways(app, seeded_admin_id):
+    from app import db
+    from models import Certificate, User
+    from pagination import keyset_paginate
+    from projections import certificate_rows
+
+    with app.app_context():
+        organization_id = db.session.get(User, seeded_admin_id).organization_id
+        query = certificate_rows(Certificate.query.filter(Certificate.organization_id == organization_id))
+        columns = [Certificate.expiry_date, Certificate.id]
+        expected = [row.id for row in query.order_by(Certificate.expiry_date, Certificate.id)]
+        filters = {'organization_id': organization_id}
+
+        pages, cursor = [], None
+        while True:
+            page = keyset_paginate(query, columns, cursor=cursor, per_page=16, filters=filters)
+            pages.append([row.id for row in page])
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        assert sum(pages, []) == expected
+        assert all(len(page) == 16 for page in pages[:-1])
+
+        walked_back = [pages[-1]]
+        while page.has_prev:
+            page = keyset_paginate(query, columns, cursor=page.prev_cursor, per_page=16, filters=filters)
+            walked_back.insert(0, [row.id for row in page])
+        assert walked_back == pages
+
+        # The same cursor under other filters restarts from the first page
+        page = keyset_paginate(query, columns, cursor=cursor, per_page=16,
+                               filters={'organization_id': organization_id, 'type': 'e-cpf'})
+        assert [row.id for row in page] == pages[0]
+        assert not page.has_prev
+
+
+def test_listing_ignores_cursor_of_other_filters(client):
+    from pagination import encode_cursor
+
+    # Past every certificate: honoured, it would give an empty page
+    filters = {'company_id': None, 'type': 'e-cnpj', 'status': None, 'search': '', 'per_page': 48}
+    cursor = encode_cursor([date(2100, 1, 1), 10 ** 6], 'next', filters)
+    first = client.get('/certificates?type=e-cpf').get_data(as_text=True)
+    response = client.get(f'/certificates?type=e-cpf&cursor={cursor}')
+    assert response.status_code == 200
+    assert 'Certificado 000000' in first
+    assert 'Certificado 000000' in response.get_data(as_text=True)
+
+
+def test_walk_audit_logs_into_the_archive(app):
+    from app import db
+    from audit_archive import archive_month, archived_audit_logs
+    from models import AuditLog, User
+    from pagination import keyset_paginate
+    from projections import audit_log_rows
+
+    with app.app_context():
+        user = db.session.get(User, factories.seed_organization('Organização de Auditoria', 10))
+        db.session.add_all([
+            AuditLog(user_id=user.id, organization_id=user.organization_id, action='login',
+                     created_at=datetime(2019, 6, 1 + day))
+            for day in range(12)
+        ])
+        db.session.add(AuditLog(user_id=user.id, organization_id=user.organization_id, action='login'))
+        db.session.commit()
+        assert archive_month(date(2019, 6, 1)) == 12
+
+        query = audit_log_rows(AuditLog.query.filter(AuditLog.organization_id == user.organization_id))
+        columns = [AuditLog.created_at, AuditLog.id]
+
+        def page_at(cursor):
+            return keyset_paginate(query, columns, cursor=cursor, per_page=7, descending=True,
+                                   tail=archived_audit_logs(user.organization_id))
+
+        pages, page = [], page_at(None)
+        pages.append([(log.created_at, log.id) for log in page])
+        while page.has_next:
+            page = page_at(page.next_cursor)
+            pages.append([(log.created_at, log.id) for log in page])
+        walked = sum(pages, [])
+        assert len(walked) == 10 * 2 + 1 + 12
+        assert walked == sorted(walked, reverse=True)
+        assert walked[-1][0] == datetime(2019, 6, 1)
+
+        walked_back = [pages[-1]]
+        while page.has_prev:
+            page = page_at(page.prev_cursor)
+            walked_back.insert(0, [(log.created_at, log.id) for log in page])
+        assert walked_back == pages
+
+
+def test_action_catalog_is_per_organization(app, seeded_admins):
+    from app import db
+    from audit import action_catalog
+    from models import User
+    from utils import log_audit_event
+
+    with app.app_context():
+        log_audit_event(seeded_admins[1], 'catalogo_teste', 'Evento', '127.0.0.1')
+        first, second = (db.session.get(User, admin_id).organization_id for admin_id in seeded_admins)
+        assert 'catalogo_teste' in action_catalog.get(second)
+        assert 'catalogo_teste' not in action_catalog.get(first)
@@ -0,0 +1,39 @@
+import pytest
+
+# Maximum SQL statements per request on the seeded dataset (cold caches).
+# Raise a budget only with a reason: a count that grows with the number of
+# rows is an N+1 and belongs in the view's eager loading instead.
+QUERY_BUDGETS = [
+    ('/dashboard', 8),
+    ('/certificates', 5),
+    ('/certificates?status=expiring-soon&type=e-cnpj', 5),
+    ('/certificates?search=Certificado', 6),
+    ('/companies', 4),
+    ('/companies?search=Empresa', 5),
+    ('/users', 3),
+    ('/audit-logs', 5),
+    ('/audit-logs?action=login', 5),
+    ('/reports/export-certificates?format=csv', 5),
+    ('/reports/export-certificates?format=xlsx', 5),
+]
+
+
+@pytest.mark.parametrize('path, limit', QUERY_BUDGETS)
+def test_query_budget(client, query_budget, path, limit):
+    with query_budget(limit):
+        response = client.get(path)
+        response.get_data()
+    assert response.status_code == 200
+
+
+def test_lazy_loads_in_templates_fail(app, seeded_admin_id):
+    from flask import render_template_string
+    from lazy_loads import LazyLoadError
+    from models import Certificate
+
+    template = '{% for certificate in certificates %}{{ certificate.company.name }}{% endfor %}'
+    with app.test_request_context('/certificates'):
+        # The first five certificates belong to five different companies
+        certificates = Certificate.query.order_by(Certificate.id).limit(5).all()
+        with pytest.raises(LazyLoadError, match='Certificate.company'):
+            render_template_string(template, certificates=certificates)
@@ -0,0 +1,74 @@
+import pytest
+
+# Capacity 3 at one token per second, capacity 2 at one token every two
+BUCKETS = [('ip:1', 3, 1.0), ('user:1', 2, 0.5)]
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    from rate_limit import MemoryStore, SQLiteStore
+
+    if request.param == 'memory':
+        return MemoryStore()
+    return SQLiteStore(str(tmp_path / 'rate_limit.db'))
+
+
+def _tokens(limits):
+    return [round(tokens, 6) for _, tokens, _, _ in limits]
+
+
+def test_buckets_are_debited_together(store):
+    assert store.consume(BUCKETS, 100.0) == (True, [(3, 2.0, 1.0, 0.0), (2, 1.0, 2.0, 0.0)])
+    allowed, limits = store.consume(BUCKETS, 100.0)
+    assert allowed and _tokens(limits) == [1.0, 0.0]
+
+    # The user bucket is empty: the request is refused and the IP bucket
+    # keeps its token
+    allowed, limits = store.consume(BUCKETS, 100.0)
+    assert not allowed
+    assert _tokens(limits) == [1.0, 0.0]
+    assert limits[1][3] == 2.0  # seconds to the user's next token
+
+    # One second refills the IP bucket, not yet a user token
+    allowed, limits = store.consume(BUCKETS, 101.0)
+    assert not allowed and _tokens(limits) == [2.0, 0.5]
+
+    allowed, limits = store.consume(BUCKETS, 102.0)
+    assert allowed and _tokens(limits) == [2.0, 0.0]
+
+
+def test_buckets_refill_up_to_capacity(store):
+    for _ in range(2):
+        store.consume(BUCKETS, 100.0)
+    allowed, limits = store.consume(BUCKETS, 1000.0)
+    assert allowed and _tokens(limits) == [2.0, 1.0]
+
+
+def test_buckets_are_independent_per_key(store):
+    for _ in range(2):
+        store.consume(BUCKETS, 100.0)
+    allowed, limits = store.consume([('ip:2', 3, 1.0), ('user:2', 2, 0.5)], 100.0)
+    assert allowed and _tokens(limits) == [2.0, 1.0]
+
+
+def test_proxy_headers_trusted_by_default(app, monkeypatch):
+    from werkzeug.test import EnvironBuilder
+
+    seen = {}
+
+    def capture(environ, start_response):
+        seen.update(environ)
+        return []
+
+    monkeypatch.setattr(app.wsgi_app, 'app', capture)
+    app.wsgi_app(EnvironBuilder(
+        headers={'X-Forwarded-For': '203.0.113.7', 'X-Forwarded-Proto': 'https',
+                 'X-Forwarded-Host': 'guardiao.example'},
+        environ_base={'REMOTE_ADDR': '127.0.0.1'}
+    ).get_environ(), lambda *args: None)
+
+    # HTTPS links and the public host come from the proxy; client IPs only
+    # when PROXY_FIX_X_FOR is set
+    assert seen['wsgi.url_scheme'] == 'https'
+    assert seen['HTTP_HOST'] == 'guardiao.example'
+    assert seen['REMOTE_ADDR'] == '127.0.0.1'
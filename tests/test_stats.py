@@ -0,0 +1,148 @@
+from datetime import date, timedelta
+
+import pytest
+
+import factories
+
+
+@pytest.fixture
+def organization(app):
+    """Id of a freshly seeded organization, inside an app context"""
+    from app import db
+    from models import User
+
+    with app.app_context():
+        admin_id = factories.seed_organization('Organização de Estatísticas', 60)
+        yield db.session.get(User, admin_id).organization_id
+
+
+def _assert_read_model_matches(organization_id, today):
+    from app import db
+    from models import OrganizationCertificateStats
+    from stats import STATS_COLUMNS, compute_certificate_stats
+
+    db.session.expire_all()
+    stats = db.session.get(OrganizationCertificateStats, organization_id)
+    assert stats.as_of == today
+    assert {column: getattr(stats, column) for column in STATS_COLUMNS} == compute_certificate_stats(
+        organization_id, today
+    )
+
+
+def _certificates(organization_id):
+    from models import Certificate
+
+    return Certificate.query.filter_by(organization_id=organization_id).order_by(Certificate.id).all()
+
+
+def test_inserts_and_deletes(organization):
+    from app import db
+    from models import Certificate
+    from stats import record_certificate_changes
+
+    today = date.today()
+    template = _certificates(organization)[0]
+    added = [
+        Certificate(name=f'Novo {days}', type='e-cpf', file_name='novo.pfx', company_id=template.company_id,
+                    issue_date=today, expiry_date=today + timedelta(days=days), created_by=template.created_by)
+        for days in (-5, 0, 1, 30, 31, 75, 200)
+    ]
+    db.session.add_all(added)
+    db.session.flush()
+    record_certificate_changes(organization, added, 1, today)
+    db.session.commit()
+    _assert_read_model_matches(organization, today)
+
+    removed = _certificates(organization)[::7]
+    for certificate in removed:
+        db.session.delete(certificate)
+    db.session.flush()
+    record_certificate_changes(organization, removed, -1, today)
+    db.session.commit()
+    _assert_read_model_matches(organization, today)
+
+
+def test_expiry_and_type_edits(organization):
+    from app import db
+    from stats import get_organization_stats
+
+    today = date.today()
+    for index, certificate in enumerate(_certificates(organization)[:12]):
+        certificate.expiry_date = today + timedelta(days=(-3, 10, 45, 80, 300)[index % 5])
+        if index % 3 == 0:
+            certificate.type = 'e-cpf' if certificate.type == 'e-cnpj' else 'e-cnpj'
+    db.session.commit()
+    _assert_read_model_matches(organization, today)
+
+    # Changed before the attribute was loaded: the row is rebuilt on read
+    certificate = _certificates(organization)[20]
+    db.session.commit()
+    certificate.expiry_date = today + timedelta(days=15)
+    db.session.commit()
+    get_organization_stats(organization)
+    _assert_read_model_matches(organization, today)
+
+
+def test_rollover_after_several_days(organization):
+    from app import db
+    from stats import rebuild_organization_stats, rollover_organization_stats
+
+    today = date.today()
+    rebuild_organization_stats(organization, today - timedelta(days=40))
+    db.session.commit()
+
+    assert rollover_organization_stats(today, organization) == 1
+    db.session.commit()
+    _assert_read_model_matches(organization, today)
+
+
+def test_edit_of_a_stale_row_rebuilds_it(organization):
+    from app import db
+    from models import OrganizationCertificateStats
+    from stats import get_organization_stats, rebuild_organization_stats
+
+    today = date.today()
+    rebuild_organization_stats(organization, today - timedelta(days=3))
+    db.session.commit()
+
+    _certificates(organization)[0].expiry_date = today + timedelta(days=5)
+    db.session.commit()
+    assert db.session.get(OrganizationCertificateStats, organization) is None
+
+    get_organization_stats(organization)
+    _assert_read_model_matches(organization, today)
+
+
+def test_company_moved_to_another_organization(organization):
+    from app import db
+    from models import Company, User
+
+    today = date.today()
+    target = db.session.get(User, factories.seed_organization('Organização de Destino', 10)).organization_id
+    certificate = _certificates(organization)[0]
+    company = db.session.get(Company, certificate.company_id)
+    company.organization_id = target
+    # Edited in the same flush as the move
+    certificate.expiry_date = today + timedelta(days=3)
+    db.session.commit()
+
+    assert {certificate.organization_id for certificate in company.certificates} == {target}
+    _assert_read_model_matches(organization, today)
+    _assert_read_model_matches(target, today)
+
+
+def test_exports_and_stats_share_the_expiry_boundary(organization):
+    from exports import iter_certificate_rows
+    from stats import certificate_status, compute_certificate_stats
+
+    today = date.today()
+    stats = compute_certificate_stats(organization, today)
+    expired = list(iter_certificate_rows(organization, 'expired', today))
+    expiring = list(iter_certificate_rows(organization, 'expiring-soon', today))
+
+    assert certificate_status(today, today) == 'expired'
+    assert any(row[5] == today.strftime('%d/%m/%Y') for row in expired)
+    assert {row[7] for row in expired} == {'Expirado'}
+    assert {row[7] for row in expiring} == {'Expirando em breve'}
+    assert len(expired) == stats['expired_count']
+    assert len(expiring) == stats['expiring_30d']
@@ -0,0 +1,70 @@
+import io
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+import factories
+
+moto = pytest.importorskip('moto')
+
+BUCKET = 'oguardiao-testes'
+# The smallest part S3 accepts
+CHUNK_SIZE = 5 * 1024 * 1024
+
+
+@pytest.fixture
+def s3(app, monkeypatch):
+    """S3Storage on a mocked bucket, installed as the app's storage backend"""
+    from storage import S3Storage
+
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testes')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testes')
+    with moto.mock_aws():
+        storage = S3Storage(BUCKET, prefix='certificates/', region='us-east-1', chunk_size=CHUNK_SIZE)
+        storage.client.create_bucket(Bucket=BUCKET)
+        monkeypatch.setitem(app.config, 'STORAGE_BACKEND', 's3')
+        monkeypatch.setitem(app.extensions.setdefault('certificate_storage', {}), 'default', storage)
+        yield storage
+
+
+def test_large_uploads_are_multipart(s3):
+    data = bytes(range(256)) * (CHUNK_SIZE * 2 // 256 + 1)
+
+    key = s3.save('grande.pfx', io.BytesIO(data))
+
+    assert key == 'certificates/grande.pfx'
+    # Multipart objects have an ETag of the form "<md5>-<parts>"
+    assert s3.client.head_object(Bucket=BUCKET, Key=key)['ETag'].strip('"').endswith('-3')
+    assert s3.open(key).read() == data
+
+
+def test_small_uploads_are_single_part(s3):
+    key = s3.save('pequeno.pfx', io.BytesIO(b'conteudo'))
+
+    assert '-' not in s3.client.head_object(Bucket=BUCKET, Key=key)['ETag']
+    assert s3.open(key).read() == b'conteudo'
+
+
+def test_download_redirects_to_presigned_url(app, s3, login):
+    from app import db
+    from models import Certificate, User
+
+    with app.app_context():
+        admin_id = factories.seed_organization('Organização S3', 1)
+        organization_id = db.session.get(User, admin_id).organization_id
+        certificate = Certificate.query.filter_by(organization_id=organization_id).one()
+        certificate.s3_key = s3.save(certificate.file_name, io.BytesIO(b'pfx'))
+        db.session.commit()
+        certificate_id, s3_key = certificate.id, certificate.s3_key
+
+    response = login(admin_id).get(f'/api/certificates/{certificate_id}/download')
+
+    assert response.status_code == 302
+    location = urlsplit(response.headers['Location'])
+    assert location.path.endswith(f'/{BUCKET}/{s3_key}') or location.netloc.startswith(BUCKET)
+    query = parse_qs(location.query)
+    assert query['Signature']
+    expires = int(query['Expires'][0]) - time.time()
+    assert 0 < expires <= app.config['STORAGE_PRESIGNED_URL_TTL']
+    assert query['response-content-disposition'][0].startswith('attachment; filename=')